@@ -0,0 +1,430 @@
+import asyncio
+import atexit
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+async def run(cmd, name='', ret=None, p_stdout=False, p_stderr=True):
+    """ Run the command asynchronously in the shell.
+
+    Args:
+        cmd (str): The command to execute.
+        name (str, optional): An output name for logging. Defaults to ''.
+        ret (str, optional): If not None, which output should be returned. Defaults to None.
+        p_stdout (bool, optional): Print stdout. Defaults to False.
+        p_stderr (bool, optional): Print stderr. Defaults to True.
+
+    Returns:
+        str|None: The requested output if `ret` is set.
+    """
+    proc = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    stdout, stderr = await proc.communicate()
+    print(f'[{name if name else cmd!r} -> {proc.returncode}]')
+    if p_stdout and stdout:
+        print(f'[stdout]\n{stdout.decode()}')
+    if ret == 'stdout' and stdout:
+        return stdout.decode()
+    if p_stderr and stderr:
+        print(f'[stderr]\n{stderr.decode()}')
+    if ret == 'stderr' and stderr:
+        return stderr.decode()
+    if ret:
+        return 'No output.'
+
+
+class DeploymentBackend:
+    """Starts and stops the intermediate nodes.
+
+    The nodes are started without a client key. They get the `lease_token`
+    so that the directory node can lease them to a route later on, and the
+    registration token of their URL to register their public keys.
+    """
+
+    name = ''
+
+    def deploy(self, node_ids):
+        """Start the nodes with the given ids.
+
+        Args:
+            node_ids (List[str]): The node ids.
+
+        Returns:
+            List[str]: The URLs of the nodes, in the order of the ids.
+        """
+        raise NotImplementedError
+
+    def stop(self, node_ids):
+        """Stop the nodes with the given ids.
+
+        Args:
+            node_ids (List[str]): The node ids.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """Return the backend counters.
+
+        Returns:
+            dict: At least the backend name.
+        """
+        return {'backend': self.name}
+
+
+class GCloudBackend(DeploymentBackend):
+    """Deploys every node as its own Cloud Run service (e.g. node-014).
+
+    The URL of this directory node and the node image are looked up with
+    `gcloud run services describe` once and cached for `refresh` seconds,
+    unless both are given.
+    """
+
+    name = 'gcloud'
+
+    def __init__(self,
+                 lease_token,
+                 region='europe-west3',
+                 directory_url=None,
+                 node_image=None,
+                 refresh=3600.0,
+                 server='wsgi',
+                 register_token=None):
+        """
+        Args:
+            lease_token (str): The lease token to pass on to the nodes.
+            region (str, optional): The Cloud Run region. Defaults to 'europe-west3'.
+            directory_url (str, optional): The URL of this directory node. Defaults to None,
+                then it is looked up.
+            node_image (str, optional): The image of the nodes. Defaults to None,
+                then it is looked up.
+            refresh (float, optional): Seconds after which the looked up values are
+                looked up again. Defaults to 3600.
+            server (str, optional): 'wsgi' serves the nodes with threads, 'asgi' with asyncio.
+                Defaults to 'wsgi'.
+            register_token (Callable[[str], str], optional): Issues the registration token
+                of a node out of its URL. Defaults to None, then the nodes do not register.
+        """
+        self.lease_token = lease_token
+        self.register_token = register_token
+        self.region = region
+        self.directory_url = directory_url
+        self.node_image = node_image
+        self.refresh = refresh
+        self.server = server
+        self.lookups = 0
+        self._info = None
+        self._looked_up = 0.0
+        self._lock = threading.Lock()
+
+    def service_info(self):
+        """Get the URL of this directory node and the image repository of the nodes.
+        Given values are used as they are, the others come from the cache
+        which is refreshed every `refresh` seconds. If a refresh fails the
+        old values are kept.
+
+        Returns:
+            str, str: directory service URL, node image URL
+        """
+        if self.directory_url and self.node_image:
+            return self.directory_url, self.node_image
+        with self._lock:
+            now = time.monotonic()
+            if self._info is None or now - self._looked_up > self.refresh:
+                self._looked_up = now
+                try:
+                    self._info = self.describe()
+                    self.lookups += 1
+                except Exception:
+                    if self._info is None:
+                        raise
+                    traceback.print_exc()
+            directory_service_url, directory_repo_url = self._info
+        return (self.directory_url or directory_service_url, self.node_image
+                or directory_repo_url)
+
+    def describe(self):
+        """Look up the URL of this directory node and the image repository of the nodes.
+
+        Returns:
+            str, str: directory service URL, node image URL
+        """
+        cmd_get_service_url = f'gcloud run services describe directory --region {self.region} --format=json'
+
+        # Get repo URL and URL of this node and remove the trailing new line
+        data_raw = asyncio.run(
+            run(cmd_get_service_url,
+                '',
+                ret='stdout',
+                p_stdout=False,
+                p_stderr=False))
+        data = json.loads(data_raw)
+        directory_service_url = data['status']['url']
+        directory_repo_url = data['spec']['template']['metadata'][
+            'annotations']['client.knative.dev/user-image']
+        directory_repo_url = directory_repo_url.replace('directory', 'node')
+        return directory_service_url, directory_repo_url
+
+    async def instantiate_nodes(self, directory_service_url,
+                                directory_repo_url, node_ids):
+        """Instantiates the nodes with the given node_ids by using the gcloud cli.
+        Are instantiates asynchronously to speed up the process.
+
+        Args:
+            directory_service_url (str): This directory nodes URL to pass on.
+            directory_repo_url (str): The repository from which to pull the node images.
+            node_ids (List[str]): Node ids for the GCloud service name (e.g. node-014).
+        """
+        cmd = """\
+DIRECTORY_NODE="{directory_service_url}"
+
+gcloud run deploy node-{idx} --region {region} --allow-unauthenticated \
+    --image {directory_repo_url} \
+    --set-env-vars="DIRECTORY_NODE=$DIRECTORY_NODE" \
+    --set-env-vars="THIS_NODE={node_url}" \
+    --set-env-vars="LEASE_TOKEN={lease_token}" \
+    --set-env-vars="REGISTER_TOKEN={register_token}" \
+    --set-env-vars="NODE_SERVER={server}"
+    """
+        node_urls = [
+            directory_service_url.replace('directory', f'node-{node_id}')
+            for node_id in node_ids
+        ]
+        await asyncio.gather(*[
+            run(
+                cmd.format(directory_service_url=directory_service_url,
+                           directory_repo_url=directory_repo_url,
+                           node_url=node_url,
+                           idx=node_id,
+                           region=self.region,
+                           lease_token=self.lease_token,
+                           register_token=self.register_token(node_url)
+                           if self.register_token else '',
+                           server=self.server),
+                f'deploy node-{node_id}')
+            for node_id, node_url in zip(node_ids, node_urls)
+        ])
+
+    async def stop_nodes(self, node_ids):
+        """Shut down the nodes GCloud services with the given names.
+        Shutdown call happens asynchronously.
+
+        Args:
+            node_ids (List[str]): The node ids to shut down.
+        """
+        cmd = 'gcloud run services delete node-{node_id} -q --region {region}'
+
+        await asyncio.gather(*[
+            run(cmd.format(node_id=node_id, region=self.region),
+                f'stop node-{node_id}') for node_id in node_ids
+        ])
+
+    def deploy(self, node_ids):
+        directory_service_url, directory_repo_url = self.service_info()
+        asyncio.run(
+            self.instantiate_nodes(directory_service_url, directory_repo_url,
+                                   node_ids))
+        return [
+            directory_service_url.replace('directory', f'node-{node_id}')
+            for node_id in node_ids
+        ]
+
+    def stop(self, node_ids):
+        asyncio.run(self.stop_nodes(node_ids))
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'region': self.region,
+            'lookups': self.lookups
+        }
+
+
+class LocalBackend(DeploymentBackend):
+    """Runs every node as a local process of `IntermediateNode/main.py` on a free port.
+
+    Every process gets its own working directory for its key files.
+    Stopped nodes are parked instead of killed, up to `max_idle` of them,
+    and are reused for the next deployment since a released node is already
+    reset by the directory node.
+    """
+
+    name = 'local'
+
+    def __init__(self,
+                 lease_token,
+                 directory_url,
+                 node_dir=None,
+                 host='127.0.0.1',
+                 max_idle=3,
+                 startup_timeout=30.0,
+                 server='wsgi',
+                 register_token=None):
+        """
+        Args:
+            lease_token (str): The lease token to pass on to the nodes.
+            directory_url (str): The URL of this directory node to pass on.
+            node_dir (str, optional): The directory of the node sources.
+                Defaults to the IntermediateNode directory next to this one.
+            host (str, optional): The interface the nodes listen on. Defaults to '127.0.0.1'.
+            max_idle (int, optional): How many stopped processes are kept for reuse. Defaults to 3.
+            startup_timeout (float, optional): Seconds a node may take to accept connections.
+                Defaults to 30.
+            server (str, optional): 'wsgi' serves the nodes with threads, 'asgi' with asyncio.
+                Defaults to 'wsgi'.
+            register_token (Callable[[str], str], optional): Issues the registration token
+                of a node out of its URL. Defaults to None, then the nodes do not register.
+        """
+        self.lease_token = lease_token
+        self.register_token = register_token
+        self.directory_url = directory_url
+        self.node_dir = os.path.abspath(node_dir or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), '..',
+            'IntermediateNode'))
+        self.host = host
+        self.max_idle = max(0, max_idle)
+        self.startup_timeout = startup_timeout
+        self.server = server
+        self.started = 0
+        self.reused = 0
+        self._nodes = {}  # node id -> (process, port, working directory)
+        self._idle = []  # (process, port, working directory)
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _free_port(self):
+        with socket.socket() as sock:
+            sock.bind((self.host, 0))
+            return sock.getsockname()[1]
+
+    def _command(self, port):
+        if self.server == 'asgi':
+            return [
+                sys.executable, '-m', 'uvicorn', 'asgi:app', '--host',
+                self.host, '--port',
+                str(port), '--app-dir', self.node_dir
+            ]
+        if importlib.util.find_spec('gunicorn'):
+            return [
+                sys.executable, '-m', 'gunicorn', '--bind',
+                f'{self.host}:{port}', '--workers', '1', '--threads', '8',
+                '--timeout', '0', '--pythonpath', self.node_dir, 'main:app'
+            ]
+        return [
+            sys.executable, '-m', 'flask', 'run', '--host', self.host,
+            '--port',
+            str(port), '--with-threads', '--no-reload'
+        ]
+
+    def _start(self):
+        port = self._free_port()
+        url = f'http://{self.host}:{port}'
+        workdir = tempfile.mkdtemp(prefix='onion-node-')
+        env = dict(os.environ,
+                   PORT=str(port),
+                   THIS_NODE=url,
+                   DIRECTORY_NODE=self.directory_url,
+                   LEASE_TOKEN=self.lease_token,
+                   FLASK_APP='main',
+                   PYTHONPATH=self.node_dir,
+                   PYTHONUNBUFFERED='1')
+        for name in ('PUBLIC_KEY', 'TRACKING_ID', 'REGISTER_TOKEN'):
+            env.pop(name, None)
+        if self.register_token:
+            env['REGISTER_TOKEN'] = self.register_token(url)
+        process = subprocess.Popen(self._command(port), cwd=workdir, env=env)
+        self.started += 1
+        return process, port, workdir
+
+    def _wait_ready(self, process, port):
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f'Node on port {port} exited with {process.returncode}')
+            try:
+                with socket.create_connection((self.host, port), timeout=1):
+                    return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        f'Node on port {port} did not start within {self.startup_timeout}s'
+                    )
+                time.sleep(0.05)
+
+    def _terminate(self, node):
+        process, _, workdir = node
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    def deploy(self, node_ids):
+        nodes = []
+        try:
+            for _ in node_ids:
+                with self._lock:
+                    node = None
+                    while self._idle and node is None:
+                        node = self._idle.pop()
+                        if node[0].poll() is not None:
+                            shutil.rmtree(node[2], ignore_errors=True)
+                            node = None
+                if node is None:
+                    node = self._start()
+                else:
+                    self.reused += 1
+                nodes.append(node)
+            for process, port, _ in nodes:
+                self._wait_ready(process, port)
+        except Exception:
+            for node in nodes:
+                self._terminate(node)
+            raise
+        with self._lock:
+            self._nodes.update(zip(node_ids, nodes))
+        return [f'http://{self.host}:{port}' for _, port, _ in nodes]
+
+    def stop(self, node_ids):
+        to_terminate = []
+        with self._lock:
+            for node_id in node_ids:
+                node = self._nodes.pop(node_id, None)
+                if node is None:
+                    continue
+                if len(self._idle) < self.max_idle and node[0].poll() is None:
+                    self._idle.append(node)
+                else:
+                    to_terminate.append(node)
+        for node in to_terminate:
+            self._terminate(node)
+
+    def close(self):
+        """Terminate all node processes."""
+        with self._lock:
+            nodes = list(self._nodes.values()) + self._idle
+            self._nodes, self._idle = {}, []
+        for node in nodes:
+            self._terminate(node)
+
+    def stats(self):
+        with self._lock:
+            running, idle = len(self._nodes), len(self._idle)
+        return {
+            'backend': self.name,
+            'running': running,
+            'idle': idle,
+            'started': self.started,
+            'reused': self.reused
+        }
@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import pkcs1_15
+
+
+def canonical(document):
+    """Return the bytes a document is signed over, which leaves out its signature.
+
+    Args:
+        document (dict): The document.
+
+    Returns:
+        bytes: The sorted, compact JSON of the document.
+    """
+    return json.dumps({
+        key: value
+        for key, value in document.items() if key != 'signature'
+    },
+                      sort_keys=True,
+                      separators=(',', ':')).encode()
+
+
+class KeyDirectory:
+    """The public keys the nodes registered, published as signed documents.
+
+    The nodes register their current public key on startup and after every
+    key rotation, so that clients get the keys together with their route
+    instead of asking every node. Documents are signed with the RSA key of
+    this directory node (see `canonical`), the signature of the last key
+    document is reused as long as its content does not change.
+    """
+
+    def __init__(self, signing_key=None, max_size=4096):
+        """
+        Args:
+            signing_key (str, optional): PEM encoded private RSA key, a new one is generated if None.
+                Defaults to None.
+            max_size (int, optional): Maximum number of registered nodes, the least
+                recently registered is dropped first. Defaults to 4096.
+        """
+        self.signing_key = RSA.import_key(
+            signing_key) if signing_key else RSA.generate(2048)
+        self.max_size = max(1, max_size)
+        self.registrations = 0
+        self.signatures = 0
+        self._keys = OrderedDict()  # node URL -> PEM encoded public key
+        self._document = (None, None, None)  # payload, etag, signed body
+        self._lock = threading.Lock()
+
+    def public_key(self):
+        """Return the public key clients verify the documents with.
+
+        Returns:
+            bytes: The PEM encoded public key.
+        """
+        return self.signing_key.publickey().export_key()
+
+    def register(self, url, public_key):
+        """Store the current public key of a node.
+
+        Args:
+            url (str): The node URL.
+            public_key (str): The PEM encoded RSA or X25519 public key.
+        """
+        try:  # Reject anything which is not a key
+            RSA.import_key(public_key)
+        except ValueError:
+            ECC.import_key(public_key)
+        with self._lock:
+            self._keys[url] = public_key
+            self._keys.move_to_end(url)
+            self.registrations += 1
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def keys(self, urls):
+        """Return the registered keys of some nodes.
+
+        Args:
+            urls (List[str]): The node URLs.
+
+        Returns:
+            dict: Node URL -> PEM encoded public key, nodes without a key are left out.
+        """
+        with self._lock:
+            return {url: self._keys[url] for url in urls if url in self._keys}
+
+    def sign(self, document):
+        """Add the signature to a document.
+
+        Args:
+            document (dict): The document.
+
+        Returns:
+            dict: The document with its base64 encoded 'signature'.
+        """
+        signature = pkcs1_15.new(self.signing_key).sign(
+            SHA256.new(canonical(document)))
+        self.signatures += 1
+        return dict(document,
+                    signature=base64.b64encode(signature).decode())
+
+    def document(self, urls):
+        """Return the signed key document of the given nodes.
+
+        Args:
+            urls (Iterable[str]): The URLs of the nodes to publish.
+
+        Returns:
+            bytes, str: The JSON body of the document and its ETag.
+        """
+        document = {'nodes': self.keys(sorted(urls))}
+        payload = canonical(document)
+        with self._lock:
+            last_payload, etag, body = self._document
+        if payload != last_payload:
+            document['published'] = int(time.time())
+            body = json.dumps(self.sign(document)).encode()
+            etag = hashlib.sha256(payload).hexdigest()[:32]
+            with self._lock:
+                self._document = (payload, etag, body)
+        return body, etag
+
+    def stats(self):
+        """Return the directory counters.
+
+        Returns:
+            dict: Registered nodes, registrations and signatures.
+        """
+        return {
+            'size': len(self._keys),
+            'registrations': self.registrations,
+            'signatures': self.signatures
+        }
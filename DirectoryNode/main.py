@@ -1,132 +1,202 @@
 #!/usr/bin/env python3
-import asyncio
+import hashlib
+import hmac
 import json
 import os
-import random
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, g, jsonify, request
 from flask_cors import CORS, cross_origin
 
+from deployment import GCloudBackend, LocalBackend
+from key_directory import KeyDirectory
+from metrics import CONTENT_TYPE, Metrics
+from node_ids import NodeIdAllocator
+from node_pool import NodePool
+from routes import RouteStore
+
 app = Flask(__name__)
 
 cors = CORS(app)
 app.config['CORS_HEADER'] = 'Content-Type'
 
-routes = {}
+# Served by /metrics, every thread records into its own shard
+metrics = Metrics()
+REQUEST_SECONDS = metrics.histogram('onion_directory_request_seconds',
+                                    'Seconds per request, by endpoint')
+STAGE_SECONDS = metrics.histogram(
+    'onion_directory_stage_seconds',
+    'Seconds per stage of a route: lease, sign, notify and release')
+IN_FLIGHT = metrics.gauge('onion_directory_in_flight',
+                          'Requests being handled')
+BYTES = metrics.counter(
+    'onion_directory_bytes_total',
+    'Bytes of the request bodies (in) and the response bodies (out), by endpoint'
+)
+ERRORS = metrics.counter('onion_directory_errors_total',
+                         'Failed requests by endpoint and exception type')
+CHECKS_REJECTED = metrics.counter(
+    'onion_directory_checks_rejected_total',
+    'Checks answered with 503 because all CHECK_THREADS were waiting')
+
+# Releases the nodes of dropped routes, off the request which dropped them
+release_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('RELEASE_THREADS', 4)),
+    thread_name_prefix='release')
+# Routes which are not checked by their client release their nodes on expiry
+routes = RouteStore(int(os.getenv('ROUTE_STORE_SIZE', 4096)),
+                    float(os.getenv('ROUTE_TTL', 600)),
+                    on_drop=lambda tracking_id, nodes: release_executor.submit(
+                        release_dropped, nodes, tracking_id))
+CHECK_TIMEOUT = float(os.getenv('CHECK_TIMEOUT', 5))
+CHECK_MAX_TIMEOUT = float(os.getenv('CHECK_MAX_TIMEOUT', 60))
+# Threads /check and /check/stream may hold while they wait for the nodes.
+# Has to stay below the threads of the server, the rest is kept free for the
+# notifications which end the waits, /route and /register
+CHECK_THREADS = int(os.getenv('CHECK_THREADS', 8))
+check_slots = threading.BoundedSemaphore(max(1, CHECK_THREADS))
+# Shared secret of the nodes for /lease and /release
+LEASE_TOKEN = os.getenv('LEASE_TOKEN') or uuid4().hex
+# Secret the registration tokens of the nodes are derived from, never leaves this directory node
+REGISTER_SECRET = os.getenv('REGISTER_SECRET') or uuid4().hex
+# 'gcloud' or 'local', see `create_backend`
+DEPLOYMENT_BACKEND = os.getenv('DEPLOYMENT_BACKEND', 'gcloud')
+# Key the route and key documents are signed with. Clients can only pin a key
+# which survives restarts (DIRECTORY_KEY), so a random one is for local runs only
+SIGNING_KEY = os.getenv('SIGNING_KEY')
+if not SIGNING_KEY and DEPLOYMENT_BACKEND != 'local':
+    raise ValueError(
+        'SIGNING_KEY has to be set unless DEPLOYMENT_BACKEND is local, '
+        'clients pin its public key as DIRECTORY_KEY')
+# Public keys registered by the nodes, handed out with the routes
+key_directory = KeyDirectory(SIGNING_KEY,
+                             int(os.getenv('KEY_DIRECTORY_SIZE', 4096)))
+KEY_DOCUMENT_MAX_AGE = int(os.getenv('KEY_DOCUMENT_MAX_AGE', 10))
+
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+@app.after_request
+def count_bytes(response):
+    endpoint = request.endpoint or 'unknown'
+    BYTES.inc(request.content_length or 0, direction='in', endpoint=endpoint)
+    if response.content_length is not None:  # Not known for streams
+        BYTES.inc(response.content_length,
+                  direction='out',
+                  endpoint=endpoint)
+    return response
+
+
+@app.teardown_request
+def finish_request(error):
+    if 'start' not in g:
+        return
+    endpoint = request.endpoint or 'unknown'
+    IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    if error is not None:
+        ERRORS.inc(endpoint=endpoint, type=type(error).__name__)
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Get the metrics of this directory node in the Prometheus text format."""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
 
 
 @app.route('/')
 def index():
     """Show information for logging purposes."""
-    return jsonify({'routes': routes})
+    return jsonify({
+        'routes': routes.snapshot(),
+        'route_store': routes.stats(),
+        'pool': node_pool.stats(),
+        'node_ids': node_ids.stats(),
+        'deployment': backend.stats(),
+        'key_directory': key_directory.stats()
+    })
+
+
+@app.route('/pool')
+def pool():
+    """Show the node pool counters."""
+    return jsonify(node_pool.stats())
 
 
 # ----------------
-# Get the route and instantiate the gcloud container
+# Get the route and instantiate the nodes
 # ----------------
 
 
-async def run(cmd, name='', ret=None, p_stdout=False, p_stderr=True):
-    """ Run the command asynchronously in the shell.
+def register_token(node_address):
+    """Return the token a node registers its public keys with.
+    Every node is deployed with the token of its own URL, so it cannot
+    register a key for another node.
 
     Args:
-        cmd (str): The command to execute.
-        name (str, optional): An output name for logging. Defaults to ''.
-        ret (str, optional): If not None, which output should be returned. Defaults to None.
-        p_stdout (bool, optional): Print stdout. Defaults to False.
-        p_stderr (bool, optional): Print stderr. Defaults to True.
+        node_address (str): The URL of the node.
 
     Returns:
-        _type_: _description_
+        str: The token.
     """
-    proc = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-
-    stdout, stderr = await proc.communicate()
-    print(f'[{name if name else cmd!r} -> {proc.returncode}]')
-    if p_stdout and stdout:
-        print(f'[stdout]\n{stdout.decode()}')
-    if ret == 'stdout' and stdout:
-        return stdout.decode()
-    if p_stderr and stderr:
-        print(f'[stderr]\n{stderr.decode()}')
-    if ret == 'stderr' and stderr:
-        return stderr.decode()
-    if ret:
-        return 'No output.'
-
-
-async def stop_nodes(node_ids):
-    """Shut down the nodes GCloud services with the given names.
-    Shutdown call happens asynchronously.
-    
-    Args:
-        node_ids (List[str]): The node ids to shut down. 3 overall.
-    """
-    cmd = "gcloud run services delete node-{node_id} -q --region europe-west3"
-
-    await asyncio.gather(
-        run(cmd.format(node_id=node_ids[0]), f'stop node-{node_ids[0]}'),
-        run(cmd.format(node_id=node_ids[1]), f'stop node-{node_ids[1]}'),
-        run(cmd.format(node_id=node_ids[2]), f'stop node-{node_ids[2]}'))
+    return hmac.new(REGISTER_SECRET.encode(), node_address.encode(),
+                    hashlib.sha256).hexdigest()
 
 
-async def instantiate_nodes(public_key, directory_service_url,
-                            directory_repo_url, node_ids, tracking_id):
-    """Instantiates the nodes with the given node_ids by using the gcloud cli.
-    Are instantiates asynchronously to speed up the process.
+def create_backend(name):
+    """Create the deployment backend of the nodes.
 
     Args:
-        public_key (str): The public key of the client to pass on.
-        directory_service_url (str): This directory nodes URL to pass on.
-        directory_repo_url (str): The repository from which to pull the node images.
-        node_ids (List[str]): Node ids for the GCloud service name (e.g. node-014).
-        tracking_id (str): Unique tracking id of the route for notification service.
-    """
-    cmd = """\
-PUBLIC_KEY="{public_key}"
-DIRECTORY_NODE="{directory_service_url}"
-
-gcloud run deploy node-{idx} --region europe-west3 --allow-unauthenticated \
-    --image {directory_repo_url} \
-    --set-env-vars="PUBLIC_KEY=$PUBLIC_KEY" \
-    --set-env-vars="DIRECTORY_NODE=$DIRECTORY_NODE" \
-    --set-env-vars="THIS_NODE={node_url}" \
-    --set-env-vars="TRACKING_ID={tracking_id}"
+        name (str): 'gcloud' or 'local'.
+
+    Returns:
+        DeploymentBackend: The backend.
     """
-    await asyncio.gather(
-        run(
-            cmd.format(public_key=public_key,
-                       directory_service_url=directory_service_url,
-                       directory_repo_url=directory_repo_url,
-                       node_url=directory_service_url.replace(
-                           'directory', f'node-{node_ids[0]}'),
-                       idx=node_ids[0],
-                       tracking_id=tracking_id), f'deploy node-{node_ids[0]}'),
-        run(
-            cmd.format(public_key=public_key,
-                       directory_service_url=directory_service_url,
-                       directory_repo_url=directory_repo_url,
-                       node_url=directory_service_url.replace(
-                           'directory', f'node-{node_ids[1]}'),
-                       idx=node_ids[1],
-                       tracking_id=tracking_id), f'deploy node-{node_ids[1]}'),
-        run(
-            cmd.format(public_key=public_key,
-                       directory_service_url=directory_service_url,
-                       directory_repo_url=directory_repo_url,
-                       node_url=directory_service_url.replace(
-                           'directory', f'node-{node_ids[2]}'),
-                       idx=node_ids[2],
-                       tracking_id=tracking_id), f'deploy node-{node_ids[2]}'))
+    if name == 'gcloud':
+        return GCloudBackend(LEASE_TOKEN,
+                             os.getenv('GCLOUD_REGION', 'europe-west3'),
+                             directory_url=os.getenv('DIRECTORY_URL'),
+                             node_image=os.getenv('NODE_IMAGE'),
+                             refresh=float(
+                                 os.getenv('SERVICE_INFO_REFRESH', 3600)),
+                             server=os.getenv('NODE_SERVER', 'wsgi'),
+                             register_token=register_token)
+    if name == 'local':
+        return LocalBackend(
+            LEASE_TOKEN,
+            os.getenv('DIRECTORY_URL',
+                      f'http://127.0.0.1:{os.getenv("PORT", 8888)}'),
+            node_dir=os.getenv('LOCAL_NODE_DIR'),
+            max_idle=int(os.getenv('LOCAL_MAX_IDLE', 3)),
+            server=os.getenv('NODE_SERVER', 'wsgi'),
+            register_token=register_token)
+    raise ValueError(f'Unknown deployment backend {name}')
+
+
+backend = create_backend(DEPLOYMENT_BACKEND)
+NODE_ID_SPACE = int(os.getenv('NODE_ID_SPACE', 999))
+node_ids = NodeIdAllocator(NODE_ID_SPACE, max(3, len(str(NODE_ID_SPACE))))
+node_pool = NodePool(backend.deploy,
+                     backend.stop,
+                     node_ids,
+                     LEASE_TOKEN,
+                     size=int(os.getenv('NODE_POOL_SIZE', 3)),
+                     retry=float(os.getenv('NODE_POOL_RETRY', 30)),
+                     register=key_directory.register)
+node_pool.start()
 
 
 def generate_route(public_key, tracking_id):
-    """ Generates a route by passing the public key to each node
-    and instantiates them.
+    """ Generates a route by leasing three warm nodes out of the node pool
+    and passing the public key to each of them.
 
     Might throw an exception.
 
@@ -137,40 +207,47 @@ def generate_route(public_key, tracking_id):
     Returns:
         List[str]: A list of nodes with their URLs.
     """
-    cmd_get_service_url = 'gcloud run services describe directory --region europe-west3 --format=json'
-
-    # Get repo URL and URL of this node and remove the trailing new line
-    data_raw = asyncio.run(
-        run(cmd_get_service_url,
-            '',
-            ret='stdout',
-            p_stdout=False,
-            p_stderr=False))
-    data = json.loads(data_raw)
-    directory_service_url = data['status']['url']
-    directory_repo_url = data['spec']['template']['metadata']['annotations'][
-        'client.knative.dev/user-image']
-    directory_repo_url = directory_repo_url.replace('directory', 'node')
-
-    # Generate three random nodes that do not exist yet
-    existent_ids = [
-        int(node.split('-')[1]) for tracking in routes.keys()
-        for node in routes[tracking]
-    ]
-    ids = []
-    while len(ids) < 3:
-        v = random.randint(1, 99)
-        if v not in ids or v not in existent_ids:
-            ids.append(v)
-    node_ids = [f'{ids[0]:03d}', f'{ids[1]:03d}', f'{ids[2]:03d}']
-    asyncio.run(
-        instantiate_nodes(public_key, directory_service_url,
-                          directory_repo_url, node_ids, tracking_id))
-    node_urls = [
-        directory_service_url.replace('directory', f'node-{node_id}')
-        for node_id in node_ids
-    ]
-    return node_urls
+    with STAGE_SECONDS.time(stage='lease'):
+        return node_pool.lease(3, public_key, tracking_id)
+
+
+def release(nodes, tracking_id):
+    """Give the nodes of a route back to the node pool.
+
+    Args:
+        nodes (List[str]): The URLs of the nodes.
+        tracking_id (str): Unique tracking id of the route.
+    """
+    with STAGE_SECONDS.time(stage='release'):
+        node_pool.release(nodes, tracking_id)
+
+
+def release_dropped(nodes, tracking_id):
+    """Give the nodes of a route which expired or was evicted back to the node pool.
+    Runs in the `release_executor`, so errors are only logged.
+
+    Args:
+        nodes (List[str]): The URLs of the nodes.
+        tracking_id (str): Unique tracking id of the route.
+    """
+    try:
+        release(nodes, tracking_id)
+    except Exception as e:
+        traceback.print_exc()
+        ERRORS.inc(endpoint='release_dropped', type=type(e).__name__)
+
+
+def release_route(tracking_id):
+    """Drop a checked route and give its nodes back to the node pool.
+    A route which was dropped in the meantime, by another check or because
+    it expired, already had its nodes released.
+
+    Args:
+        tracking_id (str): Unique tracking id of the route.
+    """
+    route = routes.remove(tracking_id)
+    if route is not None:
+        release(list(route.hops), tracking_id)
 
 
 @app.route('/route', methods=['POST'])
@@ -178,8 +255,12 @@ def get_route():
     """Get a random route of registered nodes.
     Does not affect any data at the directory node
 
+    The response is a document signed by this directory node (see `/signing-key`)
+    which also holds the public keys the nodes of the route registered,
+    so the client does not have to ask the nodes for them.
+
     Returns:
-        json: A route of three nodes in random order.
+        json: A route of three nodes in random order, their keys and the signature.
     """
     print(request.get_data())
     try:
@@ -189,95 +270,321 @@ def get_route():
                 {'error': 'public_key has to be send to get a route.'}), 400
     except Exception as e:
         traceback.print_exc()
+        ERRORS.inc(endpoint='get_route', type=type(e).__name__)
         return jsonify({'error': str(e)}), 400
 
     tracking_id = uuid4().hex
     try:
         route = generate_route(request.json['public_key'], tracking_id)
-        globals()['routes'][tracking_id] = {node: 2 for node in route}
-        return jsonify({'tracking_id': tracking_id, 'route': route})
+        routes.add(tracking_id, route)
+        with STAGE_SECONDS.time(stage='sign'):
+            document = key_directory.sign({
+                'tracking_id': tracking_id,
+                'route': route,
+                'keys': key_directory.keys(route)
+            })
+        return jsonify(document)
     except Exception as e:
         traceback.print_exc()
+        ERRORS.inc(endpoint='get_route', type=type(e).__name__)
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/register', methods=['POST'])
+def register():
+    """Store the current public key of a node.
+    Gets called by the nodes on startup and after every key rotation.
+
+    Expects a POST request with the registration token of the node (see `register_token`)
+    as bearer token and json data:
+    {'node_address': url_of_the_node, 'public_key': public_key_of_the_node}
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('node_address'),
+                      str) or not data.get('public_key'):
+        return jsonify(
+            {'error': 'node_address and public_key have to be sent'}), 400
+    if not hmac.compare_digest(
+            request.headers.get('Authorization', ''),
+            f'Bearer {register_token(data["node_address"])}'):
+        return jsonify({'error': 'Not authorized'}), 403
+    try:
+        key_directory.register(data['node_address'], data['public_key'])
+    except ValueError as e:
         return jsonify({'error': str(e)}), 400
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/keys', methods=['GET'])
+def keys():
+    """Get the signed document of the public keys of all ready and leased nodes.
+    Answers 304 if the ETag sent as If-None-Match is still current.
+    """
+    body, etag = key_directory.document(node_pool.urls())
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.max_age = KEY_DOCUMENT_MAX_AGE
+    return response.make_conditional(request)
+
+
+@app.route('/signing-key', methods=['GET'])
+def signing_key():
+    """Get the public key the route and key documents are signed with."""
+    return Response(key_directory.public_key(), mimetype='text/plain')
+
+
+def apply_notification(notification):
+    """Apply a single node notification to its route in the route store.
+
+    Args:
+        notification (dict): {'status': 'success/error msg', 'node_address': node_url, 'tracking_id': unique_id_of_route}
+
+    Returns:
+        bool: False if the notification is malformed.
+    """
+    if (not notification or not 'status' in notification
+            or not 'node_address' in notification
+            or not 'tracking_id' in notification):
+        error = 'No json found in request'
+        if notification:
+            error = notification
+        print(f'[ERROR] Node error in request /notify: {error}')
+        return False
+    tracking_id = notification['tracking_id']
+    node_address = notification['node_address']
+    route = routes.get(tracking_id)
+    if route is None:
+        print(f'[ERROR] Node error at /notify: Unknown route {tracking_id}')
+        return True
+    try:
+        with route.condition:
+            if notification['status'] == 'success':
+                if isinstance(route.hops[node_address], int):  # Not failed yet
+                    route.hops[node_address] -= 1
+            else:
+                route.hops[node_address] = notification['status']
+            route.condition.notify_all()
+    except Exception as e:
+        traceback.print_exc()
+        print(f'[ERROR] Node error at /notify: {str(e)}')
+    return True
 
 
 @app.route('/notify', methods=['POST'])
 def notify():
     """
     Gets called by the node which notify their status: Success or failure.
-    Updates the global existing routes dict so that the client can then
+    Updates the route in the route store so that the client can then
     ask for failures in the node sending process.
 
     Expects a POST request with json data:
     {'status': 'success/error msg', 'node_address': node_url, 'tracking_id': unique_id_of_route}
     """
-    if (not request.json or not 'status' in request.json
-            or not 'node_address' in request.json
-            or not 'tracking_id' in request.json):
-        error = 'No json found in request'
-        if request.json:
-            error = request.json
-        print(f'[ERROR] Node error in request /notify: {error}')
+    with STAGE_SECONDS.time(stage='notify'):
+        applied = apply_notification(request.json)
+    if not applied:
         abort(400)
-    tracking_id = request.json['tracking_id']
-    node_address = request.json['node_address']
-    try:
-        if request.json['status'] == 'success':
-            globals()['routes'][tracking_id][node_address] -= 1
-        else:
-            globals(
-            )['routes'][tracking_id][node_address] = request.json['status']
-    except Exception as e:
-        traceback.print_exc()
-        print(f'[ERROR] Node error at /notify: {str(e)}')
     return jsonify({'success': True})
 
 
+@app.route('/notify/batch', methods=['POST'])
+def notify_batch():
+    """
+    Gets called by the nodes with all notifications that piled up since their last call.
+    Malformed notifications are skipped so that they do not discard the rest of the batch.
+
+    Expects a POST request with json data:
+    {'notifications': [{'status': ..., 'node_address': ..., 'tracking_id': ...}, ...]}
+    """
+    if not request.json or not isinstance(request.json.get('notifications'),
+                                          list):
+        abort(400)
+    applied = 0
+    for notification in request.json['notifications']:
+        with STAGE_SECONDS.time(stage='notify'):
+            applied += apply_notification(notification)
+    return jsonify({
+        'success': True,
+        'applied': applied,
+        'skipped': len(request.json['notifications']) - applied
+    })
+
+
+def route_status(route):
+    """Return the final status of a route, if there is one yet.
+
+    Args:
+        route (Route): The route.
+
+    Returns:
+        dict|None: {'error': ...} if a node failed, {'status': 'success'}
+            if all nodes are done, otherwise None.
+    """
+    values = route.hops
+    for key in values:
+        if type(values[key]) == str:
+            return {'error': f'Error at {key}: {values[key]}'}
+    if all(value <= 0 for value in values.values()):
+        return {'status': 'success'}
+    return None
+
+
+def check_deadline(timeout):
+    """Return the point in time until which a check waits for its route.
+
+    Args:
+        timeout (str|float|None): Seconds asked for by the client,
+            CHECK_TIMEOUT if not set. Capped at CHECK_MAX_TIMEOUT.
+
+    Returns:
+        float: The deadline in `time.monotonic` seconds.
+    """
+    try:
+        timeout = CHECK_TIMEOUT if timeout is None else float(timeout)
+    except (TypeError, ValueError):
+        timeout = CHECK_TIMEOUT
+    return time.monotonic() + min(max(0.0, timeout), CHECK_MAX_TIMEOUT)
+
+
+def too_many_checks():
+    """Answer a check which would have to wait for a free check thread.
+    The route is kept, so the client can check it again.
+
+    Returns:
+        Response: 503 with a Retry-After header.
+    """
+    CHECKS_REJECTED.inc(endpoint=request.endpoint)
+    response = jsonify(
+        {'error': 'Too many checks at once, try again in a second'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
 @app.route('/check', methods=['POST'])
 @cross_origin()
 def check():
     """
     Gets called by the client to check for any errors that might have
     appeared in the node sending process.
+    Waits until all nodes are done, one of them failed or the deadline passed.
+    The request sleeps in between and is woken up by the notifications of the nodes.
+    At most CHECK_THREADS checks wait at once, further ones are answered with 503.
 
     Expects a POST request with json data:
-    {'tracking_id': unique_id_of_route}
+    {'tracking_id': unique_id_of_route, 'timeout': seconds (optional)}
     """
     if not request.json or not 'tracking_id' in request.json:
         return jsonify(
             {'error':
              'tracking_id has to be send to identify the route.'}), 400
-    if not request.json['tracking_id'] in globals()['routes']:
+    tracking_id = request.json['tracking_id']
+    route = routes.get(tracking_id)
+    if route is None:
         return jsonify({
             'error':
-            f'The given tracking_id is not valid anymore.\nAsked for {request.json["tracking_id"]}'
+            f'The given tracking_id is not valid anymore.\nAsked for {tracking_id}'
         }), 400
-    response = {}
-    num_iterations = 1000
-    for idx in range(num_iterations):
-        values = globals()['routes'][request.json['tracking_id']]
-        num_correct = 0
-        for key in values:
-            if type(values[key]) == str:
-                response = {'error': f'Error at {key}: {values[key]}'}
-                break
-            elif values[key] <= 0:
-                num_correct += 1
-                if num_correct == 3:
-                    response = {'status': 'success'}
-                    break
-            elif idx == num_iterations - 1:
-                response = {'error': 'Timeout'}
-                break
-        time.sleep(0.001)
-    node_ids = [
-        adr[adr.find('node-') + 5:adr.find('node-') + 8]
-        for adr in globals()['routes'][request.json['tracking_id']]
-    ]
-    print(f'Stopping nodes:\n' + '\n'.join(node_ids))
-    asyncio.run(stop_nodes(node_ids))
+    if not check_slots.acquire(blocking=False):
+        return too_many_checks()
+    try:
+        deadline = check_deadline(request.json.get('timeout'))
+        with route.condition:
+            route.condition.wait_for(lambda: route_status(route) is not None,
+                                     timeout=deadline - time.monotonic())
+            response = route_status(route) or {'error': 'Timeout'}
+    finally:
+        check_slots.release()
+    release_route(tracking_id)
     return jsonify(response)
 
 
+@app.route('/check/stream', methods=['GET'])
+@cross_origin()
+def check_stream():
+    """
+    Server-Sent-Events variant of /check for clients that want to follow every hop.
+    Sends a `hop` event whenever a node notifies and a final `done` event
+    with the same content as the response of /check.
+    Shares the CHECK_THREADS with /check.
+
+    Expects the query parameters:
+    ?tracking_id=unique_id_of_route&timeout=seconds (optional)
+    """
+    tracking_id = request.args.get('tracking_id')
+    route = routes.get(tracking_id)
+    if route is None:
+        return jsonify({
+            'error':
+            f'The given tracking_id is not valid anymore.\nAsked for {tracking_id}'
+        }), 400
+    if not check_slots.acquire(blocking=False):
+        return too_many_checks()
+    deadline = check_deadline(request.args.get('timeout'))
+
+    def event(name, data):
+        return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+    def generate():
+        sent = {}
+        try:
+            while True:
+                with route.condition:
+                    route.condition.wait_for(
+                        lambda: route.hops != sent,
+                        timeout=deadline - time.monotonic())
+                    values = dict(route.hops)
+                    status = route_status(route)
+                for node, value in values.items():
+                    if sent.get(node) != value:
+                        yield event(
+                            'hop', {'node': node, 'error': value}
+                            if type(value) == str else {
+                                'node': node,
+                                'remaining': max(0, value)
+                            })
+                sent = values
+                if status is None and time.monotonic() >= deadline:
+                    status = {'error': 'Timeout'}
+                if status is not None:
+                    yield event('done', status)
+                    return
+        finally:
+            release_route(tracking_id)
+
+    response = Response(generate(),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    # Also called if the stream is closed before it started
+    response.call_on_close(check_slots.release)
+    return response
+
+
+"""Notes:
+Optional environment variables are
+PORT: The port this directory node is running on (default 8888)
+LEASE_TOKEN: Shared secret the nodes are deployed with to accept /lease and /release (default random per start)
+REGISTER_SECRET: Secret the registration token every node is deployed with is derived from, see /register (default random per start)
+DEPLOYMENT_BACKEND: 'gcloud' deploys the nodes as Cloud Run services, 'local' runs them as local processes (default gcloud)
+GCLOUD_REGION: The Cloud Run region of the nodes (default europe-west3)
+DIRECTORY_URL: The URL of this directory node as passed on to the nodes (default looked up with gcloud, or http://127.0.0.1:PORT for the local backend)
+NODE_IMAGE: Only for the gcloud backend, the image of the nodes (default looked up with gcloud)
+SERVICE_INFO_REFRESH: Only for the gcloud backend, seconds after which the looked up URL and image are looked up again (default 3600)
+LOCAL_NODE_DIR: Only for the local backend, the directory of the node sources (default ../IntermediateNode)
+LOCAL_MAX_IDLE: Only for the local backend, how many stopped node processes are kept for reuse (default 3)
+CHECK_TIMEOUT: Seconds /check waits for the nodes of a route if the client does not ask for a timeout (default 5)
+CHECK_MAX_TIMEOUT: The longest timeout a client can ask /check for (default 60)
+CHECK_THREADS: How many /check and /check/stream requests wait at once, has to be lower than the threads of the server (default 8)
+ROUTE_STORE_SIZE: How many routes are remembered at once, the least recently used is dropped first (default 4096)
+ROUTE_TTL: Seconds after which an unused route is dropped and its nodes are released (default 600)
+RELEASE_THREADS: How many dropped routes release their nodes at once in the background (default 4)
+NODE_SERVER: 'wsgi' serves the nodes with threads (main.py), 'asgi' with asyncio (asgi.py) (default wsgi)
+NODE_ID_SPACE: How many node ids exist, which is the maximum number of nodes at once (default 999)
+NODE_POOL_SIZE: How many deployed nodes are kept ready for new routes (default 3)
+NODE_POOL_RETRY: Seconds to wait after a failed deployment of the node pool (default 30)
+SIGNING_KEY: PEM encoded private RSA key the route and key documents are signed with, required unless DEPLOYMENT_BACKEND is local (there default random per start)
+KEY_DIRECTORY_SIZE: How many registered node keys are kept at once (default 4096)
+KEY_DOCUMENT_MAX_AGE: Seconds clients may cache the key document of /keys (default 10)
+"""
 if __name__ == '__main__':
     app.run(debug=True, port=os.getenv('PORT', 8888), host='0.0.0.0')
@@ -0,0 +1,251 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histograms in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Every thread accumulates into its own shard, so recording a value takes
+    no lock and threads do not contend. The shards are only summed up when
+    the metrics are rendered, which is when `/metrics` is scraped. Shards of
+    finished threads are folded into a single one, so threads started per
+    request do not pile up.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # name -> (type, help, buckets)
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # Sum of the shards of finished threads
+        self._lock = threading.Lock()
+
+    def _register(self, kind, name, help, buckets=None):
+        with self._lock:
+            if name in self._metrics:
+                raise ValueError(f'The metric {name} already exists')
+            self._metrics[name] = (kind, help, buckets)
+
+    def counter(self, name, help):
+        """Create a counter which only goes up.
+
+        Args:
+            name (str): The metric name, should end with `_total`.
+            help (str): The description.
+
+        Returns:
+            Counter: The counter.
+        """
+        self._register('counter', name, help)
+        return Counter(self, name)
+
+    def gauge(self, name, help):
+        """Create a gauge which goes up and down.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description.
+
+        Returns:
+            Gauge: The gauge.
+        """
+        self._register('gauge', name, help)
+        return Gauge(self, name)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Create a histogram of observed values, such as durations.
+
+        Args:
+            name (str): The metric name, should end with the unit such as `_seconds`.
+            help (str): The description.
+            buckets (Tuple[float], optional): The sorted upper bounds of the buckets.
+                Defaults to DEFAULT_BUCKETS.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        self._register('histogram', name, help, tuple(buckets))
+        return Histogram(self, name, tuple(buckets))
+
+    def shard(self):
+        """Return the shard of the calling thread.
+
+        Returns:
+            dict: (metric name, labels) -> value, or bucket counts and sum of histograms.
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """Fold the shards of finished threads. Expects the lock to be held."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                merge(self._retired, shard)
+        self._shards = alive
+
+    def collect(self):
+        """Return the sum of all shards.
+
+        Returns:
+            dict: (metric name, labels) -> value, or bucket counts and sum of histograms.
+        """
+        with self._lock:
+            self._retire()
+            total = {}
+            merge(total, self._retired)
+            for _, shard in self._shards:
+                merge(total, shard.copy())
+        return total
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            str: The exposition, served with CONTENT_TYPE.
+        """
+        values = self.collect()
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        with self._lock:
+            metrics = list(self._metrics.items())
+        lines = []
+        for name, (kind, help, buckets) in metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name.get(name, [])):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                count = 0
+                for bound, bucket in zip(buckets + (float('inf'), ),
+                                         value[:-1]):
+                    count += bucket
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(
+                        f'{name}_bucket{format_labels(labels + (("le", le), ))} {count}'
+                    )
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    """A counter of `Metrics`, see `Metrics.counter`."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def inc(self, value=1, **labels):
+        """Add to the counter.
+
+        Args:
+            value (int|float, optional): The amount, must not be negative. Defaults to 1.
+            **labels (str): The label values.
+        """
+        shard = self.metrics.shard()
+        key = (self.name, tuple(sorted(labels.items())))
+        shard[key] = shard.get(key, 0) + value
+
+
+class Gauge(Counter):
+    """A gauge of `Metrics`, see `Metrics.gauge`.
+    Every thread keeps its own delta, so a gauge may go up in one thread
+    and down in another.
+    """
+
+    def dec(self, value=1, **labels):
+        """Subtract from the gauge.
+
+        Args:
+            value (int|float, optional): The amount. Defaults to 1.
+            **labels (str): The label values.
+        """
+        self.inc(-value, **labels)
+
+
+class Histogram:
+    """A histogram of `Metrics`, see `Metrics.histogram`."""
+
+    def __init__(self, metrics, name, buckets):
+        self.metrics = metrics
+        self.name = name
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        """Record a value.
+
+        Args:
+            value (float): The value, such as seconds.
+            **labels (str): The label values.
+        """
+        shard = self.metrics.shard()
+        key = (self.name, tuple(sorted(labels.items())))
+        counts = shard.get(key)
+        if counts is None:  # A count per bucket, +Inf and the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Record the seconds the block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+def merge(total, shard):
+    """Add the values of a shard to another one.
+
+    Args:
+        total (dict): Gets the values.
+        shard (dict): The values to add.
+    """
+    for key, value in shard.items():
+        if isinstance(value, list):
+            counts = total.get(key)
+            if counts is None:
+                total[key] = list(value)
+            else:
+                for i, count in enumerate(value):
+                    counts[i] += count
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def format_labels(labels):
+    """Format label pairs as `{name="value",...}`, escaped as the text format expects.
+
+    Args:
+        labels (Tuple[Tuple[str, str]]): The label names and values.
+
+    Returns:
+        str: The labels, empty without any.
+    """
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
@@ -0,0 +1,99 @@
+import bisect
+import random
+import threading
+
+
+class NodeIdAllocator:
+    """Hands out unique random node ids (e.g. '014' for the service node-014).
+
+    Only the ids in use are stored, in a sorted list. A random free id is
+    drawn by its rank among the free ids, which a binary search over the
+    list turns into the id. Allocating and releasing an id takes a binary
+    search and a list insertion or removal, and the memory only grows with
+    the ids in use, not with the size of the id space.
+    """
+
+    def __init__(self, size=999, width=3):
+        """
+        Args:
+            size (int, optional): Number of ids, they range from 1 to `size`. Defaults to 999.
+            width (int, optional): Minimal number of digits of an id. Defaults to 3.
+        """
+        self.size = max(1, size)
+        self.width = width
+        self._numbers = []  # Sorted numbers of the ids in use
+        self._allocated = set()
+        self._lock = threading.Lock()
+
+    def _format(self, number):
+        return f'{number:0{self.width}d}'
+
+    def allocate(self, count):
+        """Take random ids which are not in use.
+
+        Args:
+            count (int): Number of ids.
+
+        Returns:
+            List[str]: The node ids.
+        """
+        with self._lock:
+            free = self.size - len(self._numbers)
+            if count > free:
+                raise RuntimeError(
+                    f'Only {free} of {self.size} node ids are left')
+            ids = []
+            for _ in range(count):
+                rank = random.randrange(self.size - len(self._numbers))
+                # Count the ids in use below the free id of this rank, the
+                # id numbers[i] has numbers[i] - 1 - i free ids below it
+                low, high = 0, len(self._numbers)
+                while low < high:
+                    middle = (low + high) // 2
+                    if self._numbers[middle] - 1 - middle <= rank:
+                        low = middle + 1
+                    else:
+                        high = middle
+                number = rank + 1 + low
+                self._numbers.insert(low, number)
+                node_id = self._format(number)
+                self._allocated.add(node_id)
+                ids.append(node_id)
+            return ids
+
+    def release(self, node_ids):
+        """Give ids back. Ids which are not allocated are ignored.
+
+        Args:
+            node_ids (List[str]): The node ids.
+        """
+        with self._lock:
+            for node_id in node_ids:
+                if node_id not in self._allocated:
+                    continue
+                self._allocated.remove(node_id)
+                del self._numbers[bisect.bisect_left(self._numbers,
+                                                     int(node_id))]
+
+    def in_use(self, node_id):
+        """Check whether an id is allocated.
+
+        Args:
+            node_id (str): The node id.
+
+        Returns:
+            bool: Whether the id is in use.
+        """
+        return node_id in self._allocated
+
+    def stats(self):
+        """Return the allocator counters.
+
+        Returns:
+            dict: Size of the id space, allocated and free ids.
+        """
+        return {
+            'size': self.size,
+            'allocated': len(self._allocated),
+            'free': self.size - len(self._numbers)
+        }
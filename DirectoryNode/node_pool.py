@@ -0,0 +1,230 @@
+import threading
+import time
+import traceback
+
+import requests
+
+
+class NodePool:
+    """Pool of deployed and keyed nodes which are leased out to routes.
+
+    A background thread keeps `size` nodes deployed and ready. A route takes
+    its nodes out of the pool and hands them the public key of the client and
+    the tracking id via `/lease`. When the route is done the nodes are reset
+    via `/release` and put back into the pool, or stopped if the pool is full.
+    If the pool cannot serve a route, the missing nodes are deployed on the spot.
+    """
+
+    def __init__(self,
+                 deploy,
+                 stop,
+                 node_ids,
+                 token,
+                 size=3,
+                 retry=30.0,
+                 register=None):
+        """
+        Args:
+            deploy (Callable[[List[str]], List[str]]): Deploys the nodes with the given ids
+                and returns their URLs.
+            stop (Callable[[List[str]], None]): Stops the nodes with the given ids.
+            node_ids (NodeIdAllocator): Hands out the ids of new nodes.
+            token (str): The lease token the nodes are deployed with.
+            size (int, optional): Number of nodes kept ready. Defaults to 3.
+            retry (float, optional): Seconds to wait after a failed refill. Defaults to 30.
+            register (Callable[[str, str], None], optional): Gets the URL and the current
+                public key every leased node answers `/lease` with. Defaults to None.
+        """
+        self.deploy = deploy
+        self.stop = stop
+        self.node_ids = node_ids
+        self.token = token
+        self.size = max(0, size)
+        self.retry = retry
+        self.register = register
+        self.hits = 0
+        self.misses = 0
+        self.leases = 0
+        self.lease_seconds = 0.0
+        self.max_lease_seconds = 0.0
+        self._ready = []  # (node id, url)
+        self._leased = {}  # url -> (node id, tracking id)
+        self._deploying = 0
+        self._refill = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the background refill if it is not running yet."""
+        with self._lock:
+            if self.size and (self._worker is None
+                              or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._run,
+                                                name='node-pool',
+                                                daemon=True)
+                self._worker.start()
+        self._refill.set()
+
+    def _warm_up(self, url):
+        """Make sure the node is running and has a key pair."""
+        requests.get(url + '/get-public-key', timeout=60).raise_for_status()
+
+    def _deploy(self, count):
+        node_ids = self.node_ids.allocate(count)
+        try:
+            urls = self.deploy(node_ids)
+            for url in urls:
+                self._warm_up(url)
+            return list(zip(node_ids, urls))
+        except Exception:
+            try:
+                self._stop(node_ids)
+            except Exception:
+                traceback.print_exc()
+            raise
+
+    def _stop(self, node_ids):
+        try:
+            self.stop(node_ids)
+        finally:
+            self.node_ids.release(node_ids)
+
+    def _run(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            with self._lock:
+                missing = self.size - len(self._ready) - self._deploying
+                self._deploying += max(0, missing)
+            if missing <= 0:
+                continue
+            try:
+                nodes = self._deploy(missing)
+                with self._lock:
+                    self._ready.extend(nodes)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.retry)
+                self._refill.set()
+            finally:
+                with self._lock:
+                    self._deploying -= missing
+
+    def _post(self, url, path, json):
+        response = requests.post(url + path,
+                                 json=json,
+                                 headers={'Authorization': f'Bearer {self.token}'},
+                                 timeout=30)
+        response.raise_for_status()
+        return response
+
+    def lease(self, count, public_key, tracking_id):
+        """Lease nodes for a route and hand them the public key of the client.
+
+        Args:
+            count (int): Number of nodes.
+            public_key (str): The public key of the client.
+            tracking_id (str): Unique tracking id of the route.
+
+        Returns:
+            List[str]: The URLs of the nodes.
+        """
+        start = time.monotonic()
+        with self._lock:
+            nodes = self._ready[:count]
+            del self._ready[:count]
+        if len(nodes) == count:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                nodes += self._deploy(count - len(nodes))
+            except Exception:
+                with self._lock:  # Keep the nodes which are ready
+                    self._ready.extend(nodes)
+                raise
+        self._refill.set()
+        with self._lock:
+            self._leased.update(
+                {url: (node_id, tracking_id)
+                 for node_id, url in nodes})
+        urls = [url for _, url in nodes]
+        try:
+            for url in urls:
+                response = self._post(url, '/lease', {
+                    'public_key': public_key,
+                    'tracking_id': tracking_id
+                })
+                if self.register is not None:
+                    self.register(url, response.json()['public_key'])
+        except Exception:
+            self.release(urls, tracking_id)
+            raise
+        elapsed = time.monotonic() - start
+        self.leases += 1
+        self.lease_seconds += elapsed
+        self.max_lease_seconds = max(self.max_lease_seconds, elapsed)
+        return urls
+
+    def release(self, urls, tracking_id):
+        """Give the nodes of a route back to the pool.
+        Nodes which cannot be reset or do not fit into the pool are stopped.
+        Nodes which are not leased to the route anymore are left alone.
+
+        Args:
+            urls (List[str]): The URLs of the nodes.
+            tracking_id (str): Unique tracking id of the route.
+        """
+        to_stop = []
+        for url in urls:
+            with self._lock:
+                node_id, leased_to = self._leased.get(url, (None, None))
+                if leased_to != tracking_id:  # Already released
+                    continue
+                del self._leased[url]
+            try:
+                self._post(url, '/release', {})
+            except Exception:
+                traceback.print_exc()
+                to_stop.append(node_id)
+                continue
+            with self._lock:
+                if len(self._ready) < self.size:
+                    self._ready.append((node_id, url))
+                else:
+                    to_stop.append(node_id)
+        if to_stop:
+            print('Stopping nodes:\n' + '\n'.join(to_stop))
+            self._stop(to_stop)
+        self._refill.set()
+
+    def urls(self):
+        """Return the URLs of all ready and leased nodes.
+
+        Returns:
+            List[str]: The node URLs.
+        """
+        with self._lock:
+            return [url for _, url in self._ready] + list(self._leased)
+
+    def stats(self):
+        """Return the pool counters.
+
+        Returns:
+            dict: Pool size, ready, deploying and leased nodes, hit rate and lease latency.
+        """
+        with self._lock:
+            ready, deploying, leased = len(self._ready), self._deploying, len(
+                self._leased)
+        requests_total = self.hits + self.misses
+        return {
+            'size': self.size,
+            'ready': ready,
+            'deploying': deploying,
+            'leased': leased,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / requests_total, 4) if requests_total else 0.0,
+            'lease_seconds_avg': round(self.lease_seconds / self.leases, 4) if self.leases else 0.0,
+            'lease_seconds_max': round(self.max_lease_seconds, 4)
+        }
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Route:
+    """The nodes of a route and their progress.
+
+    Every node starts with 2 pending notifications and counts down on
+    'success', an error message replaces the count. The condition is
+    signalled on every change.
+    """
+
+    def __init__(self, nodes):
+        """
+        Args:
+            nodes (List[str]): The URLs of the nodes.
+        """
+        self.hops = {node: 2 for node in nodes}
+        self.condition = threading.Condition()
+
+
+class RouteStore:
+    """Bounded store of the routes handed out to clients.
+
+    Maps a tracking id to its Route. Entries expire after `ttl` seconds
+    without use and the least recently used route is evicted once
+    `max_size` routes are stored. The nodes of a dropped route are passed
+    to `on_drop` so that they are not leased forever if the client never
+    checks its route.
+    """
+
+    def __init__(self, max_size=4096, ttl=600.0, on_drop=None):
+        """
+        Args:
+            max_size (int, optional): Maximum number of routes. Defaults to 4096.
+            ttl (float, optional): Seconds a route is kept without use. Defaults to 600.
+            on_drop (Callable[[str, List[str]], None], optional): Gets the tracking id
+                and the node URLs of every expired or evicted route. Defaults to None.
+        """
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.on_drop = on_drop
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.removed = 0
+        self._routes = OrderedDict()  # tracking id -> [route, last used]
+        self._lock = threading.Lock()
+
+    def _expire(self, now, dropped):
+        """Drop expired routes, the oldest are first. Expects the lock to be held."""
+        while self._routes:
+            tracking_id, (route, last_used) = next(iter(self._routes.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._routes[tracking_id]
+            dropped.append((tracking_id, route))
+            self.expired += 1
+
+    def _drop(self, dropped):
+        if self.on_drop is None:
+            return
+        for tracking_id, route in dropped:
+            self.on_drop(tracking_id, list(route.hops))
+
+    def add(self, tracking_id, nodes):
+        """Store a new route.
+
+        Args:
+            tracking_id (str): Unique tracking id of the route.
+            nodes (List[str]): The URLs of the nodes.
+
+        Returns:
+            Route: The new route.
+        """
+        now = time.monotonic()
+        route = Route(nodes)
+        dropped = []
+        with self._lock:
+            self._expire(now, dropped)
+            self._routes[tracking_id] = [route, now]
+            self._routes.move_to_end(tracking_id)
+            self.created += 1
+            while len(self._routes) > self.max_size:
+                evicted_id, (evicted, _) = self._routes.popitem(last=False)
+                dropped.append((evicted_id, evicted))
+                self.evicted += 1
+        self._drop(dropped)
+        return route
+
+    def get(self, tracking_id):
+        """Return a route and refresh its expiry.
+
+        Args:
+            tracking_id (str): Unique tracking id of the route.
+
+        Returns:
+            Route|None: The route, None if unknown or expired.
+        """
+        now = time.monotonic()
+        dropped = []
+        with self._lock:
+            self._expire(now, dropped)
+            entry = self._routes.get(tracking_id)
+            if entry is not None:
+                entry[1] = now
+                self._routes.move_to_end(tracking_id)
+        self._drop(dropped)
+        return None if entry is None else entry[0]
+
+    def remove(self, tracking_id):
+        """Drop a route whose nodes the caller releases, `on_drop` is not called.
+
+        Args:
+            tracking_id (str): Unique tracking id of the route.
+
+        Returns:
+            Route|None: The route, None if it was already dropped.
+        """
+        with self._lock:
+            entry = self._routes.pop(tracking_id, None)
+            if entry is not None:
+                self.removed += 1
+        return None if entry is None else entry[0]
+
+    def snapshot(self):
+        """Return the progress of all routes for logging purposes.
+
+        Returns:
+            dict: tracking id -> {node URL: pending notifications or error}
+        """
+        with self._lock:
+            routes = [(tracking_id, entry[0])
+                      for tracking_id, entry in self._routes.items()]
+        return {tracking_id: dict(route.hops) for tracking_id, route in routes}
+
+    def stats(self):
+        """Return the store counters.
+
+        Returns:
+            dict: Size, created, expired, evicted and removed routes.
+        """
+        return {
+            'size': len(self._routes),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'removed': self.removed
+        }
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""Asynchronous (ASGI) serving mode of the node.
+
+Serves the same endpoints and wire protocol as `main.py`, which still holds
+the keys, circuits, lease and notifications of the node. The relays run on
+the event loop and wait for the next hop with a shared `aiohttp.ClientSession`,
+so a waiting relay does not hold a thread. The key and AES work runs in a
+thread pool to keep the event loop free.
+
+Run it with:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import aiohttp
+from starlette.applications import Starlette
+from starlette.responses import (HTMLResponse, JSONResponse,
+                                 PlainTextResponse, Response,
+                                 StreamingResponse)
+from starlette.background import BackgroundTask
+from starlette.routing import Route
+
+import main as node
+from metrics import CONTENT_TYPE
+from onion import (CHUNK_SIZE, COMPRESSION_NONE, MUX_DATA, MUX_END,
+                   MUX_ERROR, MUX_FRAME, MUX_MAGIC, STREAM_SIZE, STREAM_TYPE,
+                   AsyncChunkReader, Compressor, Decompressor, aiter_frames,
+                   aread_header, decode_mux_requests, encode_frame,
+                   encode_header, encode_mux_frame)
+
+# Threads of the key and AES work
+CRYPTO_THREADS = int(os.getenv('CRYPTO_THREADS', os.cpu_count() or 1))
+# Runs the key and AES work off the event loop
+crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_THREADS,
+                                 thread_name_prefix='crypto')
+# Connections to the next hops, created on startup
+client = None
+# A multiplexed stream fails once its service sends nothing for this long
+MUX_CLIENT_TIMEOUT = aiohttp.ClientTimeout(sock_connect=node.MUX_TIMEOUT,
+                                           sock_read=node.MUX_TIMEOUT)
+in_flight = 0
+max_in_flight = 0
+
+
+async def crypto(func, *args):
+    """Run `func(*args)` in the crypto thread pool.
+
+    Args:
+        func (Callable): The function.
+
+    Returns:
+        The result of the function.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        crypto_pool, func, *args)
+
+
+def error(stage, e):
+    """Count and report the error to the directory node and send it back.
+
+    Args:
+        stage (str): 'unwrap' or 'relay'.
+        e (Exception): The error.
+
+    Returns:
+        PlainTextResponse: The error response.
+    """
+    node.report_error(stage, e)
+    return PlainTextResponse(f'Error: {str(e)}')
+
+
+def wrap_response(response_key,
+                  circuit,
+                  content_mode,
+                  accept,
+                  content,
+                  content_type=None):
+    """Compress (only at the exit node) and encrypt the response of the next hop
+    (see `main.node`).
+
+    Args:
+        response_key (bytes|None): The backward AES key of the circuit.
+        circuit (bytes|None): The circuit id.
+        content_mode (int): The content mode of the request.
+        accept (int): The mask of the compressions the client accepts.
+        content (bytes): The response.
+        content_type (str, optional): The Content-Type of the response. Defaults to None.
+
+    Returns:
+        List[bytes]: The header and the encrypted content.
+    """
+    compression, content = node.compress_response(content, accept,
+                                                  content_type)
+    start = time.perf_counter()
+    key, cipher_aes, suite = node.response_cipher(response_key, content_mode)
+    response_content = cipher_aes.encrypt(content)
+    parts = [
+        encode_header(key, cipher_aes.nonce, b'none:0000',
+                      len(response_content), circuit, suite, cipher_aes.mode,
+                      compression), response_content
+    ]
+    node.STAGE_SECONDS.observe(time.perf_counter() - start, stage='encrypt')
+    return parts
+
+
+async def iterate(parts):
+    for part in parts:
+        yield part
+
+
+async def fetch_stream(stream_id, method, url, body, frames):
+    """Send the request of a multiplexed stream, see `main.fetch_stream`.
+
+    Args:
+        stream_id (int): The stream id.
+        method (str): The HTTP method.
+        url (str): The service URL.
+        body (bytes): The request body.
+        frames (asyncio.Queue): Gets the encoded frames, the last one is MUX_END or MUX_ERROR.
+    """
+    try:
+        async with client.request(method,
+                                  url,
+                                  data=body or None,
+                                  timeout=MUX_CLIENT_TIMEOUT) as response:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if chunk:
+                    await frames.put(encode_mux_frame(stream_id, chunk))
+        await frames.put(encode_mux_frame(stream_id, flags=MUX_END))
+    except Exception as e:
+        node.ERRORS.inc(stage='stream', type=type(e).__name__)
+        await frames.put(
+            encode_mux_frame(stream_id, str(e).encode(), MUX_ERROR))
+
+
+async def serve_streams(content):
+    """Send all requests of multiplexed content at once and yield their
+    response frames in the order they arrive, see `main.serve_streams`.
+
+    Args:
+        content (bytes): The innermost content, starting with MUX_MAGIC.
+
+    Yields:
+        bytes: MUX_MAGIC and the response frames, the last one ends the content.
+    """
+    requests = decode_mux_requests(content)
+    frames = asyncio.Queue()
+    tasks = [
+        asyncio.create_task(fetch_stream(stream_id, *request, frames))
+        for stream_id, request in requests.items()
+    ]
+    try:
+        yield MUX_MAGIC
+        open_streams = set(requests)
+        while open_streams:
+            try:
+                frame = await asyncio.wait_for(frames.get(), node.MUX_TIMEOUT)
+            except asyncio.TimeoutError:
+                node.ERRORS.inc(stage='stream', type='Timeout')
+                for stream_id in sorted(open_streams):
+                    yield encode_mux_frame(
+                        stream_id,
+                        f'No response within {node.MUX_TIMEOUT}s'.encode(),
+                        MUX_ERROR)
+                break
+            stream_id, flags, _ = MUX_FRAME.unpack_from(frame)
+            if flags != MUX_DATA:  # The stream is done
+                open_streams.discard(stream_id)
+            yield frame
+        yield encode_mux_frame(0, flags=MUX_END)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def relay(request):
+    """Unwrap the package, pass it on to the next hop and wrap the response.
+    Same as `main.node`.
+    """
+    global in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    start = time.perf_counter()
+    mode = 'stream' if request.headers.get(
+        'content-type', '').split(';')[0].strip() == STREAM_TYPE else 'package'
+    node.IN_FLIGHT.inc(mode=mode)
+    try:
+        if mode == 'stream':
+            response = await relay_stream(request)
+        else:
+            response = await relay_buffered(request)
+    except BaseException:
+        node.finish(start, mode)
+        raise
+    finally:
+        in_flight -= 1
+
+    async def finish():
+        node.finish(start, mode)
+
+    response.background = BackgroundTask(finish)
+    return response
+
+
+async def relay_buffered(request):
+    # Unpack the received data
+    try:
+        data = await request.body()
+        node.BYTES.inc(len(data), direction='in')
+        (next_host, content, response_key, circuit, content_mode,
+         accept) = await crypto(node.parse_package, data)
+    except Exception as e:
+        return error('unwrap', e)
+    # Notify on parsing
+    node.report('success')
+
+    # Make next connection
+    try:
+        start = time.perf_counter()
+        content_type = None
+        if content.startswith(MUX_MAGIC):  # Last hop of multiplexed streams
+            upstream_content = b''.join(
+                [frame async for frame in serve_streams(content)])
+        else:
+            if b'GET ' in content:  # Last hop
+                upstream = client.get(next_host)
+            else:  # Intermediate hop
+                upstream = client.post(
+                    next_host,
+                    data=content,
+                    headers={'Content-Type': 'application/x-binary'})
+            async with upstream as upstream_response:
+                upstream_content = await upstream_response.read()
+                content_type = upstream_response.headers.get('Content-Type')
+        node.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                   stage='upstream')
+        parts = await crypto(wrap_response, response_key, circuit,
+                             content_mode, accept, upstream_content,
+                             content_type)
+    except Exception as e:
+        return error('relay', e)
+
+    # Notify on encryption and packaging
+    node.report('success')
+    size = sum(len(part) for part in parts)
+    node.BYTES.inc(size, direction='out')
+    return StreamingResponse(iterate(parts),
+                             media_type='application/x-binary',
+                             headers={'Content-Length': str(size)})
+
+
+async def relay_stream(request):
+    """Relay a streamed package frame by frame, same as `main.relay_stream`."""
+    # Unpack the header and the first frame
+    try:
+        reader = AsyncChunkReader(request.stream())
+        header = await aread_header(reader)
+        cipher_aes, response_key = await crypto(node.content_cipher,
+                                                header.key, header.nonce,
+                                                header.circuit, header.suite,
+                                                header.mode)
+        streamed = header.content_size == STREAM_SIZE
+        # Frames of a stream carry their own tags and end with a tag only frame
+        decrypt = cipher_aes.decrypt_frame if streamed else cipher_aes.decrypt
+        if header.compression != COMPRESSION_NONE:  # Only at the exit node
+            decompressor = Decompressor(header.compression)
+            decrypt_frame = decrypt
+
+            def decrypt(frame):
+                return decompressor.decompress(decrypt_frame(frame))
+
+        frames = aiter_frames(reader, header.content_size)
+        first_frame = await anext(frames, b'')
+        node.BYTES.inc(len(first_frame), direction='in')
+        first = await crypto(decrypt, first_frame)
+    except Exception as e:
+        return error('unwrap', e)
+    # Notify on parsing
+    node.report('success')
+
+    async def content():
+        yield first
+        async for frame in frames:
+            node.BYTES.inc(len(frame), direction='in')
+            data = await crypto(decrypt, frame)
+            if data:
+                yield data
+        if streamed:
+            cipher_aes.check_end()
+        if header.compression != COMPRESSION_NONE:
+            decompressor.finish()
+
+    # Make next connection
+    try:
+        start = time.perf_counter()
+        upstream = None
+        if first.startswith(MUX_MAGIC):  # Last hop of multiplexed streams
+            chunks = serve_streams(b''.join(
+                [data async for data in content()]))
+        elif first.startswith(b'GET '):  # Last hop
+            # Decrypt the rest of the package, so its tags and end are checked
+            async for _ in content():
+                pass
+            upstream = await client.get(header.address)
+        else:  # Intermediate hop, the body is sent while it is decrypted
+            upstream = await client.post(
+                header.address,
+                data=content(),
+                headers={'Content-Type': STREAM_TYPE})
+        if upstream is not None:
+            chunks = upstream.content.iter_chunked(CHUNK_SIZE)
+        node.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                   stage='upstream')
+        compression = node.stream_compression(header.accept, upstream)
+        key, cipher_response, suite = await crypto(node.response_cipher,
+                                                   response_key, header.mode)
+    except Exception as e:
+        if upstream is not None:  # Holds its connection until released
+            upstream.release()
+        return error('relay', e)
+
+    if compression != COMPRESSION_NONE:  # Only at the exit node
+        compressor = Compressor(compression)
+
+        def compress_and_encrypt(chunk, last=False):
+            chunk = compressor.finish(chunk) if last else compressor.compress(
+                chunk)
+            return cipher_response.encrypt(chunk)
+
+        encrypt = compress_and_encrypt
+    else:
+        encrypt = cipher_response.encrypt
+
+    async def generate():
+        try:
+            part = encode_header(key,
+                                 cipher_response.nonce,
+                                 b'none:0000',
+                                 circuit=header.circuit,
+                                 suite=suite,
+                                 mode=cipher_response.mode,
+                                 compression=compression)
+            node.BYTES.inc(len(part), direction='out')
+            yield part
+            async for chunk in chunks:
+                if chunk:
+                    part = encode_frame(await crypto(encrypt, chunk))
+                    node.BYTES.inc(len(part), direction='out')
+                    yield part
+            if compression != COMPRESSION_NONE:  # The end of the compressed content
+                part = encode_frame(await crypto(encrypt, b'', True))
+                node.BYTES.inc(len(part), direction='out')
+                yield part
+            end = cipher_response.end()  # Empty without an AEAD mode
+            part = (encode_frame(end) if end else b'') + encode_frame(b'')
+            node.BYTES.inc(len(part), direction='out')
+            yield part
+        finally:
+            if upstream is not None:
+                upstream.release()
+        # Notify on encryption and packaging
+        node.report('success')
+
+    return StreamingResponse(generate(), media_type=STREAM_TYPE)
+
+
+async def get_public_key(request):
+    """Get the public key of this node, see `main.get_public_key`."""
+    return Response(await crypto(node.generate_key),
+                    media_type='text/html')
+
+
+async def lease_node(request):
+    """Assign this warm node to a route, see `main.lease_node`."""
+    if not node.authorized(request.headers.get('Authorization')):
+        return PlainTextResponse('Error: Not authorized', 403)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    message, result = await crypto(node.start_lease, data)
+    if message:
+        return PlainTextResponse(message, 400)
+    return JSONResponse(result)
+
+
+async def release_node(request):
+    """Reset this node after its route is done, see `main.release_node`."""
+    if not node.authorized(request.headers.get('Authorization')):
+        return PlainTextResponse('Error: Not authorized', 403)
+    await crypto(node.end_lease)
+    return PlainTextResponse('OK')
+
+
+async def get_metrics(request):
+    """Get the metrics of this node, see `main.get_metrics`."""
+    return Response(node.metrics.render(),
+                    headers={'Content-Type': CONTENT_TYPE})
+
+
+async def info(request):
+    """Show information for logging purposes."""
+    msg = node.info_text() + f'''\
+ASYNC: {{'in_flight': {in_flight}, 'max_in_flight': {max_in_flight}, 'crypto_threads': {CRYPTO_THREADS}}}
+'''
+    print(node.LOG_PREFIX + msg)
+    return HTMLResponse(msg.replace('\n', '<br>'))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    client = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=int(os.getenv('ASYNC_MAX_CONNECTIONS', 1000)),
+            keepalive_timeout=float(os.getenv('HTTP_IDLE_TIMEOUT', 60))),
+        timeout=aiohttp.ClientTimeout(total=None),
+        auto_decompress=False)
+    yield
+    await client.close()
+
+
+app = Starlette(routes=[
+    Route('/', relay, methods=['POST']),
+    Route('/get-public-key', get_public_key, methods=['GET']),
+    Route('/lease', lease_node, methods=['POST']),
+    Route('/release', release_node, methods=['POST']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/info', info, methods=['GET']),
+],
+                lifespan=lifespan)
+"""Notes:
+Takes the environment variables of main.py and additionally
+CRYPTO_THREADS (optional): How many threads run the key and AES work (default number of CPUs)
+ASYNC_MAX_CONNECTIONS (optional): How many connections to the next hops may be open at once (default 1000)
+"""
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', 8080)))
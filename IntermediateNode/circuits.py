@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CircuitTable:
+    """Bounded table of the circuits running through this node.
+
+    Maps a circuit id to the keys of both directions. Entries expire after
+    `ttl` seconds without a package and the least recently used circuit is
+    evicted once `max_size` circuits are stored.
+    """
+
+    def __init__(self, max_size=4096, ttl=600.0):
+        """
+        Args:
+            max_size (int, optional): Maximum number of circuits. Defaults to 4096.
+            ttl (float, optional): Seconds a circuit is kept without use. Defaults to 600.
+        """
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self._circuits = OrderedDict()  # circuit id -> (keys, last used)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        """Drop expired circuits, the oldest are first. Expects the lock to be held."""
+        while self._circuits:
+            circuit, (_, last_used) = next(iter(self._circuits.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._circuits[circuit]
+            self.expired += 1
+
+    def put(self, circuit, keys):
+        """Store the keys of a new circuit.
+
+        Args:
+            circuit (bytes): The circuit id.
+            keys (Tuple[bytes, bytes]): The forward and backward AES keys.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._circuits[circuit] = (keys, now)
+            self._circuits.move_to_end(circuit)
+            self.created += 1
+            while len(self._circuits) > self.max_size:
+                self._circuits.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, circuit):
+        """Return the keys of a circuit and refresh its expiry.
+
+        Args:
+            circuit (bytes): The circuit id.
+
+        Returns:
+            Tuple[bytes, bytes]|None: The forward and backward AES keys, None if unknown.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._circuits.get(circuit)
+            if entry is None:
+                return None
+            self._circuits[circuit] = (entry[0], now)
+            self._circuits.move_to_end(circuit)
+            return entry[0]
+
+    def clear(self):
+        """Forget all circuits.
+
+        Returns:
+            int: Number of circuits dropped.
+        """
+        with self._lock:
+            dropped = len(self._circuits)
+            self._circuits.clear()
+        return dropped
+
+    def stats(self):
+        """Return the table counters.
+
+        Returns:
+            dict: Size, created, expired and evicted circuits.
+        """
+        return {
+            'size': len(self._circuits),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
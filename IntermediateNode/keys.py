@@ -0,0 +1,240 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+from onion import SUITE_RSA, export_key, import_key, key_cipher, new_key
+
+
+class KeyRing:
+    """Process wide store of the private keys of this node.
+
+    Every key is parsed and validated only once and kept as a ready to use
+    cipher of its key suite (see `onion.key_cipher`). The newest key is used
+    first, older generations are kept so that packages which were wrapped
+    before a key rotation can still be decrypted.
+
+    Readers never lock: the ciphers are stored in a tuple which is replaced
+    as a whole whenever a new key is installed.
+    """
+
+    def __init__(self, generations=2):
+        """
+        Args:
+            generations (int, optional): How many keys are kept. Defaults to 2.
+        """
+        self.generations = max(1, generations)
+        self._ciphers = ()  # (suite, cipher)
+        self._public_key = None
+        self._lock = threading.Lock()
+
+    def install(self, key):
+        """Make the given key the current key of this node.
+
+        Args:
+            key (Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey): A private
+                RSA or X25519 key.
+        """
+        if not key.has_private():
+            raise ValueError('Only private keys can be installed')
+        cipher = key_cipher(key)
+        public_key = export_key(key)
+        with self._lock:
+            self._ciphers = (cipher, ) + self._ciphers[:self.generations - 1]
+            self._public_key = public_key
+
+    def load(self, key_name='private.pem'):
+        """Install the key stored in the given PEM file if it exists.
+
+        Args:
+            key_name (str, optional): The PEM file. Defaults to 'private.pem'.
+
+        Returns:
+            bool: Whether a key was loaded.
+        """
+        if not os.path.exists(key_name):
+            return False
+        with open(key_name) as key_file:
+            self.install(import_key(key_file.read()))
+        return True
+
+    def public_key(self):
+        """Return the public key of the current key.
+
+        Returns:
+            bytes|None: The PEM encoded public key, None if no key is installed.
+        """
+        return self._public_key
+
+    def ciphers(self):
+        """Return a snapshot of all ciphers, newest first.
+
+        Returns:
+            Tuple[Tuple[int, PKCS1_OAEP|X25519Cipher]]: The suite and the cipher of every key.
+        """
+        return self._ciphers
+
+    def decrypt(self, enc_key, suite=SUITE_RSA):
+        """Unwrap the AES key with the newest matching key of the key suite.
+
+        Args:
+            enc_key (bytes): The encrypted AES key.
+            suite (int, optional): The key suite of the package header. Defaults to SUITE_RSA.
+
+        Returns:
+            bytes: The decrypted AES key.
+        """
+        ciphers = self._ciphers
+        if not ciphers:
+            raise ValueError('No private key available. Ask for /get-public-key first')
+        for key_suite, cipher in ciphers:
+            if key_suite != suite:
+                continue
+            try:
+                return cipher.decrypt(enc_key)
+            except ValueError:
+                continue
+        raise ValueError('The package was not wrapped for any key of this node')
+
+
+class PublicKeyCache:
+    """Bounded LRU cache of parsed client public keys.
+
+    Keys are looked up by the SHA-256 fingerprint of their PEM so that a node
+    serving many clients does not parse the same PEM for every response.
+    """
+
+    def __init__(self, max_size=64):
+        """
+        Args:
+            max_size (int, optional): Maximum number of cached keys. Defaults to 64.
+        """
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self.misses = 0
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(public_key):
+        """Return the fingerprint of a PEM encoded public key.
+
+        Args:
+            public_key (str|bytes): The PEM encoded public key.
+
+        Returns:
+            str: The hex encoded SHA-256 digest of the PEM.
+        """
+        if isinstance(public_key, str):
+            public_key = public_key.encode()
+        return hashlib.sha256(public_key.strip()).hexdigest()
+
+    def cipher(self, public_key):
+        """Return the cipher which wraps AES keys for the given PEM encoded public key.
+
+        Args:
+            public_key (str|bytes): The PEM encoded RSA or X25519 public key.
+
+        Returns:
+            int, PKCS1_OAEP|X25519Cipher: The key suite and the cipher.
+        """
+        fingerprint = self.fingerprint(public_key)
+        with self._lock:
+            cipher = self._ciphers.get(fingerprint)
+            if cipher is not None:
+                self._ciphers.move_to_end(fingerprint)
+                self.hits += 1
+                return cipher
+            self.misses += 1
+        # Parse outside of the lock, a concurrent miss only costs a second parse
+        cipher = key_cipher(import_key(public_key))
+        with self._lock:
+            self._ciphers[fingerprint] = cipher
+            self._ciphers.move_to_end(fingerprint)
+            while len(self._ciphers) > self.max_size:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    def stats(self):
+        """Return the cache counters.
+
+        Returns:
+            dict: Size, hits and misses of the cache.
+        """
+        return {'size': len(self._ciphers), 'hits': self.hits, 'misses': self.misses}
+
+
+class KeyPool:
+    """Pool of pre-generated key pairs.
+
+    A background thread keeps up to `depth` key pairs ready so that a new key
+    can be handed out without waiting for `RSA.generate`. If the pool runs
+    dry, a key is generated in the calling thread and the exhaustion is
+    counted. X25519 keys are cheap to generate, the pool mostly matters for RSA.
+    """
+
+    def __init__(self, depth=2, suite=SUITE_RSA, bits=2048, on_exhausted=None):
+        """
+        Args:
+            depth (int, optional): Number of key pairs kept ready. Defaults to 2.
+            suite (int, optional): The key suite of the keys. Defaults to SUITE_RSA.
+            bits (int, optional): RSA key size. Defaults to 2048.
+            on_exhausted (Callable[[], None], optional): Called whenever the pool
+                ran dry. Defaults to None.
+        """
+        self.depth = max(1, depth)
+        self.suite = suite
+        self.bits = bits
+        self.on_exhausted = on_exhausted
+        self.exhausted = 0
+        self._keys = queue.Queue()
+        self._refill = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the background worker if it is not running yet."""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name='key-pool',
+                                                daemon=True)
+                self._worker.start()
+        self._refill.set()
+
+    def _run(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while self._keys.qsize() < self.depth:
+                self._keys.put(new_key(self.suite, self.bits))
+
+    def take(self):
+        """Take a key pair out of the pool and trigger a refill.
+
+        Returns:
+            Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey: A new private key.
+        """
+        try:
+            key = self._keys.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.exhausted += 1
+            if self.on_exhausted:
+                self.on_exhausted()
+            key = new_key(self.suite, self.bits)
+        self._refill.set()
+        return key
+
+    def stats(self):
+        """Return the pool counters.
+
+        Returns:
+            dict: Depth, ready keys and exhaustion events of the pool.
+        """
+        return {
+            'depth': self.depth,
+            'ready': self._keys.qsize(),
+            'exhausted': self.exhausted
+        }
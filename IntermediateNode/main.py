@@ -1,117 +1,483 @@
 #!/usr/bin/env python3
+import itertools
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
-from flask import Flask, Response, request
+from flask import Flask, Response, jsonify, request
+
+from circuits import CircuitTable
+from http_pool import SessionPool
+from keys import KeyPool, KeyRing, PublicKeyCache
+from metrics import CONTENT_TYPE, Metrics
+from notifier import Notifier
+from onion import (CHUNK_SIZE, COMPRESSION_NONE, MODE_EAX, MUX_DATA, MUX_END,
+                   MUX_ERROR, MUX_FRAME, MUX_MAGIC, STREAM_TYPE, SUITE_RSA, SUITES,
+                   ChunkReader, LayerCipher, choose_compression, compress,
+                   compressible, decode, decode_mux_requests, decompress,
+                   decompress_chunks, decrypt_frames, derive_circuit_keys,
+                   encode_header, encode_mux_frame, export_key, iter_frames,
+                   read_header, wrap_stream)
 
 app = Flask(__name__)
 
 LOG_PREFIX = f'\x1b[42m[Node {os.getenv("PORT")}]\x1b[0m'
 DIRECTORY_NODE = os.getenv('DIRECTORY_NODE', 'http://127.0.0.1:8888')
 
+# Keep-alive connections to the next hops and the directory node
+http = SessionPool(int(os.getenv('HTTP_POOL_SIZE', 16)),
+                   float(os.getenv('HTTP_IDLE_TIMEOUT', 60)))
+# Private keys of this node, loaded once instead of on every package
+keyring = KeyRing(int(os.getenv('KEY_GENERATIONS', 2)))
+keyring.load('private.pem')
+# Parsed public keys of the clients, used to wrap the responses
+public_keys = PublicKeyCache(int(os.getenv('PUBLIC_KEY_CACHE_SIZE', 64)))
+# Session keys of the circuits running through this node
+circuits = CircuitTable(int(os.getenv('CIRCUIT_TABLE_SIZE', 4096)),
+                        float(os.getenv('CIRCUIT_TTL', 600)))
+# Key suite of the keys of this node, X25519 unless old clients need RSA.
+# With the `cryptography` package a hop costs a third of an RSA hop, and a
+# key, one of which is taken on every release, is generated 200x faster (see README)
+KEY_SUITE = SUITES[os.getenv('KEY_SUITE', 'x25519')]
+# Key pairs generated in the background, handed out by /get-public-key
+key_pool = KeyPool(int(os.getenv('KEY_POOL_SIZE', 2)),
+                   KEY_SUITE,
+                   on_exhausted=lambda: KEY_POOL_EXHAUSTED.inc())
+key_pool.start()
+# Writes the PEM files in order without blocking the request
+key_writer = ThreadPoolExecutor(max_workers=1)
+# Batches the notifications to the directory node off the request path
+notifier = Notifier(DIRECTORY_NODE + '/notify/batch',
+                    max_queue=int(os.getenv('NOTIFY_QUEUE_SIZE', 1024)),
+                    max_batch=int(os.getenv('NOTIFY_BATCH_SIZE', 64)),
+                    http=http)
+notifier.start()
+# Sends the requests of multiplexed streams at the exit node
+mux_pool = ThreadPoolExecutor(max_workers=int(os.getenv('MUX_THREADS', 16)),
+                              thread_name_prefix='mux')
+# Seconds a multiplexed stream may wait for its service before it fails with MUX_ERROR
+MUX_TIMEOUT = float(os.getenv('MUX_TIMEOUT', 30))
+# Smaller responses are not compressed by the exit node, compressing them saves too little
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+# Client key and tracking id handed over by the directory node via /lease
+lease = {}
+LEASE_TOKEN = os.getenv('LEASE_TOKEN')
+# Token of this node for /register at the directory node, issued with its deployment
+REGISTER_TOKEN = os.getenv('REGISTER_TOKEN')
+# Served by /metrics, every thread records into its own shard
+metrics = Metrics()
+STAGE_SECONDS = metrics.histogram(
+    'onion_node_stage_seconds',
+    'Seconds per stage of a package: parse, unwrap_key, aes_decrypt, decompress, notify, upstream, compress and encrypt'
+)
+REQUEST_SECONDS = metrics.histogram(
+    'onion_node_request_seconds',
+    'Seconds from receiving a package until its response is sent, by mode')
+IN_FLIGHT = metrics.gauge('onion_node_in_flight',
+                          'Packages being relayed, by mode')
+BYTES = metrics.counter(
+    'onion_node_bytes_total',
+    'Bytes of the received packages (in) and the sent responses (out)')
+ERRORS = metrics.counter('onion_node_errors_total',
+                         'Failed packages by stage and exception type')
+KEY_POOL_EXHAUSTED = metrics.counter(
+    'onion_node_key_pool_exhausted_total',
+    'Keys generated on the request path because the key pool was empty')
+
+
+def setting(name):
+    """Return a route setting of the current lease, or of the environment
+    if the node was deployed for a single route.
 
-def generate_rsa_key():
-    """Generate a new RSA key pair which will be stored
-    as `private.pem` and `public.pem`.
-    Returns the public key.
+    Args:
+        name (str): 'PUBLIC_KEY' or 'TRACKING_ID'.
 
     Returns:
-        Crypto.PublicKey.RSA.RsaKey: The newly generated public key.
+        str: The value, None if it is not set.
+    """
+    return lease.get(name) or os.getenv(name)
+
+
+def report(status):
+    """Queue a notification about the current route for the directory node.
+    Every package is reported twice, after unwrapping and after wrapping the response.
+
+    Args:
+        status (str): 'success' or the error message.
+    """
+    start = time.perf_counter()
+    notifier.notify({
+        'status': status,
+        'node_address': os.getenv('THIS_NODE'),
+        'tracking_id': setting('TRACKING_ID')
+    })
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='notify')
+
+
+def report_error(stage, e):
+    """Count a failed package by stage and exception type
+    and report it to the directory node.
+
+    Args:
+        stage (str): 'unwrap' or 'relay'.
+        e (Exception): The error.
+    """
+    ERRORS.inc(stage=stage, type=type(e).__name__)
+    report(str(e))
+
+
+def count_bytes(chunks, direction):
+    """Pass the chunks on and count their bytes.
+
+    Args:
+        chunks (Iterable[bytes]): The chunks.
+        direction (str): 'in' or 'out'.
+
+    Yields:
+        bytes: The chunks.
     """
-    key = RSA.generate(2048)
-    private_key = key.export_key()
+    for chunk in chunks:
+        BYTES.inc(len(chunk), direction=direction)
+        yield chunk
+
+
+def finish(start, mode):
+    """Record a relayed package once its response is sent.
+
+    Args:
+        start (float): The `time.perf_counter` the package was received at.
+        mode (str): 'package' or 'stream'.
+    """
+    IN_FLIGHT.dec(mode=mode)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, mode=mode)
+
+
+def write_key(key):
+    """Store the key pair as `private.pem` and `public.pem`.
+
+    Args:
+        key (Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey): The private key.
+    """
+    private_key = export_key(key, private=True)
     private_file = open('private.pem', 'wb')
     private_file.write(private_key)
     private_file.close()
     public_file = open('public.pem', 'wb')
-    public_file.write(key.publickey().export_key())
+    public_file.write(export_key(key))
     public_file.close()
-    return key.publickey().export_key()
 
 
-def get_private_rsa_key():
-    """Read the private.pem key and return it.
+def register_key(public_key):
+    """Publish the public key at the directory node, which hands it out
+    together with the routes. Only nodes deployed by the directory node register,
+    with the registration token they were deployed with.
+
+    Args:
+        public_key (bytes): The PEM encoded public key.
+    """
+    if not REGISTER_TOKEN or not os.getenv('THIS_NODE'):
+        return
+    try:
+        http.post(DIRECTORY_NODE + '/register',
+                  json={
+                      'node_address': os.getenv('THIS_NODE'),
+                      'public_key': public_key.decode()
+                  },
+                  headers={
+                      'Authorization': f'Bearer {REGISTER_TOKEN}'
+                  },
+                  timeout=10).raise_for_status()
+    except Exception as e:
+        print(f'{LOG_PREFIX} Registering the public key failed: {str(e)}')
+
+
+def generate_key():
+    """Take a new key pair of KEY_SUITE out of the key pool which will be stored
+    as `private.pem` and `public.pem` and registered at the directory node
+    in the background. The new key replaces the current key in the keyring.
+    Returns the public key.
 
     Returns:
-        str: The private RSA key
+        bytes: The PEM encoded public key.
     """
-    key_name = 'private.pem'
-    return RSA.import_key(open(key_name).read())
+    key = key_pool.take()
+    keyring.install(key)
+    public_key = export_key(key)
+    key_writer.submit(write_key, key)
+    key_writer.submit(register_key, public_key)
+    return public_key
 
 
-def encrypt(content):
-    """Encrypt the content with AES and RSA.
-    First generates a random AES key which is used to encrypt the content,
-    then the AES key itself is encrypted with the given public key.
+# Register the stored key on startup, or a new one if there is none
+if keyring.public_key():
+    key_writer.submit(register_key, keyring.public_key())
+else:
+    key_writer.submit(generate_key)
+
+
+def response_cipher(response_key=None, mode=MODE_EAX):
+    """Create a random AES cipher for a response
+    and encrypt its key with the public key of the client.
+    Inside of a circuit the backward key of the circuit is used instead
+    and no key is sent.
 
     Args:
-        public_key (str): The public key as a string.
-        content (str): The content that should be encrypted.
+        response_key (bytes, optional): The backward AES key of the circuit. Defaults to None.
+        mode (int, optional): The content mode, the one of the request. Defaults to MODE_EAX.
 
     Returns:
-        (bytes, bytes, bytes): encrypted AES key, AES key nonce, encrypted content
+        (bytes, onion.LayerCipher, int): encrypted AES key, content cipher, key suite
     """
+    if response_key:
+        return b'', LayerCipher(response_key, mode), SUITE_RSA
     # Get public client key
-    key_name = os.getenv('PUBLIC_KEY')
-    public_key = RSA.import_key(key_name)
+    suite, cipher_key = public_keys.cipher(setting('PUBLIC_KEY'))
     session_key = get_random_bytes(32)  # Random AES key
-    cipher_rsa = PKCS1_OAEP.new(public_key)
-    enc_key = cipher_rsa.encrypt(session_key)  # Encrypt AES key with RSA key
-    cipher_aes = AES.new(session_key, AES.MODE_EAX)
+    enc_key = cipher_key.encrypt(session_key)  # Wrap AES key for the client key
+    return enc_key, LayerCipher(session_key, mode), suite
+
+
+def encrypt(content, mode=MODE_EAX):
+    """Encrypt the content with AES and the public key of the client.
+    First generates a random AES key which is used to encrypt the content,
+    then the AES key itself is wrapped for the public key of the client.
+
+    Args:
+        content (str): The content that should be encrypted.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
+
+    Returns:
+        (bytes, bytes, bytes, int, int): encrypted AES key, AES key nonce, encrypted content,
+            key suite, content mode
+    """
+    enc_key, cipher_aes, suite = response_cipher(mode=mode)
     enc_content = cipher_aes.encrypt(content)  # Encrypt content with AES key
-    return enc_key, cipher_aes.nonce, enc_content
+    return enc_key, cipher_aes.nonce, enc_content, suite, mode
+
+
+def unwrap_key(enc_key, suite=SUITE_RSA):
+    """Unwrap an AES key with the keys of the key suite in the keyring.
+
+    Args:
+        enc_key (bytes): The encrypted AES key.
+        suite (int, optional): The key suite of the package header. Defaults to SUITE_RSA.
+
+    Returns:
+        bytes: The AES key.
+    """
+    start = time.perf_counter()
+    key = keyring.decrypt(enc_key, suite)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='unwrap_key')
+    return key
 
 
-def decrypt(enc_key, nonce, enc_content):
-    """Decrypt the AES key using the public key of this node
+def content_cipher(enc_key,
+                   nonce,
+                   circuit=None,
+                   suite=SUITE_RSA,
+                   mode=MODE_EAX):
+    """Create the AES cipher to decrypt the content of a package.
+
+    Outside of a circuit the AES key is decrypted using the private keys in the keyring.
+    The first package of a circuit carries the session key of the circuit
+    which is stored for the following packages. These do not carry a key
+    and the stored keys of the circuit are used.
+
+    Args:
+        enc_key (bytes): The encrypted AES key, empty for later packages of a circuit.
+        nonce (bytes): The AES nonce needed for decryption.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite of the package header. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode of the package header. Defaults to MODE_EAX.
+
+    Returns:
+        (onion.LayerCipher, bytes|None): content cipher, AES key of the response (None outside of circuits)
+    """
+    if circuit is None:
+        key, response_key = unwrap_key(enc_key, suite), None
+    elif enc_key:
+        key, response_key = derive_circuit_keys(unwrap_key(enc_key, suite))
+        circuits.put(circuit, (key, response_key))
+    else:
+        keys = circuits.get(circuit)
+        if keys is None:
+            raise ValueError('Unknown circuit, it has to be created again')
+        key, response_key = keys
+    return LayerCipher(key, mode, nonce), response_key
+
+
+def decrypt(enc_key, nonce, enc_content, suite=SUITE_RSA, mode=MODE_EAX):
+    """Decrypt the AES key using the private keys in the keyring of this node
     and then the content with the decrypted key and the nonce.
 
     Args:
         enc_key (bytes): The encrypted AES key.
         nonce (bytes): The AES nonce needed for decryption.
         enc_content (bytes): The encrypted content.
+        suite (int, optional): The key suite the AES key is wrapped with. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
 
     Returns:
         str: Decrypted content.
     """
-    private_key = get_private_rsa_key()
-    cipher_rsa = PKCS1_OAEP.new(private_key)
-    key = cipher_rsa.decrypt(enc_key)
-    cipher_aes = AES.new(key, AES.MODE_EAX, nonce)
+    cipher_aes, _ = content_cipher(enc_key, nonce, suite=suite, mode=mode)
     return cipher_aes.decrypt(enc_content)
 
 
 def parse_package(data):
     """Parse the received data package and return the next host and content.
-    The package will have an AES key which will be decrypted with the private RSA key,
+    The package will have an AES key which will be unwrapped with the private key of its key suite,
     then used to decrypt the content which will then be returned together with the next host.
+    With an AEAD content mode the tag of the content is verified first,
+    so a corrupted package is not passed on.
 
-    Follows this protocol:
-    |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
-    | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+    Inside of a circuit the AES key is taken from the circuit instead (see `content_cipher`).
+
+    Follows this protocol (see onion.py):
+    |  1 Byte |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
+    | version | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+    Versions 3 and 4 add the key suite after the version byte, versions 5 and 6 also the content mode,
+    versions 7 and 8 also the compression, the compressed content of the innermost layer is decompressed.
 
     Args:
         data (bytes): The received bytes package.
 
     Returns:
-        str, str: The next host, the decrypted content (might still be encrypted)
+        str, str, bytes|None, bytes|None, int, int: The next host, the decrypted content (might still be encrypted),
+            the AES key of the response and the circuit id (both None outside of circuits),
+            the content mode and the mask of the compressions the client accepts for the response
+    """
+    start = time.perf_counter()
+    package = decode(data)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='parse')
+    cipher_aes, response_key = content_cipher(package.key, package.nonce,
+                                              package.circuit, package.suite,
+                                              package.mode)
+    start = time.perf_counter()
+    content = cipher_aes.decrypt(package.content)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='aes_decrypt')
+    if package.compression != COMPRESSION_NONE:
+        start = time.perf_counter()
+        content = decompress(package.compression, content)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage='decompress')
+    return (package.address, content, response_key, package.circuit,
+            package.mode, package.accept)
+
+
+def compress_response(content, accept, content_type=None):
+    """Compress the response of the exit node with a compression the client accepts.
+    Responses smaller than COMPRESS_MIN_SIZE, of an already compressed
+    content type or which do not get smaller are sent as they are.
+
+    Args:
+        content (bytes): The response.
+        accept (int): The mask of the compressions the client accepts, 0 at all other hops.
+        content_type (str, optional): The Content-Type of the response. Defaults to None.
+
+    Returns:
+        int, bytes: The compression and the (compressed) response.
     """
-    key_size = int.from_bytes(data[:4], byteorder='big')
-    address_size = int.from_bytes(data[4:8], byteorder='big')
-    content_size = int.from_bytes(data[8:12], byteorder='big')
-    enc_key = data[12:12 + key_size]
-    idx = 12 + key_size + 16
-    nonce = data[12 + key_size:idx]
+    compression = choose_compression(accept, len(content), COMPRESS_MIN_SIZE)
+    if compression == COMPRESSION_NONE or not compressible(content_type):
+        return COMPRESSION_NONE, content
+    start = time.perf_counter()
+    compressed = compress(compression, content)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='compress')
+    if len(compressed) >= len(content):
+        return COMPRESSION_NONE, content
+    return compression, compressed
 
-    next_host = data[idx:idx + address_size].decode()
-    idx += address_size
-    enc_content = data[idx:idx + content_size]
-    content = decrypt(enc_key, nonce, enc_content)
-    return next_host, content
 
+def stream_compression(accept, response=None):
+    """Choose the compression of a streamed response, see `compress_response`.
+    The size of a stream is only known if the service sends its Content-Length.
+
+    Args:
+        accept (int): The mask of the compressions the client accepts, 0 at all other hops.
+        response (requests.Response|aiohttp.ClientResponse, optional): The response
+            of the next hop, None for multiplexed streams. Defaults to None.
+
+    Returns:
+        int: The compression.
+    """
+    if response is None:
+        return choose_compression(accept, min_size=COMPRESS_MIN_SIZE)
+    if not compressible(response.headers.get('Content-Type')):
+        return COMPRESSION_NONE
+    size = response.headers.get('Content-Length', '')
+    return choose_compression(accept,
+                              int(size) if size.isdigit() else None,
+                              COMPRESS_MIN_SIZE)
+
+
+def fetch_stream(stream_id, method, url, body, frames, done):
+    """Send the request of a multiplexed stream and queue its response frames.
+
+    Args:
+        stream_id (int): The stream id.
+        method (str): The HTTP method.
+        url (str): The service URL.
+        body (bytes): The request body.
+        frames (queue.Queue): Gets the encoded frames, the last one is MUX_END or MUX_ERROR.
+        done (threading.Event): Set once the frames are no longer read, then the request stops.
+    """
+    if done.is_set():
+        return
+    try:
+        with http.request(method, url, data=body or None, stream=True,
+                          timeout=MUX_TIMEOUT) as response:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if done.is_set():
+                    return
+                if chunk:
+                    frames.put(encode_mux_frame(stream_id, chunk))
+        frames.put(encode_mux_frame(stream_id, flags=MUX_END))
+    except Exception as e:
+        ERRORS.inc(stage='stream', type=type(e).__name__)
+        frames.put(encode_mux_frame(stream_id, str(e).encode(), MUX_ERROR))
+
+
+def serve_streams(content):
+    """Send all requests of multiplexed content (see onion.py) at once
+    and yield their response frames interleaved in the order they arrive.
+    The streams which get no frame for MUX_TIMEOUT seconds end with MUX_ERROR.
+
+    Args:
+        content (bytes): The innermost content, starting with MUX_MAGIC.
+
+    Yields:
+        bytes: MUX_MAGIC and the response frames, the last one ends the content.
+    """
+    requests = decode_mux_requests(content)
+    frames = queue.Queue()
+    done = threading.Event()
+    for stream_id, (method, url, body) in requests.items():
+        mux_pool.submit(fetch_stream, stream_id, method, url, body, frames,
+                        done)
+    try:
+        yield MUX_MAGIC
+        open_streams = set(requests)
+        while open_streams:
+            try:
+                frame = frames.get(timeout=MUX_TIMEOUT)
+            except queue.Empty:
+                ERRORS.inc(stage='stream', type='Timeout')
+                for stream_id in sorted(open_streams):
+                    yield encode_mux_frame(
+                        stream_id,
+                        f'No response within {MUX_TIMEOUT}s'.encode(),
+                        MUX_ERROR)
+                break
+            stream_id, flags, _ = MUX_FRAME.unpack_from(frame)
+            if flags != MUX_DATA:  # The stream is done
+                open_streams.discard(stream_id)
+            yield frame
+        yield encode_mux_frame(0, flags=MUX_END)
+    finally:
+        done.set()
 
 @app.route('/', methods=['POST'])
 def node():
@@ -123,74 +489,271 @@ def node():
         - notify the directory node,
         - wrap the response,
         - return the response.
+    Streamed packages (Content-Type application/x-onion-stream) are relayed by `relay_stream`,
+    all others by `relay_package`.
     """
-    notification_url = DIRECTORY_NODE + '/notify'
+    start = time.perf_counter()
+    mode = 'stream' if request.mimetype == STREAM_TYPE else 'package'
+    IN_FLIGHT.inc(mode=mode)
+    if mode == 'package':  # The response is complete once it is built
+        try:
+            return relay_package()
+        finally:
+            finish(start, mode)
+    try:
+        response = relay_stream()
+    except BaseException:
+        finish(start, mode)
+        raise
+    response.call_on_close(lambda: finish(start, mode))  # Once it is sent
+    return response
+
+
+def relay_package():
+    """Relay a package which is sent as a whole, see `node`."""
     status = 'success'
 
     # Unpack the received data
     try:
         received_data = request.get_data()
-        next_host, content = parse_package(received_data)
+        BYTES.inc(len(received_data), direction='in')
+        next_host, content, response_key, circuit, content_mode, accept = parse_package(
+            received_data)
     except Exception as e:
-        status = str(e)
+        report_error('unwrap', e)
         return Response(f'Error: {str(e)}')
     # Notify on parsing
-    requests.post(notification_url,
-                  json={
-                      'status': status,
-                      'node_address': os.getenv('THIS_NODE'),
-                      'tracking_id': os.getenv('TRACKING_ID')
-                  })
+    report(status)
 
     # Make next connection
     try:
-        if b'GET ' in content:  # Last hop
-            request_response = requests.get(next_host)
+        start = time.perf_counter()
+        content_type = None
+        if content.startswith(MUX_MAGIC):  # Last hop of multiplexed streams
+            upstream_content = b''.join(serve_streams(content))
+        elif b'GET ' in content:  # Last hop
+            upstream_response = http.get(next_host)
+            upstream_content = upstream_response.content
+            content_type = upstream_response.headers.get('Content-Type')
         else:  # Intermediate hop
-            request_response = requests.post(
+            upstream_content = http.post(
                 url=next_host,
                 data=content,
-                headers={'Content-Type': 'application/x-binary'})
-        key, nonce, response_content = encrypt(request_response.content)
+                headers={'Content-Type': 'application/x-binary'}).content
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - start, stage='upstream')
+        compression, upstream_content = compress_response(
+            upstream_content, accept, content_type)
+        key, cipher_aes, suite = response_cipher(response_key, content_mode)
+        response_content = cipher_aes.encrypt(upstream_content)
         address = b'none:0000'
-        response = (len(key).to_bytes(4, byteorder='big') +
-                    len(address).to_bytes(4, byteorder='big') +
-                    len(response_content).to_bytes(4, byteorder='big') + key +
-                    nonce + address + response_content)
+        # Header and content are sent one after another to avoid a copy
+        response = [
+            encode_header(key, cipher_aes.nonce, address,
+                          len(response_content), circuit, suite,
+                          cipher_aes.mode, compression),
+            response_content
+        ]
+        STAGE_SECONDS.observe(time.perf_counter() - now, stage='encrypt')
     except Exception as e:
-        status = str(e)
+        report_error('relay', e)
         return Response(f'Error: {str(e)}')
 
     # Notify on encryption and packaging
-    requests.post(notification_url,
-                  json={
-                      'status': status,
-                      'public_key': os.getenv('PUBLIC_KEY')
-                  })
+    report(status)
+    size = sum(len(part) for part in response)
+    BYTES.inc(size, direction='out')
     return Response(response,
                     mimetype="application/x-binary",
+                    headers={'Content-Length': str(size)},
                     direct_passthrough=True)
 
 
+def relay_stream():
+    """Relay a streamed package (see onion.py).
+    The content is decrypted and passed on frame by frame
+    and the response is encrypted and returned frame by frame,
+    so the memory used does not depend on the size of the package.
+    """
+    status = 'success'
+
+    # Unpack the header and the first frame
+    try:
+        reader = ChunkReader.from_stream(request.stream)
+        header = read_header(reader)
+        next_host = header.address
+        cipher_aes, response_key = content_cipher(header.key, header.nonce,
+                                                  header.circuit, header.suite,
+                                                  header.mode)
+        content = decrypt_frames(
+            cipher_aes,
+            count_bytes(iter_frames(reader, header.content_size), 'in'),
+            header.content_size)
+        if header.compression != COMPRESSION_NONE:  # Only at the exit node
+            content = decompress_chunks(header.compression, content)
+        first = next(content, b'')
+    except Exception as e:
+        report_error('unwrap', e)
+        return Response(f'Error: {str(e)}')
+    # Notify on parsing
+    report(status)
+
+    # Make next connection
+    try:
+        start = time.perf_counter()
+        request_response = None
+        if first.startswith(MUX_MAGIC):  # Last hop of multiplexed streams
+            chunks = serve_streams(b''.join(itertools.chain([first], content)))
+        elif first.startswith(b'GET '):  # Last hop
+            for _ in content:  # Drain the rest of the package
+                pass
+            request_response = http.get(next_host, stream=True)
+        else:  # Intermediate hop, the body is sent while it is decrypted
+            request_response = http.post(
+                url=next_host,
+                data=itertools.chain([first], content),
+                headers={'Content-Type': STREAM_TYPE},
+                stream=True)
+        if request_response is not None:
+            chunks = request_response.iter_content(CHUNK_SIZE)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage='upstream')
+        compression = stream_compression(header.accept, request_response)
+        key, cipher_aes, suite = response_cipher(response_key, header.mode)
+    except Exception as e:
+        if request_response is not None:  # Holds its connection until closed
+            request_response.close()
+        report_error('relay', e)
+        return Response(f'Error: {str(e)}')
+
+    def generate():
+        try:
+            yield from count_bytes(
+                wrap_stream(key, cipher_aes, b'none:0000', chunks,
+                            header.circuit, suite, compression), 'out')
+        finally:
+            if request_response is not None:
+                request_response.close()
+        # Notify on encryption and packaging
+        report(status)
+
+    return Response(generate(), mimetype=STREAM_TYPE)
+
+
 @app.route('/get-public-key', methods=['GET'])
 def get_public_key():
     """Get the public key of this node.
     A new pair will be created so it shouldn't be called multiple times.
     """
-    return generate_rsa_key()
+    return generate_key()
 
 
-@app.route('/info', methods=['GET'])
-def info():
-    """Show information for logging purposes."""
-    msg = f'''\
+def authorized(authorization):
+    """Check the lease token the directory node sends as bearer token.
+
+    Args:
+        authorization (str|None): The Authorization header.
+
+    Returns:
+        bool: Whether the directory node sent the request.
+    """
+    return bool(LEASE_TOKEN) and authorization == f'Bearer {LEASE_TOKEN}'
+
+
+def start_lease(data):
+    """Assign this node to a route.
+
+    Args:
+        data (dict|None): {'public_key': public_key_of_client, 'tracking_id': unique_id_of_route}
+
+    Returns:
+        str|None, dict|None: The error, or the current public key of this node
+            as {'public_key': public_key_of_node} if the node is leased.
+    """
+    if not data or not data.get('public_key') or not data.get('tracking_id'):
+        return 'Error: public_key and tracking_id have to be sent', None
+    if not keyring.public_key():
+        generate_key()
+    lease.update(PUBLIC_KEY=data['public_key'],
+                 TRACKING_ID=data['tracking_id'])
+    print(f'{LOG_PREFIX} Leased for route {data["tracking_id"]}')
+    return None, {'public_key': keyring.public_key().decode()}
+
+
+def end_lease():
+    """Reset this node after its route is done.
+    The key pair is replaced before the node can be leased again, so that the
+    next client does not get the same key and `/lease` never hands out a key
+    which is about to be rotated out. The circuits of the route are dropped
+    with it, so their session keys cannot be used by the next client.
+    """
+    print(f'{LOG_PREFIX} Released from route {lease.get("TRACKING_ID")}')
+    lease.clear()
+    circuits.clear()
+    generate_key()
+
+
+def info_text():
+    """Return the settings and counters of this node.
+
+    Returns:
+        str: One line per setting.
+    """
+    return f'''\
 Directory: {DIRECTORY_NODE}
 PORT: {os.getenv("PORT", "undefined")}
 SUFFIX: {os.getenv("SUFFIX", "undefined")}
 THIS_NODE: {os.getenv("THIS_NODE", "undefined")}
-TRACKING_ID: {os.getenv("TRACKING_ID", "undefined")}
-PUBLIC_KEY: {os.getenv("PUBLIC_KEY", "undefined")}
-    '''
+TRACKING_ID: {setting("TRACKING_ID") or "undefined"}
+PUBLIC_KEY: {setting("PUBLIC_KEY") or "undefined"}
+PUBLIC_KEY_CACHE: {public_keys.stats()}
+KEY_POOL: {key_pool.stats()}
+CIRCUITS: {circuits.stats()}
+NOTIFIER: {notifier.stats()}
+HTTP_POOL: {http.stats()}
+'''
+
+
+@app.route('/lease', methods=['POST'])
+def lease_node():
+    """Assign this warm node to a route.
+    Gets called by the directory node with the public key of the client
+    and the tracking id of the route.
+
+    Expects a POST request with json data:
+    {'public_key': public_key_of_client, 'tracking_id': unique_id_of_route}
+    and answers with the current public key of this node:
+    {'public_key': public_key_of_node}
+    """
+    if not authorized(request.headers.get('Authorization')):
+        return 'Error: Not authorized', 403
+    error, result = start_lease(request.get_json(silent=True))
+    if error:
+        return error, 400
+    return jsonify(result)
+
+
+@app.route('/release', methods=['POST'])
+def release_node():
+    """Reset this node after its route is done so it can be leased again.
+    The key pair is replaced and the circuits are dropped so that the next
+    client does not get the same keys.
+    """
+    if not authorized(request.headers.get('Authorization')):
+        return 'Error: Not authorized', 403
+    end_lease()
+    return 'OK'
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get the metrics of this node in the Prometheus text format."""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/info', methods=['GET'])
+def info():
+    """Show information for logging purposes."""
+    msg = info_text()
     print(LOG_PREFIX + msg)
     return msg.replace('\n', '<br>')
 
@@ -198,9 +761,25 @@ PUBLIC_KEY: {os.getenv("PUBLIC_KEY", "undefined")}
 """Notes:
 Needed environment variables are
 PORT: The port this node is running on
-PUBLIC_KEY: The public key of the client used for encryption
+PUBLIC_KEY: The public key of the client used for encryption, unless the node is leased via /lease
+TRACKING_ID: The tracking id of the route, unless the node is leased via /lease
+LEASE_TOKEN (optional): Bearer token of the directory node for /lease and /release, both are disabled without it
 THIS_NODE: Only if deployed in the cloud, then the URL of this node as passed on by the directory node.
+REGISTER_TOKEN (optional): Bearer token of this node for /register at the directory node, the public keys are not registered without it
 SUFFIX (optional): Only for development if multiple private/public keys are existent in the folder
+KEY_GENERATIONS (optional): How many rotated private keys are kept for packages still in flight (default 2)
+PUBLIC_KEY_CACHE_SIZE (optional): How many parsed client public keys are cached (default 64)
+CIRCUIT_TABLE_SIZE (optional): How many circuits are stored at once (default 4096)
+CIRCUIT_TTL (optional): Seconds after which an unused circuit is dropped (default 600)
+KEY_SUITE (optional): Key suite of the keys of this node, 'x25519' or 'rsa' for clients without X25519 support (default 'x25519')
+KEY_POOL_SIZE (optional): How many key pairs are generated ahead of time (default 2)
+NOTIFY_QUEUE_SIZE (optional): How many notifications may wait for the directory node before new ones are dropped (default 1024)
+NOTIFY_BATCH_SIZE (optional): How many notifications are sent to the directory node at once (default 64)
+MUX_THREADS (optional): How many requests of multiplexed streams the exit node sends at once (default 16)
+MUX_TIMEOUT (optional): Seconds a multiplexed stream waits for its service before it fails (default 30)
+HTTP_POOL_SIZE (optional): How many keep-alive connections are kept per next hop (default 16)
+HTTP_IDLE_TIMEOUT (optional): Seconds after which the connections to an unused next hop are closed (default 60)
+COMPRESS_MIN_SIZE (optional): Smallest response in bytes the exit node compresses for clients which accept it (default 1024)
 """
 if __name__ == '__main__':
     port = os.getenv('PORT')
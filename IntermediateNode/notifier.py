@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+import traceback
+
+import requests
+
+
+class Notifier:
+    """Sends status notifications to the directory node in the background.
+
+    Notifications are put into a bounded queue and a background thread sends
+    everything that piled up as one batch to `/notify/batch`. If the queue is
+    full the notification is dropped and counted instead of blocking the
+    relayed package.
+    """
+
+    def __init__(self,
+                 url,
+                 max_queue=1024,
+                 max_batch=64,
+                 interval=0.05,
+                 http=requests):
+        """
+        Args:
+            url (str): The batch notification URL of the directory node.
+            max_queue (int, optional): Maximum queued notifications. Defaults to 1024.
+            max_batch (int, optional): Maximum notifications per batch. Defaults to 64.
+            interval (float, optional): Seconds to wait for more notifications
+                before sending a batch. Defaults to 0.05.
+            http (optional): Sends the batches, anything with a `post` like `requests`.
+                Defaults to requests.
+        """
+        self.url = url
+        self.http = http
+        self.max_batch = max(1, max_batch)
+        self.interval = interval
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the background sender if it is not running yet."""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name='notifier',
+                                                daemon=True)
+                self._worker.start()
+
+    def notify(self, notification):
+        """Queue a notification without blocking.
+
+        Args:
+            notification (dict): The json data of the notification.
+
+        Returns:
+            bool: False if the notification was dropped.
+        """
+        try:
+            self._queue.put_nowait(notification)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        # The interval counts from the first notification of the batch, so a
+        # steady trickle cannot hold the batch back
+        deadline = time.monotonic() + self.interval
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(
+                    self._queue.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                response = self.http.post(self.url,
+                                          json={'notifications': batch},
+                                          timeout=10)
+                response.raise_for_status()
+                self.sent += len(batch)
+                self.batches += 1
+            except Exception:
+                traceback.print_exc()
+                self.failed += len(batch)
+
+    def stats(self):
+        """Return the notifier counters.
+
+        Returns:
+            dict: Queued, sent, dropped and failed notifications and sent batches.
+        """
+        return {
+            'queued': self._queue.qsize(),
+            'sent': self.sent,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
@@ -1,164 +1,716 @@
 #!/usr/bin/env python3
 import os
+import threading
+import time
 
-import requests
-from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
 from flask import Flask, jsonify, render_template, request
 
+from http_pool import SessionPool
+from node_keys import DirectoryKeys, NodeKeyCache
+from onion import (CHUNK_SIZE, CIRCUIT_ID_SIZE, COMPRESSION_NONE,
+                   COMPRESSION_ZLIB, COMPRESSIONS, MODE_EAX, MODES, MUX_DATA,
+                   MUX_ERROR, MUX_MAGIC, STREAM_TYPE, SUITE_RSA, SUITES,
+                   SUPPORTED_COMPRESSIONS, ChunkReader, LayerCipher,
+                   choose_compression, compress, compression_mask, decode,
+                   decompress, decompress_chunks, decrypt_frames,
+                   derive_circuit_keys, encode_into, encode_mux_requests,
+                   encoded_size, export_key, import_key, iter_frames,
+                   iter_mux_frames, key_cipher, new_key, read_header,
+                   wrap_stream)
+
 app = Flask(__name__,
             static_url_path='',
             static_folder='static',
             template_folder='templates')
 
+# Keep-alive connections to the nodes, shared by all requests
+http = SessionPool(int(os.getenv('HTTP_POOL_SIZE', 16)),
+                   float(os.getenv('HTTP_IDLE_TIMEOUT', 60)))
+
+
+def fetch_public_key(address):
+    """Ask a node for its public key.
+
+    Args:
+        address (str): The node URL.
 
-def generate_rsa_key():
-    """Generate a new RSA key pair which will be stored
+    Returns:
+        str: The PEM encoded public key.
+    """
+    public_key = http.get(address + '/get-public-key').text
+    if '404 Page not found' in public_key:
+        raise Exception(f'/get-public-key of {address} not found')
+    return public_key
+
+
+# Public keys of the nodes, fetched concurrently and reused for a while
+node_keys = NodeKeyCache(fetch_public_key,
+                         float(os.getenv('PUBLIC_KEY_TTL', 60)),
+                         int(os.getenv('PUBLIC_KEY_CACHE_SIZE', 256)),
+                         int(os.getenv('PUBLIC_KEY_WORKERS', 8)))
+# Signed node keys published by the directory nodes. Without a pinned
+# DIRECTORY_KEY the signing key is fetched over the same channel as the
+# documents, so the signatures only protect against changes after that
+directory_keys = DirectoryKeys(node_keys, http, os.getenv('DIRECTORY_KEY'))
+if directory_keys.pinned is None:
+    print('[WARNING] DIRECTORY_KEY is not set, the signing key of the '
+          'directory node is trusted on first use')
+
+# Established circuits by route, dropped before the nodes forget them
+CIRCUIT_TTL = float(os.getenv('CIRCUIT_TTL', 300))
+circuits = {}
+circuits_lock = threading.Lock()
+
+# Key suite of new client keys, X25519 unless the nodes only support RSA
+KEY_SUITE = SUITES[os.getenv('KEY_SUITE', 'x25519')]
+# Cipher of the private key of the client with the mtime of `private.pem` it was loaded at
+client_key = (None, None)
+# Content mode of every layer, the nodes answer with the same mode.
+# EAX without tags until every node is upgraded, older nodes cannot answer an
+# unknown mode with an error the client recognizes. 'gcm' or 'chacha20' verify
+# the content at every hop
+CONTENT_MODE = MODES[os.getenv('CONTENT_MODE', 'eax')]
+# Compressions the exit node may answer with, those which are not installed are left out.
+# 'none' for exit nodes without compression
+COMPRESSION = [
+    COMPRESSIONS[name]
+    for name in os.getenv('COMPRESSION', 'zstd,zlib').split(',')
+]
+# Smaller requests are not compressed
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+
+
+def generate_key():
+    """Generate a new key pair of KEY_SUITE which will be stored
     as `private.pem` and `public.pem`.
     """
-    key = RSA.generate(2048)
-    private_key = key.export_key()
+    key = new_key(KEY_SUITE)
+    private_key = export_key(key, private=True)
     private_file = open('private.pem', "wb")
     private_file.write(private_key)
     private_file.close()
     public_file = open('public.pem', "wb")
-    public_file.write(key.publickey().export_key())
+    public_file.write(export_key(key))
     public_file.close()
 
 
-def encrypt(public_key, content):
-    """Encrypt the content with AES and RSA.
+def client_cipher():
+    """Return the cipher of the private key of the client.
+    `private.pem` is only parsed again once it changed.
+
+    Returns:
+        int, PKCS1_OAEP|X25519Cipher: The key suite and the cipher.
+    """
+    global client_key
+    mtime = os.stat('private.pem').st_mtime_ns
+    loaded, cipher = client_key
+    if loaded != mtime:
+        with open('private.pem') as key_file:
+            cipher = key_cipher(import_key(key_file.read()))
+        client_key = (mtime, cipher)
+    return cipher
+
+
+def new_cipher(public_key, mode=None):
+    """Create a random AES cipher and wrap its key for the given public key.
+
+    Args:
+        public_key (str|Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey): The RSA or
+            X25519 public key as a string or an imported key.
+        mode (int, optional): The content mode, CONTENT_MODE if None. Defaults to None.
+
+    Returns:
+        (bytes, onion.LayerCipher, int): encrypted AES key, content cipher, key suite
+    """
+    if isinstance(public_key, (str, bytes)):
+        public_key = import_key(public_key)
+    suite, cipher_key = key_cipher(public_key)
+    session_key = get_random_bytes(32)  # Random AES key
+    enc_key = cipher_key.encrypt(session_key)  # Wrap AES key for the node key
+    return enc_key, LayerCipher(session_key,
+                                CONTENT_MODE if mode is None else mode), suite
+
+
+def encrypt(public_key, content, mode=None):
+    """Encrypt the content with AES and the given public key.
     First generates a random AES key which is used to encrypt the content,
-    then the AES key itself is encrypted with the given public key.
+    then the AES key itself is wrapped for the given public key.
 
     Args:
         public_key (str): The public key as a string.
         content (str): The content that should be encrypted.
+        mode (int, optional): The content mode, CONTENT_MODE if None. Defaults to None.
 
     Returns:
-        (bytes, bytes, bytes): encrypted AES key, AES key nonce, encrypted content
+        (bytes, bytes, bytes, int, int): encrypted AES key, AES key nonce, encrypted content,
+            key suite, content mode
     """
-    public_key = RSA.importKey(public_key)
-    session_key = get_random_bytes(32)  # Random AES key
-    cipher_rsa = PKCS1_OAEP.new(public_key)
-    enc_key = cipher_rsa.encrypt(session_key)  # Encrypt AES key with RSA key
-    cipher_aes = AES.new(session_key, AES.MODE_EAX)
+    enc_key, cipher_aes, suite = new_cipher(public_key, mode)
     enc_content = cipher_aes.encrypt(content)  # Encrypt content with AES key
-    return enc_key, cipher_aes.nonce, enc_content
+    return enc_key, cipher_aes.nonce, enc_content, suite, cipher_aes.mode
+
+
+def session_cipher(enc_key, nonce, suite=SUITE_RSA, mode=MODE_EAX):
+    """Unwrap the AES key using the private key of the client
+    and create the AES cipher for the content.
+
+    Args:
+        enc_key (bytes): The encrypted AES key.
+        nonce (bytes): The AES nonce needed for decryption.
+        suite (int, optional): The key suite of the package header. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode of the package header. Defaults to MODE_EAX.
+
+    Returns:
+        onion.LayerCipher: The content cipher.
+    """
+    key_suite, cipher_key = client_cipher()
+    if key_suite != suite:
+        raise ValueError('The response was not wrapped for the key of this client')
+    key = cipher_key.decrypt(enc_key)
+    return LayerCipher(key, mode, nonce)
 
 
-def decrypt(enc_key, nonce, enc_content):
-    """Decrypt the AES key using the public key of the client
+def decrypt(enc_key, nonce, enc_content, suite=SUITE_RSA, mode=MODE_EAX):
+    """Decrypt the AES key using the private key of the client
     and then the content with the decrypted key and the nonce.
 
     Args:
         enc_key (bytes): The encrypted AES key.
         nonce (bytes): The AES nonce needed for decryption.
         enc_content (bytes): The encrypted content.
+        suite (int, optional): The key suite the AES key is wrapped with. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
 
     Returns:
         str: Decrypted content.
     """
-    private_key = RSA.import_key(open('private.pem').read())  # Get private key
-    cipher_rsa = PKCS1_OAEP.new(private_key)
-    key = cipher_rsa.decrypt(enc_key)
-    cipher_aes = AES.new(key, AES.MODE_EAX, nonce)
-    return cipher_aes.decrypt(enc_content)
+    return session_cipher(enc_key, nonce, suite, mode).decrypt(enc_content)
+
+
+def onion_layers(public_keys, addresses, mode=None):
+    """Create the layers of a package outside of a circuit.
+    Every layer gets a random AES key which is wrapped for the public key of its node.
+
+    Args:
+        public_keys (List[str|Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey]): The public
+            key of each layer, innermost first.
+        addresses (List[str]): The next address of each layer, innermost first.
+        mode (int, optional): The content mode, CONTENT_MODE if None. Defaults to None.
+
+    Returns:
+        List[Tuple]: The layers for `build_onion`.
+    """
+    layers = []
+    for public_key, address in zip(public_keys, addresses):
+        enc_key, cipher_aes, suite = new_cipher(public_key, mode)
+        layers.append((enc_key, cipher_aes, address.encode(), None, suite))
+    return layers
+
+
+def build_onion(content, layers, compression=COMPRESSION_NONE, accept=0):
+    """Wrap the content into one layer after another inside a single buffer.
+
+    The size of every layer is known up front, so the buffer is allocated once
+    with the content between the headers and the tags of all layers. Each
+    layer is then encrypted in place, its tag (with an AEAD content mode) is
+    written directly behind it and its header directly in front of it, which
+    keeps wrapping linear in the size of the package instead of copying the
+    whole onion per layer.
+
+    Args:
+        content (bytes): The innermost content.
+        layers (List[Tuple[bytes, LayerCipher, bytes, bytes|None, int]]): Encrypted AES key,
+            content cipher, next address, circuit id and key suite of each layer, innermost first.
+        compression (int, optional): The innermost content is compressed with it
+            before it is encrypted. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the compressions accepted for the response,
+            sent to the exit node in the innermost header. Defaults to 0.
+
+    Returns:
+        bytes: The package of the outermost layer.
+    """
+    if compression != COMPRESSION_NONE:
+        content = compress(compression, content)
+    # Only the innermost header carries the compression
+    compressions = [(compression, accept)] + [(COMPRESSION_NONE, 0)] * (
+        len(layers) - 1)
+    heads = [
+        encoded_size(len(key), len(address), 0, circuit, suite,
+                     cipher_aes.mode, *compressions[hop])
+        for hop, (key, cipher_aes, address, circuit, suite) in enumerate(layers)
+    ]
+    start = sum(heads)
+    end = start + len(content)
+    size = end + sum(cipher_aes.overhead for _, cipher_aes, *_ in layers)
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    view[start:end] = content
+    for (key, cipher_aes, address, circuit,
+         suite), head, (compression, accept) in zip(layers, heads,
+                                                    compressions):
+        tag = cipher_aes.encrypt_into(view[start:end])
+        view[end:end + len(tag)] = tag
+        end += len(tag)
+        start -= head
+        encode_into(view, start, key, cipher_aes.nonce, address,
+                    end - start - head, circuit, suite, cipher_aes.mode,
+                    compression, accept)
+    view.release()
+    return bytes(buffer)
+
+
+class Circuit:
+    """Session keys shared with every node of a route.
+
+    The first package sent over a circuit carries the session key of every hop
+    wrapped for the key of its node, which the nodes store under the circuit id of the hop.
+    All later packages carry no key at all and only use the content mode.
+    """
+
+    def __init__(self, route):
+        """
+        Args:
+            route (List[str]): The node URLs, first node first.
+        """
+        self.route = list(route)
+        self.ids = [get_random_bytes(CIRCUIT_ID_SIZE) for _ in self.route]
+        self._session_keys = [get_random_bytes(32) for _ in self.route]
+        self.keys = [derive_circuit_keys(key) for key in self._session_keys]
+        self.established = False
+        self.last_used = time.monotonic()
+
+    def layers(self, addresses, public_keys=None):
+        """Create the layers of the next package of this circuit.
+
+        Args:
+            addresses (List[str]): The next address of each layer, innermost first.
+            public_keys (List[Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey], optional): The
+                public key of each layer, innermost first. Only needed until the circuit is established.
+                Defaults to None.
+
+        Returns:
+            List[Tuple]: The layers for `build_onion`.
+        """
+        layers = []
+        for i, address in enumerate(addresses):
+            hop = len(self.route) - 1 - i
+            enc_key, suite = b'', SUITE_RSA
+            if not self.established:
+                suite, cipher_key = key_cipher(public_keys[i])
+                enc_key = cipher_key.encrypt(self._session_keys[hop])
+            cipher_aes = LayerCipher(self.keys[hop][0], CONTENT_MODE)
+            layers.append(
+                (enc_key, cipher_aes, address.encode(), self.ids[hop], suite))
+        return layers
+
+    def response_cipher(self,
+                        hop,
+                        enc_key,
+                        nonce,
+                        suite=SUITE_RSA,
+                        mode=MODE_EAX):
+        """Create the content cipher for the response layer of a hop.
+
+        Args:
+            hop (int): The index of the node in the route.
+            enc_key (bytes): The encrypted AES key of the layer, empty inside of the circuit.
+            nonce (bytes): The AES nonce.
+            suite (int, optional): The key suite of the layer. Defaults to SUITE_RSA.
+            mode (int, optional): The content mode of the layer. Defaults to MODE_EAX.
+
+        Returns:
+            onion.LayerCipher: The content cipher.
+        """
+        if enc_key:
+            return session_cipher(enc_key, nonce, suite, mode)
+        return LayerCipher(self.keys[hop][1], mode, nonce)
+
+
+def get_circuit(route):
+    """Return the circuit of the route, a new one if there is none
+    or the last one was not used for CIRCUIT_TTL seconds.
+
+    Args:
+        route (List[str]): The node URLs, first node first.
+
+    Returns:
+        Circuit: The circuit.
+    """
+    now = time.monotonic()
+    with circuits_lock:
+        for key, circuit in list(circuits.items()):
+            if now - circuit.last_used > CIRCUIT_TTL:
+                del circuits[key]
+        circuit = circuits.get(tuple(route))
+        if circuit is None:
+            circuit = circuits[tuple(route)] = Circuit(route)
+        circuit.last_used = now
+        return circuit
+
+
+def drop_circuit(circuit):
+    """Forget the circuit so that the next package creates a new one.
+
+    Args:
+        circuit (Circuit): The circuit.
+    """
+    with circuits_lock:
+        if circuits.get(tuple(circuit.route)) is circuit:
+            del circuits[tuple(circuit.route)]
 
 
 def parse_package(data):
     """Parse the received data package and return the received key and content.
-    The returned key is still encrypted and has to be decrypted with this nodes
-    private RSA key. The nonce is needed by the crypto library used.
+    The returned key is still wrapped and has to be unwrapped with the private key
+    of its key suite. The nonce is needed by the crypto library used.
     The content is encrypted with the decrypted AES key.
 
-    Follows this protocol:
-    |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
-    | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+    Follows this protocol (see onion.py):
+    |  1 Byte |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
+    | version | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
 
     Args:
         data (bytes): The received bytes package.
 
     Returns:
-        str, str, str: Encrypted AES key, Nonce for AES decryption, encrypted content
+        bytes, bytes, memoryview, int, int, int: Encrypted AES key (empty inside of a circuit),
+            Nonce for AES decryption, encrypted content, key suite of the AES key, content mode,
+            compression of the content
     """
-    key_size = int.from_bytes(data[:4], byteorder='big')
-    address_size = int.from_bytes(data[4:8], byteorder='big')
-    content_size = int.from_bytes(data[8:12], byteorder='big')
-    enc_key = data[12:12 + key_size]
-    idx = 12 + key_size + 16
-    nonce = data[12 + key_size:idx]
-    enc_content = data[idx + address_size:idx + address_size + content_size]
-    return enc_key, nonce, enc_content
+    package = decode(data)
+    return (package.key, package.nonce, package.content, package.suite,
+            package.mode, package.compression)
 
 
-def client(service, route):
+def unwrap_stream(chunks, response_cipher=session_cipher):
+    """Decrypt one layer of a streamed package (see onion.py) chunk by chunk.
+
+    Args:
+        chunks (Iterable[bytes]): The streamed package.
+        response_cipher (Callable, optional): Creates the content cipher out of the
+            encrypted AES key, nonce, key suite and content mode. Defaults to session_cipher.
+
+    Yields:
+        bytes: The decrypted and decompressed content (might still be encrypted).
+    """
+    chunks = iter(chunks)
+    reader = ChunkReader(chunks)
+    header = read_header(reader)
+    cipher_aes = response_cipher(header.key, header.nonce, header.suite,
+                                 header.mode)
+    content = decrypt_frames(cipher_aes,
+                             iter_frames(reader, header.content_size),
+                             header.content_size)
+    if header.compression != COMPRESSION_NONE:  # Only the innermost layer
+        content = decompress_chunks(header.compression, content)
+    yield from content
+    # The content of an inner layer ends before the end frames of the outer
+    # one, which are read as well so that its end is checked and the node
+    # gets to finish its response
+    for _ in chunks:
+        pass
+
+
+def record(timings, stage, start):
+    """Add the seconds since `start` to a stage of the timings.
+
+    Args:
+        timings (dict|None): Stage -> seconds, nothing is recorded if None.
+        stage (str): The stage.
+        start (float): The `time.perf_counter` the stage started at.
+
+    Returns:
+        float: The current `time.perf_counter`.
+    """
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+def client(service, route, stream=False, circuit=False, timings=None):
     """Starts the wrapping, sending and unwrapping process.
 
-    The package protocol is:
-    |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
-    | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+    The package protocol is (see onion.py):
+    |  1 Byte |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
+    | version | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+
+    With `stream` the package is sent streamed (see onion.py) so that the nodes
+    pass it on frame by frame instead of buffering it as a whole.
+
+    The exit node compresses responses of at least its COMPRESS_MIN_SIZE bytes
+    with a compression of COMPRESSION, which only the client decompresses (see onion.py).
+
+    With `circuit` the package is sent over the circuit of the route (see `Circuit`).
+    Only the first package of a circuit needs the public keys of the nodes,
+    all following ones are encrypted with the session keys of the circuit.
+
+    The public keys of the nodes are fetched at once and cached (see `NodeKeyCache`).
+    If a package of an established circuit or with cached keys fails,
+    the circuit and the keys are created again and the package is sent once more.
+
+    The seconds spent per stage ('key_fetch', 'wrap', 'transit' and 'unwrap')
+    are added to `timings`. A streamed package is wrapped while it is sent
+    and unwrapped while it is received, so 'transit' and 'unwrap' share that time.
 
     Args:
         service (str): Service URL.
         route (List[str]): A list of node URLs like ['first', 'second', 'third'].
+        stream (bool, optional): Use the streamed package format. Defaults to False.
+        circuit (bool, optional): Send the package over a circuit. Defaults to False.
+        timings (dict, optional): Gets the seconds per stage. Defaults to None.
 
     Returns:
         bool, str|dict: Success, Error string on failure | {'result': Response data} else
     """
-    try:
-        # Build up the route with the services address
-        addresses = route
-        addresses.reverse()
-        public_keys = [
-            requests.get(address + '/get-public-key').text
-            for address in addresses
-        ]
-        addresses = [service] + addresses
-        if any(['404 Page not found' in k for k in public_keys]):
-            raise Exception(f'/get-public-key of {addresses} not found')
-        print(
-            f'[{addresses[-1]}] -> [{addresses[-2]}] -> [{addresses[1]}] -> [{addresses[0]}]'
-        )
-        first_address = addresses.pop()
-    except Exception as e:
-        return False, f'[ERROR] Getting public keys from nodes: {str(e)}'
+    # Predefined request
+    content = b'GET / HTTP/1.1\r\nHost: ' + service.encode() + b'\r\n\r\n'
+    status, data = deliver(service, route, content, receive_content, stream,
+                           circuit, timings)
+    if not status:
+        return status, data
+    print(data)
+    return True, {'result': data}
+
+
+def client_streams(services, route, stream=False, circuit=False, timings=None):
+    """Send a GET request to each service as multiplexed streams of a single package.
+
+    The requests share one onion, so the route, the public keys and the
+    connections are only paid once. The exit node sends all requests at once
+    and the responses come back interleaved in the order they arrive (see onion.py).
+    Failed requests fail on their own stream only.
+
+    Args:
+        services (List[str]): Service URLs, one stream each.
+        route (List[str]): A list of node URLs like ['first', 'second', 'third'].
+        stream (bool, optional): Use the streamed package format. Defaults to False.
+        circuit (bool, optional): Send the package over a circuit. Defaults to False.
+        timings (dict, optional): Gets the seconds per stage, see `client`. Defaults to None.
+
+    Returns:
+        bool, str|dict: Success, Error string on failure | {'results': [{'status': bool,
+            'result': Response data} or {'status': False, 'error': Error string} per service]} else
+    """
+    content = encode_mux_requests([('GET', service, b'')
+                                   for service in services])
+    status, data = deliver('mux:0000', route, content,
+                           lambda chunks: receive_streams(chunks, len(services)),
+                           stream, circuit, timings)
+    if not status:
+        return status, data
+    return True, {'results': data}
+
+
+def receive_content(chunks):
+    """Join the unwrapped response of a single request.
+
+    Args:
+        chunks (Iterable[bytes]): The decrypted response.
+
+    Returns:
+        str: The response data.
+    """
+    return b''.join(chunks).decode()
+
+
+def receive_streams(chunks, count):
+    """Demultiplex the unwrapped responses of multiplexed streams.
+    Streamed packages are read frame by frame while the responses arrive.
+
+    Args:
+        chunks (Iterable[bytes]): The decrypted multiplexed content.
+        count (int): Number of streams.
+
+    Returns:
+        List[dict]: {'status': True, 'result': Response data} or
+            {'status': False, 'error': Error string} per stream.
+    """
+    reader = ChunkReader(chunks)
+    if reader.read(len(MUX_MAGIC)) != MUX_MAGIC:
+        raise ValueError('Response is not multiplexed')
+    data = [bytearray() for _ in range(count)]
+    results = [None] * count
+    for stream_id, flags, frame in iter_mux_frames(reader):
+        if not 0 < stream_id <= count:
+            raise ValueError(f'Unknown stream {stream_id}')
+        if flags == MUX_DATA:
+            data[stream_id - 1] += frame
+        elif flags == MUX_ERROR:
+            results[stream_id - 1] = {'status': False, 'error': frame.decode()}
+        else:
+            results[stream_id - 1] = {
+                'status': True,
+                'result': data[stream_id - 1].decode()
+            }
+    return [
+        result or {
+            'status': False,
+            'error': 'Stream ended without a response'
+        } for result in results
+    ]
+
+
+def deliver(service,
+            route,
+            content,
+            receive,
+            stream=False,
+            circuit=False,
+            timings=None):
+    """Send the content and receive the response, over the circuit of the
+    route if asked for, see `client`.
+
+    Args:
+        service (str): The address of the innermost layer.
+        route (List[str]): A list of node URLs like ['first', 'second', 'third'].
+        content (bytes): The innermost content.
+        receive (Callable[[Iterable[bytes]], Any]): Reads the decrypted response.
+        stream (bool, optional): Use the streamed package format. Defaults to False.
+        circuit (bool, optional): Send the package over a circuit. Defaults to False.
+        timings (dict, optional): Gets the seconds per stage, see `client`. Defaults to None.
+
+    Returns:
+        bool, Any: Success, Error string on failure | result of `receive` else
+    """
+    for _ in range(2):
+        onion_circuit = get_circuit(route) if circuit else None
+        established = onion_circuit is not None and onion_circuit.established
+        public_keys, cached = None, False
+        if not established:
+            start = time.perf_counter()
+            try:
+                public_keys, cached = node_keys.get(route)
+            except Exception as e:
+                return False, f'[ERROR] Getting public keys from nodes: {str(e)}'
+            record(timings, 'key_fetch', start)
+        status, msg = send(service, route, content, receive, stream,
+                           onion_circuit, public_keys, timings)
+        if status:
+            if onion_circuit is not None:
+                onion_circuit.established = True
+            break
+        if onion_circuit is not None:
+            drop_circuit(onion_circuit)
+        if public_keys is not None:
+            node_keys.invalidate(route)
+        if not established and not cached:  # Fresh keys failed, retrying does not help
+            break
+    return status, msg
+
+
+def send(service,
+         route,
+         content,
+         receive,
+         stream=False,
+         onion_circuit=None,
+         public_keys=None,
+         timings=None):
+    """Wrap, send and unwrap a single package, see `client`.
+
+    Args:
+        service (str): The address of the innermost layer.
+        route (List[str]): A list of node URLs like ['first', 'second', 'third'].
+        content (bytes): The innermost content.
+        receive (Callable[[Iterable[bytes]], Any]): Reads the decrypted response.
+        stream (bool, optional): Use the streamed package format. Defaults to False.
+        onion_circuit (Circuit, optional): The circuit to send the package over. Defaults to None.
+        public_keys (List[RsaKey|EccKey], optional): The public keys of the nodes,
+            first node first. Only needed outside of established circuits. Defaults to None.
+        timings (dict, optional): Gets the seconds per stage, see `client`. Defaults to None.
+
+    Returns:
+        bool, Any: Success, Error string on failure | result of `receive` else
+    """
+    start = time.perf_counter()
+    # Build up the route with the services address
+    addresses = list(route)
+    addresses.reverse()
+    if public_keys is not None:
+        public_keys = public_keys[::-1]
+    addresses = [service] + addresses
+    print(
+        f'[{addresses[-1]}] -> [{addresses[-2]}] -> [{addresses[1]}] -> [{addresses[0]}]'
+    )
+    first_address = addresses.pop()
 
     try:
         # Create the onion request
-        # Predefined request
-        content = b'GET / HTTP/1.1\r\nHost: ' + service.encode() + b'\r\n\r\n'
+        if onion_circuit is None:
+            layers = onion_layers(public_keys, addresses)
+        else:
+            layers = onion_circuit.layers(addresses, public_keys)
+        # The exit node answers with one of the accepted compressions and
+        # understands zlib, so larger requests are compressed with it
+        accept = compression_mask(compression for compression in COMPRESSION
+                                  if compression in SUPPORTED_COMPRESSIONS)
+        compression = choose_compression(
+            accept & compression_mask([COMPRESSION_ZLIB]), len(content),
+            COMPRESS_MIN_SIZE)
         # Wrap up the content multiple times according to the protocol
-        for i, address in enumerate(addresses):
-            key, nonce, content = encrypt(public_keys[i], content)
-            content = (len(key).to_bytes(4, byteorder='big') +
-                       len(address).to_bytes(4, byteorder='big') +
-                       len(content).to_bytes(4, byteorder='big') + key +
-                       nonce + address.encode() + content)
+        if stream:  # Encrypted lazily while it is sent
+            content = [content]
+            for key, cipher_aes, address, circuit_id, suite in layers:
+                content = wrap_stream(key, cipher_aes, address, content,
+                                      circuit_id, suite, compression, accept)
+                compression, accept = COMPRESSION_NONE, 0  # Only the innermost layer
+        else:
+            content = build_onion(content, layers, compression, accept)
     except Exception as e:
         return False, f'[ERROR] Wrapping up package: {str(e)}'
+    start = record(timings, 'wrap', start)
 
     try:
         # Make the connection
-        response = requests.post(
+        response = http.post(
             url=first_address,
             data=content,
-            headers={'Content-Type': 'application/x-binary'})
+            headers={
+                'Content-Type': STREAM_TYPE if stream else 'application/x-binary'
+            },
+            stream=stream)
     except Exception as e:
         return False, f'[ERROR] Making request to first node: {str(e)}'
+    start = record(timings, 'transit', start)
 
     try:
-        # Wait for the response and unwrap it
-        data = response.content
-        for i in range(len(addresses)):
-            enc_key, nonce, data = parse_package(data)
-            data = decrypt(enc_key, nonce, data)
-        print(data.decode())
+        # Wait for the response and unwrap it, the first node first
+        if onion_circuit is None:
+            ciphers = [session_cipher] * len(addresses)
+        else:
+            ciphers = [
+                lambda enc_key, nonce, suite, mode, hop=hop: onion_circuit.
+                response_cipher(hop, enc_key, nonce, suite, mode)
+                for hop in range(len(addresses))
+            ]
+        if stream:
+            if not response.headers.get('Content-Type',
+                                        '').startswith(STREAM_TYPE):
+                raise Exception(response.text)
+            data = response.iter_content(CHUNK_SIZE)
+            for response_cipher in ciphers:
+                data = unwrap_stream(data, response_cipher)
+            result = receive(data)
+        else:
+            data = response.content
+            for response_cipher in ciphers:
+                if data.startswith(b'Error: '):  # Failed at the previous node
+                    raise Exception(data.decode())
+                enc_key, nonce, data, suite, mode, compression = parse_package(
+                    data)
+                data = response_cipher(enc_key, nonce, suite,
+                                       mode).decrypt(data)
+                if compression != COMPRESSION_NONE:  # Only the innermost layer
+                    data = decompress(compression, data)
+            result = receive([data])
     except Exception as e:
         return False, f'[ERROR] Encryption of package: {str(e)}'
+    record(timings, 'unwrap', start)
 
-    return True, {'result': data.decode()}
+    return True, result
 
 
 @app.route('/')
@@ -168,7 +720,7 @@ def index():
     The web interface asks the directory node for a route.
     """
     if not os.path.exists('public.pem'):
-        generate_rsa_key()
+        generate_key()
     public_key = open('public.pem').read()
     return render_template('index.html', public_key=public_key)
 
@@ -180,13 +732,39 @@ def start_client():
     to send the wrapped package to the service.
 
     Expects a POST request with {'service': service_url, 'route': ['first', 'second', 'third']}
+    and optionally 'stream': true to send a streamed package
+    and 'circuit': true to send it over the circuit of the route.
+    With 'streams': n the service is requested n times over multiplexed streams
+    of a single package (see `client_streams`).
+
+    With 'directory': directory_url the node keys are taken out of the signed
+    'document' (the response of /route, which then also gives the route)
+    or the key document of the directory node instead of asking every node.
     """
     service = request.json['service']
-    route = request.json['route']
-    if not service or not route:
+    route = request.json.get('route')
+    stream = bool(request.json.get('stream', False))
+    circuit = bool(request.json.get('circuit', False))
+    streams = int(request.json.get('streams', 0))
+    directory = request.json.get('directory')
+    document = request.json.get('document')
+    error = None
+    try:
+        if directory and document:
+            route = directory_keys.load_route(directory, document)
+        elif directory:
+            directory_keys.refresh(directory)
+    except Exception as e:
+        error = f'[ERROR] Getting public keys from the directory node: {str(e)}'
+    if error:
+        status, msg = False, error
+    elif not service or not route:
         status, msg = False, 'Service URL and route have to be given as URL parameters'
+    elif streams > 0:
+        status, msg = client_streams([service] * streams, route, stream,
+                                     circuit)
     else:
-        status, msg = client(service, route)
+        status, msg = client(service, route, stream, circuit)
     result = {'status': status}
     if status:
         result['data'] = msg
@@ -195,5 +773,15 @@ def start_client():
     return jsonify(result)
 
 
+@app.route('/info', methods=['GET'])
+def info():
+    """Show the connection reuse of the keep-alive pools and the key caches."""
+    return jsonify({
+        'http_pool': http.stats(),
+        'node_keys': node_keys.stats(),
+        'directory_keys': directory_keys.stats()
+    })
+
+
 if __name__ == '__main__':
     app.run(debug=True, host="0.0.0.0", port=os.getenv('PORT', 8080))
@@ -0,0 +1,157 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    """Keep-alive `requests` sessions, one per destination.
+
+    Every destination (scheme, host and port) gets its own session with a
+    connection pool so that consecutive requests to the same host reuse the
+    TCP (and TLS) connection. The sessions are shared between all threads.
+    Sessions without requests for `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, pool_size=16, idle_timeout=60.0):
+        """
+        Args:
+            pool_size (int, optional): Maximum connections kept per destination. Defaults to 16.
+            idle_timeout (float, optional): Seconds after which an unused destination
+                is evicted. Defaults to 60.
+        """
+        self.pool_size = max(1, pool_size)
+        self.idle_timeout = idle_timeout
+        self.requests = 0
+        self.evictions = 0
+        self._evicted_connections = 0
+        self._sessions = {}  # destination -> [session, last used, in flight]
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def destination(url):
+        """Return the destination key of an URL.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            str: scheme://host:port
+        """
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}'
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _connection_pools(session):
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    def _sweep(self, now):
+        """Close the sessions that were idle for too long. Expects the lock to be held."""
+        self._last_sweep = now
+        for destination, entry in list(self._sessions.items()):
+            session, last_used, in_flight = entry
+            if in_flight == 0 and now - last_used > self.idle_timeout:
+                self._evicted_connections += sum(
+                    pool.num_connections
+                    for pool in self._connection_pools(session))
+                session.close()
+                del self._sessions[destination]
+                self.evictions += 1
+
+    def request(self, method, url, **kwargs):
+        """Send a request over the pooled session of the destination.
+        Takes the same arguments as `requests.request`.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL.
+
+        Returns:
+            requests.Response: The response, with stream=True it has to be closed.
+        """
+        destination = self.destination(url)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > self.idle_timeout / 2:
+                self._sweep(now)
+            entry = self._sessions.get(destination)
+            if entry is None:
+                entry = self._sessions[destination] = [
+                    self._new_session(), now, 0
+                ]
+            entry[1] = now
+            entry[2] += 1
+            self.requests += 1
+        try:
+            response = entry[0].request(method, url, **kwargs)
+        except BaseException:
+            self._release(entry)
+            raise
+        if not kwargs.get('stream'):
+            self._release(entry)
+            return response
+        # The body is still read over the session, which stays in flight until
+        # the response is closed
+        close = response.close
+        closed = False
+
+        def close_and_release():
+            nonlocal closed
+            try:
+                close()
+            finally:
+                if not closed:
+                    closed = True
+                    self._release(entry)
+
+        response.close = close_and_release
+        return response
+
+    def _release(self, entry):
+        with self._lock:
+            entry[1] = time.monotonic()
+            entry[2] -= 1
+
+    def get(self, url, **kwargs):
+        """Send a GET request, see `request`."""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Send a POST request, see `request`."""
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Return the connection reuse counters.
+
+        Returns:
+            dict: Destinations, requests, opened connections and the reuse rate.
+        """
+        with self._lock:
+            sessions = [entry[0] for entry in self._sessions.values()]
+            connections = self._evicted_connections
+            evictions = self.evictions
+            total = self.requests
+        connections += sum(pool.num_connections for session in sessions
+                           for pool in self._connection_pools(session))
+        return {
+            'destinations': len(sessions),
+            'requests': total,
+            'connections': connections,
+            'evictions': evictions,
+            'reuse_rate': round(1 - connections / total, 4) if total else 0.0
+        }
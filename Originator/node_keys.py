@@ -0,0 +1,255 @@
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+from onion import import_key
+
+
+class NodeKeyCache:
+    """Bounded cache of the parsed public keys of the nodes, by node URL.
+
+    Missing keys of a route are fetched concurrently, so setting up a route
+    costs a single round trip instead of one per node. A node replaces its
+    key pair whenever a key is asked for, but still decrypts with the
+    previous generations for a while, so cached keys are only kept for `ttl`
+    seconds and are dropped with `invalidate` once a package wrapped with
+    them fails.
+    """
+
+    def __init__(self, fetch, ttl=60.0, max_size=256, workers=8):
+        """
+        Args:
+            fetch (Callable[[str], str]): Returns the PEM encoded public key of a node URL.
+            ttl (float, optional): Seconds a key is used after it was fetched. Defaults to 60.
+            max_size (int, optional): Maximum number of cached keys. Defaults to 256.
+            workers (int, optional): Maximum number of keys fetched at once. Defaults to 8.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._keys = OrderedDict()  # node URL -> (key, fetched at)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                            thread_name_prefix='node-keys')
+        self._lock = threading.Lock()
+
+    def _fetch(self, url):
+        return import_key(self.fetch(url))
+
+    def get(self, urls):
+        """Return the public keys of the nodes, fetching the missing ones at once.
+
+        Args:
+            urls (List[str]): The node URLs.
+
+        Returns:
+            List[RsaKey|EccKey], bool: The keys in the order of the URLs
+                and whether all of them came out of the cache.
+        """
+        now = time.monotonic()
+        keys = {}
+        with self._lock:
+            for url in urls:
+                entry = self._keys.get(url)
+                if entry is not None and now - entry[1] <= self.ttl:
+                    self._keys.move_to_end(url)
+                    keys[url] = entry[0]
+            missing = [url for url in dict.fromkeys(urls) if url not in keys]
+            self.hits += len(urls) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            fetched = list(self._executor.map(self._fetch, missing))
+            now = time.monotonic()
+            with self._lock:
+                for url, key in zip(missing, fetched):
+                    keys[url] = key
+                    self._keys[url] = (key, now)
+                    self._keys.move_to_end(url)
+                while len(self._keys) > self.max_size:
+                    self._keys.popitem(last=False)
+        return [keys[url] for url in urls], not missing
+
+    def put(self, keys):
+        """Store keys which were not fetched from the nodes themselves,
+        such as the keys of a route document of the directory node.
+
+        Args:
+            keys (Dict[str, str]): Node URL -> PEM encoded public key.
+        """
+        parsed = {url: import_key(key) for url, key in keys.items()}
+        now = time.monotonic()
+        with self._lock:
+            for url, key in parsed.items():
+                self._keys[url] = (key, now)
+                self._keys.move_to_end(url)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def invalidate(self, urls):
+        """Drop the keys of the nodes so that they are fetched again.
+
+        Args:
+            urls (List[str]): The node URLs.
+        """
+        with self._lock:
+            for url in urls:
+                if self._keys.pop(url, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        """Return the cache counters.
+
+        Returns:
+            dict: Size, hits, misses and invalidations of the cache.
+        """
+        return {
+            'size': len(self._keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+
+class DirectoryKeys:
+    """Loads the node keys the directory nodes publish into a NodeKeyCache.
+
+    The route and key documents of a directory node are signed with its
+    RSA key, which is either pinned or trusted on first use, that is
+    fetched once from `/signing-key`.
+    The key document of `/keys` is fetched conditionally with its ETag, so an
+    unchanged document costs a 304 without a body.
+    """
+
+    def __init__(self, node_keys, http, pinned=None):
+        """
+        Args:
+            node_keys (NodeKeyCache): Gets the verified keys.
+            http (SessionPool): Connections to the directory nodes.
+            pinned (str, optional): PEM encoded public key all documents have to be
+                signed with. Defaults to None.
+        """
+        self.node_keys = node_keys
+        self.http = http
+        self.pinned = RSA.import_key(pinned) if pinned else None
+        self.documents = 0
+        self.not_modified = 0
+        self._signing_keys = {}  # directory URL -> public key
+        self._key_documents = {}  # directory URL -> (ETag, node keys)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def canonical(document):
+        """Return the bytes a document is signed over, see DirectoryNode/key_directory.py.
+
+        Args:
+            document (dict): The document.
+
+        Returns:
+            bytes: The sorted, compact JSON of the document without its signature.
+        """
+        return json.dumps({
+            key: value
+            for key, value in document.items() if key != 'signature'
+        },
+                          sort_keys=True,
+                          separators=(',', ':')).encode()
+
+    def signing_key(self, directory):
+        """Return the key the documents of a directory node are signed with.
+
+        Args:
+            directory (str): The directory node URL.
+
+        Returns:
+            Crypto.PublicKey.RSA.RsaKey: The public key.
+        """
+        if self.pinned is not None:
+            return self.pinned
+        with self._lock:
+            key = self._signing_keys.get(directory)
+        if key is None:
+            response = self.http.get(directory + '/signing-key', timeout=10)
+            response.raise_for_status()
+            key = RSA.import_key(response.text)
+            with self._lock:
+                self._signing_keys[directory] = key
+        return key
+
+    def verify(self, directory, document):
+        """Check the signature of a document of a directory node.
+
+        Args:
+            directory (str): The directory node URL.
+            document (dict): The document.
+        """
+        try:
+            signature = base64.b64decode(document['signature'])
+            pkcs1_15.new(self.signing_key(directory)).verify(
+                SHA256.new(self.canonical(document)), signature)
+        except (KeyError, ValueError, TypeError):
+            raise ValueError(
+                f'The document is not signed by the directory node {directory}'
+            ) from None
+
+    def load_route(self, directory, document):
+        """Verify a route document of `/route` and cache the keys of its nodes.
+
+        Args:
+            directory (str): The directory node URL.
+            document (dict): The route document.
+
+        Returns:
+            List[str]: The node URLs of the route.
+        """
+        self.verify(directory, document)
+        self.node_keys.put(document.get('keys', {}))
+        self.documents += 1
+        return document['route']
+
+    def refresh(self, directory):
+        """Fetch the key document of `/keys` unless it did not change
+        and cache the keys of all nodes. The keys of an unchanged document
+        are cached again.
+
+        Args:
+            directory (str): The directory node URL.
+
+        Returns:
+            bool: Whether a new document was loaded.
+        """
+        with self._lock:
+            etag, keys = self._key_documents.get(directory, (None, None))
+        response = self.http.get(
+            directory + '/keys',
+            headers={'If-None-Match': f'"{etag}"'} if etag else {},
+            timeout=10)
+        if response.status_code == 304:
+            self.not_modified += 1
+            self.node_keys.put(keys)
+            return False
+        response.raise_for_status()
+        document = response.json()
+        self.verify(directory, document)
+        self.node_keys.put(document['nodes'])
+        self.documents += 1
+        with self._lock:
+            self._key_documents[directory] = (response.headers.get(
+                'ETag', '').strip('"'), document['nodes'])
+        return True
+
+    def stats(self):
+        """Return the document counters.
+
+        Returns:
+            dict: Loaded and unchanged documents.
+        """
+        return {'documents': self.documents, 'not_modified': self.not_modified}
@@ -0,0 +1,1282 @@
+"""Encoding and decoding of the onion packages.
+
+Every package follows this protocol:
+|  1 Byte |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
+| version | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+
+Packages of a circuit use version 2, which adds the circuit id of the hop:
+|  1 Byte |  16 Bytes  |    4 Bytes   |      4 Bytes     |      4 Bytes     | ks Bytes | 16 Bytes  |    as Bytes    |  cs Bytes  |
+| version | circuit id | keySize (ks) | addressSize (as) | contentSize (cs) | AES key  | AES nonce |  next address  |  content   |
+The first package of a circuit carries the wrapped session key of the hop,
+later packages leave the key empty (ks = 0) and the node uses the session key
+it stored for the circuit id (see `derive_circuit_keys`).
+
+The AES key is wrapped for the public key of the receiver with a key suite.
+Versions 1 and 2 use SUITE_RSA (RSA-OAEP, ks = 256 for 2048 bit keys), versions
+3 and 4 are versions 1 and 2 with the suite after the version byte:
+|  1 Byte |  1 Byte |    4 Bytes   | ...        |  1 Byte |  1 Byte |  16 Bytes  | ...
+| version |  suite  | keySize (ks) | ...        | version |  suite  | circuit id | ...
+SUITE_X25519 wraps the AES key with an X25519 key agreement between a fresh
+ephemeral key and the key of the receiver (see `X25519Cipher`, ks = 80).
+The key agreement runs in the `cryptography` package if it is installed,
+otherwise in pycryptodome, which is about 15x slower at it.
+`key_cipher` returns the suite and the wrapping cipher of either kind of key.
+
+The content of a layer is encrypted with a content mode (see `LayerCipher`).
+Versions 1 to 4 use MODE_EAX (AES-EAX without a tag), versions 5 and 6 are
+versions 3 and 4 with the mode after the suite byte:
+|  1 Byte |  1 Byte |  1 Byte |    4 Bytes   | ...        |  1 Byte |  1 Byte |  1 Byte |  16 Bytes  | ...
+| version |  suite  |  mode   | keySize (ks) | ...        | version |  suite  |  mode   | circuit id | ...
+The AEAD modes MODE_GCM and MODE_CHACHA20 (ChaCha20-Poly1305) append a
+16 byte tag to the content, which every hop verifies before it passes the
+content on, so a corrupted package is rejected at the next hop.
+
+The innermost content may be compressed before it is encrypted (see
+`Compressor`). Versions 7 and 8 are versions 5 and 6 with a compression
+byte after the mode, whose low 4 bits name the compression of the content
+of the layer and whose high 4 bits are the mask (`compression_mask`) of the
+compressions the sender accepts for the response:
+|  1 Byte |  1 Byte |  1 Byte |    1 Byte   |    4 Bytes   | ...
+| version |  suite  |  mode   | compression | keySize (ks) | ...
+Only the header of the innermost layer carries it, so only the exit node
+and the client compress and decompress. The exit node compresses a
+response of at least COMPRESS_MIN_SIZE bytes with a compression the client
+accepts (`choose_compression`). COMPRESSION_ZLIB is always available,
+COMPRESSION_ZSTD only with the optional `zstandard` package.
+
+Decoding does not copy the content, it is returned as a memoryview into the
+received buffer. Encoding copies every field exactly once, either into a new
+package or into a preallocated buffer (`encode_into`).
+
+A streamed package sets its contentSize to STREAM_SIZE
+and the content follows as frames:
+|     4 Bytes     |  fs Bytes  |     |   4 Bytes  |
+| frameSize (fs)  |  content   | ... |      0     |
+Every frame is encrypted with the same AES cipher, one after another,
+so the content can be decrypted and forwarded while it is still arriving.
+With an AEAD mode every frame carries its own tag and a frame of only a tag
+precedes the end frame, so a stream which was cut short is rejected as well.
+`AsyncChunkReader`, `aread_header` and `aiter_frames` read streams of asyncio servers.
+
+The innermost content may carry several streams at once. It then starts with
+MUX_MAGIC and is followed by stream frames, the streams are interleaved:
+| 4 Bytes  | 1 Byte |   4 Bytes   |  ds Bytes  |
+| streamId | flags  | dataSize ds |    data    |
+A stream ends with a MUX_END (or MUX_ERROR) frame and the content ends
+with a MUX_END frame of stream 0. The data of a request stream is
+`METHOD URL\r\n\r\nbody`, the exit node sends all requests at once and
+returns the responses as the same kind of stream frames in the order they arrive.
+
+Keep this file identical in IntermediateNode/ and Originator/.
+"""
+import struct
+import zlib
+from collections import namedtuple
+
+from Crypto.Cipher import AES, PKCS1_OAEP, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Random import get_random_bytes
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey, X25519PublicKey)
+except ImportError:  # pycryptodome does the same key agreement, only slower
+    X25519PrivateKey = X25519PublicKey = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always there
+    zstandard = None
+DECOMPRESS_ERRORS = (zlib.error, ) + ((zstandard.ZstdError, ) if zstandard else
+                                      ())
+
+HEADERS = {
+    1: struct.Struct('!BIII'),  # version, keySize, addressSize, contentSize
+    2: struct.Struct('!B16sIII'),  # version, circuit id, keySize, addressSize, contentSize
+    3: struct.Struct('!BBIII'),  # version, suite, keySize, addressSize, contentSize
+    4: struct.Struct('!BB16sIII'),  # version, suite, circuit id, keySize, addressSize, contentSize
+    5: struct.Struct('!BBBIII'),  # version, suite, mode, keySize, addressSize, contentSize
+    6: struct.Struct('!BBB16sIII'),  # version, suite, mode, circuit id, keySize, addressSize, contentSize
+    7: struct.Struct('!BBBBIII'),  # version, suite, mode, compression, keySize, addressSize, contentSize
+    8: struct.Struct('!BBBB16sIII'),  # version, suite, mode, compression, circuit id, keySize, addressSize, contentSize
+}
+HEADER_V1 = HEADERS[1]
+FRAME = struct.Struct('!I')  # frameSize
+NONCE_SIZE = 16
+CIRCUIT_ID_SIZE = 16
+
+STREAM_TYPE = 'application/x-onion-stream'
+STREAM_SIZE = 0xFFFFFFFF
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 1024 * 1024
+
+MUX_MAGIC = b'\x00MUX'
+MUX_FRAME = struct.Struct('!IBI')  # stream id, flags, dataSize
+MUX_DATA = 0
+MUX_END = 1
+MUX_ERROR = 2
+
+SUITE_RSA = 1
+SUITE_X25519 = 2
+SUITES = {'rsa': SUITE_RSA, 'x25519': SUITE_X25519}
+X25519_KEY_SIZE = 32
+TAG_SIZE = 16
+
+MODE_EAX = 0
+MODE_GCM = 1
+MODE_CHACHA20 = 2
+MODES = {'eax': MODE_EAX, 'gcm': MODE_GCM, 'chacha20': MODE_CHACHA20}
+FRAME_NONCE_SIZE = 12
+END_FRAME_DATA = b'onion end'
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {
+    'none': COMPRESSION_NONE,
+    'zlib': COMPRESSION_ZLIB,
+    'zstd': COMPRESSION_ZSTD
+}
+# Preferred first, zstd compresses faster than zlib at a similar ratio
+SUPPORTED_COMPRESSIONS = ((COMPRESSION_ZSTD, ) if zstandard else
+                          ()) + (COMPRESSION_ZLIB, )
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESS_MIN_SIZE = 1024
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+# A zstd block holds up to 128 KiB in as few as 4 bytes (a header and one RLE byte)
+ZSTD_MAX_EXPANSION = 32 * 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', '+json', '+xml')
+
+Header = namedtuple('Header', [
+    'key', 'nonce', 'address', 'content_size', 'circuit', 'suite', 'mode',
+    'compression', 'accept'
+],
+                    defaults=(SUITE_RSA, MODE_EAX, COMPRESSION_NONE, 0))
+Header.__doc__ = """A decoded package header.
+
+Args:
+    key (bytes): The encrypted AES key, empty if the session key of the circuit is used.
+    nonce (bytes): The AES nonce.
+    address (str): The next address.
+    content_size (int): Size of the content or STREAM_SIZE.
+    circuit (bytes|None): The circuit id, None if the package is not part of a circuit.
+    suite (int): The key suite the AES key is wrapped with.
+    mode (int): The content mode.
+    compression (int): The compression of the content.
+    accept (int): The mask of the compressions accepted for the response.
+"""
+
+Package = namedtuple('Package', [
+    'key', 'nonce', 'address', 'content', 'circuit', 'suite', 'mode',
+    'compression', 'accept'
+],
+                     defaults=(SUITE_RSA, MODE_EAX, COMPRESSION_NONE, 0))
+Package.__doc__ = """A decoded package.
+
+Args:
+    key (bytes): The encrypted AES key, empty if the session key of the circuit is used.
+    nonce (bytes): The AES nonce.
+    address (str): The next address.
+    content (memoryview): The encrypted content, a view into the received data.
+    circuit (bytes|None): The circuit id, None if the package is not part of a circuit.
+    suite (int): The key suite the AES key is wrapped with.
+    mode (int): The content mode.
+    compression (int): The compression of the content.
+    accept (int): The mask of the compressions accepted for the response.
+"""
+
+
+def derive_circuit_keys(session_key):
+    """Derive the keys of both directions of a circuit hop from its session key.
+
+    Args:
+        session_key (bytes): The session key sent in the first package of the circuit.
+
+    Returns:
+        bytes, bytes: The AES key towards the service, the AES key towards the client
+    """
+    return HKDF(session_key, 32, b'', SHA256, 2, context=b'onion circuit')
+
+
+class X25519Cipher:
+    """Wraps AES keys for an X25519 key, with the interface of a PKCS1_OAEP cipher.
+
+    Every wrapped key is the public key of a fresh ephemeral X25519 key
+    followed by the AES key encrypted with AES-EAX under a key derived
+    (HKDF-SHA256) from the shared secret of the ephemeral key and the key of
+    the receiver. The derived key is used only once, so the nonce is fixed.
+    A wrapped key which does not belong to the key fails its tag check.
+    """
+
+    def __init__(self, key):
+        """
+        Args:
+            key (Crypto.PublicKey.ECC.EccKey): The Curve25519 key, a private key to unwrap.
+        """
+        self._key = key
+        self._public_key = key.public_key()
+        self._public_bytes = self._public_key.export_key(format='raw')
+        if X25519PrivateKey is not None:
+            self._fast_public_key = X25519PublicKey.from_public_bytes(
+                self._public_bytes)
+            self._fast_key = (X25519PrivateKey.from_private_bytes(key.seed)
+                              if key.has_private() else None)
+
+    def _kek(self, ephemeral_bytes, secret):
+        return HKDF(secret,
+                    32,
+                    ephemeral_bytes + self._public_bytes,
+                    SHA256,
+                    context=b'onion x25519')
+
+    def encrypt(self, session_key):
+        """Wrap an AES key.
+
+        Args:
+            session_key (bytes): The AES key.
+
+        Returns:
+            bytes: The ephemeral public key, the encrypted AES key and its tag.
+        """
+        if X25519PrivateKey is not None:
+            ephemeral = X25519PrivateKey.generate()
+            ephemeral_bytes = ephemeral.public_key().public_bytes_raw()
+            secret = ephemeral.exchange(self._fast_public_key)
+        else:
+            ephemeral = ECC.generate(curve='Curve25519')
+            ephemeral_bytes = ephemeral.public_key().export_key(format='raw')
+            secret = key_agreement(eph_priv=ephemeral,
+                                   static_pub=self._public_key,
+                                   kdf=lambda secret: secret)
+        enc_key, tag = AES.new(self._kek(ephemeral_bytes, secret),
+                               AES.MODE_EAX,
+                               nonce=bytes(NONCE_SIZE)).encrypt_and_digest(
+                                   session_key)
+        return ephemeral_bytes + enc_key + tag
+
+    def decrypt(self, enc_key):
+        """Unwrap an AES key.
+
+        Args:
+            enc_key (bytes): The wrapped AES key.
+
+        Returns:
+            bytes: The AES key.
+        """
+        if not self._key.has_private():
+            raise TypeError('This is not a private key')
+        if len(enc_key) <= X25519_KEY_SIZE + TAG_SIZE:
+            raise ValueError(f'Wrapped key of {len(enc_key)} bytes is too short')
+        ephemeral_bytes = bytes(enc_key[:X25519_KEY_SIZE])
+        if X25519PrivateKey is not None:
+            secret = self._fast_key.exchange(
+                X25519PublicKey.from_public_bytes(ephemeral_bytes))
+        else:
+            secret = key_agreement(
+                static_priv=self._key,
+                eph_pub=import_x25519_public_key(ephemeral_bytes),
+                kdf=lambda secret: secret)
+        return AES.new(self._kek(ephemeral_bytes, secret),
+                       AES.MODE_EAX,
+                       nonce=bytes(NONCE_SIZE)).decrypt_and_verify(
+                           enc_key[X25519_KEY_SIZE:-TAG_SIZE],
+                           enc_key[-TAG_SIZE:])
+
+def new_key(suite, bits=2048):
+    """Generate a private key of a key suite.
+
+    Args:
+        suite (int): SUITE_RSA or SUITE_X25519.
+        bits (int, optional): Size of RSA keys. Defaults to 2048.
+
+    Returns:
+        Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey: The private key.
+    """
+    if suite == SUITE_X25519:
+        return ECC.generate(curve='Curve25519')
+    if suite == SUITE_RSA:
+        return RSA.generate(bits)
+    raise ValueError(f'Unsupported key suite {suite}')
+
+
+def import_key(data):
+    """Parse a PEM encoded RSA or X25519 key.
+
+    Args:
+        data (str|bytes): The key.
+
+    Returns:
+        Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey: The key.
+    """
+    try:
+        return RSA.import_key(data)
+    except ValueError:
+        return ECC.import_key(data)
+
+
+def export_key(key, private=False):
+    """Encode a key as PEM.
+
+    Args:
+        key (Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey): The key.
+        private (bool, optional): Export the private key instead of the public key.
+            Defaults to False.
+
+    Returns:
+        bytes: The PEM encoded key.
+    """
+    if isinstance(key, RSA.RsaKey):
+        return (key if private else key.publickey()).export_key()
+    return (key if private else key.public_key()).export_key(
+        format='PEM').encode()
+
+
+def key_cipher(key):
+    """Return the suite of a key and the cipher which wraps AES keys for it.
+
+    Args:
+        key (Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey): The key,
+            a private key to unwrap.
+
+    Returns:
+        int, PKCS1_OAEP|X25519Cipher: The suite and the cipher.
+    """
+    if isinstance(key, RSA.RsaKey):
+        return SUITE_RSA, PKCS1_OAEP.new(key)
+    if isinstance(key, ECC.EccKey) and key.curve == 'Curve25519':
+        return SUITE_X25519, X25519Cipher(key)
+    raise ValueError(f'Unsupported key {key}')
+
+
+class LayerCipher:
+    """Encrypts or decrypts the content of a layer with a content mode.
+
+    MODE_EAX encrypts the content, or all frames of a stream one after
+    another, as a single AES-EAX stream without a tag. The AEAD modes seal
+    every frame on its own, the content of a buffered package is a single
+    frame. Frame i is sealed with the first FRAME_NONCE_SIZE bytes of the
+    nonce plus i, so frames cannot be dropped or reordered, and the frame
+    which ends a stream (`end`) is a tag over END_FRAME_DATA.
+    A frame which fails its tag check raises a ValueError.
+    """
+
+    def __init__(self, key, mode=MODE_EAX, nonce=None):
+        """
+        Args:
+            key (bytes): The AES key, also the ChaCha20 key.
+            mode (int, optional): The content mode. Defaults to MODE_EAX.
+            nonce (bytes, optional): The nonce of the header, a random one if None.
+                Defaults to None.
+        """
+        if mode not in MODES.values():
+            raise ValueError(f'Unsupported content mode {mode}')
+        self.mode = mode
+        self.nonce = get_random_bytes(NONCE_SIZE) if nonce is None else bytes(
+            nonce)
+        self.overhead = 0 if mode == MODE_EAX else TAG_SIZE
+        self._key = key
+        self._frames = 0
+        self._ended = False
+        self._eax = AES.new(key, AES.MODE_EAX,
+                            self.nonce) if mode == MODE_EAX else None
+
+    def _frame_cipher(self):
+        if self._ended:
+            raise ValueError('Frame after the end of the stream')
+        base = int.from_bytes(self.nonce[:FRAME_NONCE_SIZE], 'big')
+        nonce = ((base + self._frames) %
+                 (1 << 8 * FRAME_NONCE_SIZE)).to_bytes(FRAME_NONCE_SIZE, 'big')
+        self._frames += 1
+        if self.mode == MODE_GCM:
+            return AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        return ChaCha20_Poly1305.new(key=self._key, nonce=nonce)
+
+    def encrypt(self, data):
+        """Encrypt the content of a buffered package or the next frame of a stream.
+
+        Args:
+            data (bytes): The plain data, not empty inside of a stream.
+
+        Returns:
+            bytes: The encrypted data followed by its tag.
+        """
+        if self._eax is not None:
+            return self._eax.encrypt(data)
+        enc_data, tag = self._frame_cipher().encrypt_and_digest(data)
+        return enc_data + tag
+
+    def encrypt_into(self, buffer):
+        """Encrypt the content of a buffered package in place.
+
+        Args:
+            buffer (bytearray|memoryview): The plain content.
+
+        Returns:
+            bytes: The tag which has to follow the content, empty for MODE_EAX.
+        """
+        if self._eax is not None:
+            self._eax.encrypt(buffer, output=buffer)
+            return b''
+        cipher = self._frame_cipher()
+        cipher.encrypt(buffer, output=buffer)
+        return cipher.digest()
+
+    def decrypt(self, data):
+        """Decrypt and verify the content of a buffered package or the next frame of a stream.
+
+        Args:
+            data (bytes|memoryview): The encrypted data followed by its tag.
+
+        Returns:
+            bytes: The plain data.
+        """
+        if self._eax is not None:
+            return self._eax.decrypt(data)
+        if len(data) < TAG_SIZE:
+            raise ValueError(f'Content of {len(data)} bytes is shorter than its tag')
+        try:
+            return self._frame_cipher().decrypt_and_verify(
+                data[:-TAG_SIZE], data[-TAG_SIZE:])
+        except ValueError:
+            raise ValueError('The content failed its tag check') from None
+
+    def end(self):
+        """Return the frame which ends a stream.
+
+        Returns:
+            bytes: The tag of the end, empty for MODE_EAX which has no such frame.
+        """
+        if self._eax is not None:
+            return b''
+        cipher = self._frame_cipher()
+        cipher.update(END_FRAME_DATA)
+        self._ended = True
+        return cipher.digest()
+
+    def decrypt_frame(self, frame):
+        """Decrypt and verify the next frame of a stream, see `decrypt`.
+
+        Args:
+            frame (bytes): The frame content.
+
+        Returns:
+            bytes: The plain data, empty for the frame which ends the stream.
+        """
+        if self._eax is not None or len(frame) != TAG_SIZE:
+            return self.decrypt(frame)
+        cipher = self._frame_cipher()
+        cipher.update(END_FRAME_DATA)
+        try:
+            cipher.verify(frame)
+        except ValueError:
+            raise ValueError('The end of the stream failed its tag check') from None
+        self._ended = True
+        return b''
+
+    def check_end(self):
+        """Make sure that the frame which ends the stream was received."""
+        if self._eax is None and not self._ended:
+            raise ValueError('The stream was cut short')
+
+
+def compression_mask(compressions):
+    """Return the mask of compressions sent in a header as the accepted ones.
+
+    Args:
+        compressions (Iterable[int]): The compressions, COMPRESSION_NONE is ignored.
+
+    Returns:
+        int: The mask, 0 if no compression is accepted.
+    """
+    mask = 0
+    for compression in compressions:
+        if compression != COMPRESSION_NONE:
+            mask |= 1 << compression
+    return mask
+
+
+def compressible(content_type):
+    """Return whether content of a content type is worth compressing.
+    Images, archives and the like are already compressed.
+
+    Args:
+        content_type (str|None): The Content-Type of a response, None if unknown.
+
+    Returns:
+        bool: True for text, JSON, XML and unknown content.
+    """
+    if not content_type:
+        return True
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES[0]) or any(
+        content_type.endswith(suffix) for suffix in COMPRESSIBLE_TYPES[1:])
+
+
+def choose_compression(accept, size=None, min_size=COMPRESS_MIN_SIZE):
+    """Choose the compression of a response.
+
+    Args:
+        accept (int): The mask of the compressions the receiver accepts.
+        size (int, optional): Size of the content, None if unknown (streams). Defaults to None.
+        min_size (int, optional): Smaller content is not compressed. Defaults to COMPRESS_MIN_SIZE.
+
+    Returns:
+        int: The preferred supported compression out of the accepted ones,
+            COMPRESSION_NONE if there is none or the content is too small.
+    """
+    if size is not None and size < min_size:
+        return COMPRESSION_NONE
+    for compression in SUPPORTED_COMPRESSIONS:
+        if accept & (1 << compression):
+            return compression
+    return COMPRESSION_NONE
+
+
+class Compressor:
+    """Compresses content chunk by chunk.
+    Every chunk is flushed, so the receiver can decompress it once it arrives.
+    """
+
+    def __init__(self, compression):
+        """
+        Args:
+            compression (int): COMPRESSION_ZLIB or COMPRESSION_ZSTD.
+        """
+        if compression == COMPRESSION_ZLIB:
+            self._compressor = zlib.compressobj(ZLIB_LEVEL)
+            self._flush = zlib.Z_SYNC_FLUSH
+        elif compression == COMPRESSION_ZSTD and zstandard is not None:
+            self._compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL).compressobj()
+            self._flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError(f'Unsupported compression {compression}')
+        self.compression = compression
+
+    def compress(self, data):
+        """Compress a chunk.
+
+        Args:
+            data (bytes): The chunk.
+
+        Returns:
+            bytes: The compressed chunk.
+        """
+        return self._compressor.compress(data) + self._compressor.flush(
+            self._flush)
+
+    def finish(self, data=b''):
+        """Compress the last chunk and end the compressed content.
+
+        Args:
+            data (bytes, optional): The last chunk. Defaults to b''.
+
+        Returns:
+            bytes: The rest of the compressed content.
+        """
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class Decompressor:
+    """Decompresses content chunk by chunk, see `Compressor`."""
+
+    def __init__(self, compression, max_size=MAX_DECOMPRESSED_SIZE):
+        """
+        Args:
+            compression (int): COMPRESSION_ZLIB or COMPRESSION_ZSTD.
+            max_size (int, optional): Content which is larger once decompressed
+                is rejected. Defaults to MAX_DECOMPRESSED_SIZE.
+        """
+        if compression == COMPRESSION_ZLIB:
+            self._decompressor = zlib.decompressobj()
+        elif compression == COMPRESSION_ZSTD and zstandard is not None:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise ValueError(f'Unsupported compression {compression}')
+        self.compression = compression
+        self.max_size = max_size
+        self.size = 0
+
+    def decompress(self, data):
+        """Decompress a chunk.
+
+        Args:
+            data (bytes): The compressed chunk.
+
+        Raises:
+            ValueError: The chunk is corrupt, follows the end of the content or
+                the content exceeds max_size.
+
+        Returns:
+            bytes: The decompressed data, might be empty.
+        """
+        if self._decompressor.eof and data:
+            raise ValueError('The compressed content continues after its end')
+        try:
+            if self.compression == COMPRESSION_ZLIB:  # Stops right after the limit
+                data = self._decompressor.decompress(
+                    data, self.max_size - self.size + 1)
+                self._count(data)
+            else:
+                data = self._decompress_zstd(data)
+        except DECOMPRESS_ERRORS as e:
+            raise ValueError(f'The content failed to decompress: {e}') from None
+        if self._decompressor.unused_data:
+            raise ValueError('The compressed content continues after its end')
+        return data
+
+    def finish(self):
+        """Check that the compressed content is complete.
+
+        Raises:
+            ValueError: The compressed content is truncated.
+        """
+        if not self._decompressor.eof:
+            raise ValueError('The compressed content is truncated')
+
+    def _decompress_zstd(self, data):
+        # The decompressor has no output limit, so it is fed slices that can
+        # only expand a little beyond the limit
+        view, chunks = memoryview(data), []
+        while view and not self._decompressor.eof:
+            step = (self.max_size - self.size) // ZSTD_MAX_EXPANSION + 4
+            chunks.append(self._decompressor.decompress(view[:step]))
+            self._count(chunks[-1])
+            view = view[step:]
+        if view:
+            raise ValueError('The compressed content continues after its end')
+        return b''.join(chunks)
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ValueError(
+                f'The content exceeds {self.max_size} bytes decompressed')
+
+
+def compress(compression, data):
+    """Compress buffered content.
+
+    Args:
+        compression (int): The compression.
+        data (bytes): The content.
+
+    Returns:
+        bytes: The compressed content.
+    """
+    return Compressor(compression).finish(data)
+
+
+def decompress(compression, data, max_size=MAX_DECOMPRESSED_SIZE):
+    """Decompress buffered content.
+
+    Args:
+        compression (int): The compression.
+        data (bytes): The compressed content.
+        max_size (int, optional): See `Decompressor`. Defaults to MAX_DECOMPRESSED_SIZE.
+
+    Returns:
+        bytes: The content.
+    """
+    decompressor = Decompressor(compression, max_size)
+    data = decompressor.decompress(data)
+    decompressor.finish()
+    return data
+
+
+def compress_chunks(compression, chunks):
+    """Yield the compressed chunks of streamed content.
+
+    Args:
+        compression (int): The compression.
+        chunks (Iterable[bytes]): The content.
+
+    Yields:
+        bytes: The compressed chunks.
+    """
+    compressor = Compressor(compression)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def decompress_chunks(compression, chunks, max_size=MAX_DECOMPRESSED_SIZE):
+    """Yield the decompressed chunks of streamed content.
+
+    Args:
+        compression (int): The compression.
+        chunks (Iterable[bytes]): The compressed content.
+        max_size (int, optional): See `Decompressor`. Defaults to MAX_DECOMPRESSED_SIZE.
+
+    Yields:
+        bytes: The content.
+    """
+    decompressor = Decompressor(compression, max_size)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    decompressor.finish()
+
+
+def _header_version(circuit, suite, mode, compression=COMPRESSION_NONE,
+                    accept=0):
+    if compression != COMPRESSION_NONE or accept:
+        version = 7
+    elif mode != MODE_EAX:
+        version = 5
+    elif suite != SUITE_RSA:
+        version = 3
+    else:
+        version = 1
+    return version if circuit is None else version + 1
+
+
+def encoded_size(key_size,
+                 address_size,
+                 content_size,
+                 circuit=None,
+                 suite=SUITE_RSA,
+                 mode=MODE_EAX,
+                 compression=COMPRESSION_NONE,
+                 accept=0):
+    """Return the size of an encoded package.
+
+    Args:
+        key_size (int): Size of the encrypted AES key.
+        address_size (int): Size of the next address.
+        content_size (int): Size of the content, including its tag.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
+        compression (int, optional): The compression of the content. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the accepted compressions. Defaults to 0.
+
+    Returns:
+        int: The package size in bytes.
+    """
+    header = HEADERS[_header_version(circuit, suite, mode, compression,
+                                     accept)]
+    return header.size + key_size + NONCE_SIZE + address_size + content_size
+
+
+def _pack_header(key,
+                 nonce,
+                 address,
+                 content_size,
+                 circuit,
+                 suite,
+                 mode,
+                 compression=COMPRESSION_NONE,
+                 accept=0):
+    if len(nonce) != NONCE_SIZE:
+        raise ValueError(f'Nonce has to be {NONCE_SIZE} bytes')
+    if (circuit is None and suite == SUITE_RSA and mode == MODE_EAX
+            and compression == COMPRESSION_NONE and not accept):
+        # Fast path of the plain version 1 header, small packages are
+        # dominated by the checks below
+        return HEADER_V1.pack(1, len(key), len(address), content_size)
+    if suite not in SUITES.values():
+        raise ValueError(f'Unsupported key suite {suite}')
+    if mode not in MODES.values():
+        raise ValueError(f'Unsupported content mode {mode}')
+    if compression not in COMPRESSIONS.values() or not 0 <= accept < 16:
+        raise ValueError(f'Unsupported compression {compression}')
+    if circuit is not None and len(circuit) != CIRCUIT_ID_SIZE:
+        raise ValueError(f'Circuit id has to be {CIRCUIT_ID_SIZE} bytes')
+    version = _header_version(circuit, suite, mode, compression, accept)
+    fields = (len(key), len(address), content_size)
+    if circuit is not None:
+        fields = (circuit, ) + fields
+    if version >= 7:
+        fields = (accept << 4 | compression, ) + fields
+    if version >= 5:
+        fields = (mode, ) + fields
+    if version >= 3:
+        fields = (suite, ) + fields
+    return HEADERS[version].pack(version, *fields)
+
+
+def _header_struct(version):
+    header = HEADERS.get(version)
+    if header is None:
+        raise ValueError(f'Unsupported package version {version}')
+    return header
+
+
+def _unpack_header(header, data):
+    fields = header.unpack_from(data)
+    version, fields = fields[0], fields[1:]
+    if version == 1:
+        return (SUITE_RSA, MODE_EAX, COMPRESSION_NONE, 0, None) + fields
+    suite, mode, compression, accept = SUITE_RSA, MODE_EAX, COMPRESSION_NONE, 0
+    if version >= 3:
+        suite, fields = fields[0], fields[1:]
+        if suite not in SUITES.values():
+            raise ValueError(f'Unsupported key suite {suite}')
+    if version >= 5:
+        mode, fields = fields[0], fields[1:]
+        if mode not in MODES.values():
+            raise ValueError(f'Unsupported content mode {mode}')
+    if version >= 7:
+        compression, accept = fields[0] & 0x0F, fields[0] >> 4
+        fields = fields[1:]
+        if compression not in COMPRESSIONS.values():
+            raise ValueError(f'Unsupported compression {compression}')
+    circuit = None
+    if version % 2 == 0:
+        circuit, fields = fields[0], fields[1:]
+    return (suite, mode, compression, accept, circuit) + fields
+
+
+def encode_into(buffer,
+                offset,
+                key,
+                nonce,
+                address,
+                content_size,
+                circuit=None,
+                suite=SUITE_RSA,
+                mode=MODE_EAX,
+                compression=COMPRESSION_NONE,
+                accept=0):
+    """Write the package header at `offset` into the buffer.
+    The content has to be written directly behind it.
+
+    Args:
+        buffer (bytearray|memoryview): The buffer.
+        offset (int): Where the package starts.
+        key (bytes): The encrypted AES key.
+        nonce (bytes): The AES nonce.
+        address (bytes): The next address.
+        content_size (int): Size of the content, including its tag.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite of the key. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
+        compression (int, optional): The compression of the content. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the accepted compressions. Defaults to 0.
+
+    Returns:
+        int: The offset of the content.
+    """
+    header = _pack_header(key, nonce, address, content_size, circuit, suite,
+                          mode, compression, accept)
+    for field in (header, key, nonce, address):
+        buffer[offset:offset + len(field)] = field
+        offset += len(field)
+    return offset
+
+
+def encode(key,
+           nonce,
+           address,
+           content,
+           circuit=None,
+           suite=SUITE_RSA,
+           mode=MODE_EAX,
+           compression=COMPRESSION_NONE,
+           accept=0):
+    """Build a package with a single allocation and a single copy of the content.
+
+    Args:
+        key (bytes): The encrypted AES key.
+        nonce (bytes): The AES nonce.
+        address (bytes): The next address.
+        content (bytes): The encrypted content, including its tag.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite of the key. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
+        compression (int, optional): The compression of the content. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the accepted compressions. Defaults to 0.
+
+    Returns:
+        bytes: The package.
+    """
+    header = _pack_header(key, nonce, address, len(content), circuit, suite,
+                          mode, compression, accept)
+    return b''.join((header, key, nonce, address, content))
+
+
+def decode(data):
+    """Decode a buffered package without copying its content.
+
+    Args:
+        data (bytes|bytearray|memoryview): The received package.
+
+    Returns:
+        Package: The decoded package.
+    """
+    if not data:
+        raise ValueError('Package is empty')
+    header = _header_struct(data[0])
+    if len(data) < header.size:
+        raise ValueError(f'Package of {len(data)} bytes is too short')
+    (suite, mode, compression, accept, circuit, key_size, address_size,
+     content_size) = _unpack_header(header, data)
+    if content_size == STREAM_SIZE:
+        raise ValueError('Streamed package sent as buffered package')
+    nonce_start = header.size + key_size
+    address_start = nonce_start + NONCE_SIZE
+    content_start = address_start + address_size
+    end = content_start + content_size
+    if end > len(data):
+        raise ValueError(
+            f'Package of {len(data)} bytes is shorter than its header says ({end})'
+        )
+    # Only the content is a view, the small fields are sliced directly
+    return Package(bytes(data[header.size:nonce_start]),
+                   bytes(data[nonce_start:address_start]),
+                   str(data[address_start:content_start], 'utf-8'),
+                   memoryview(data)[content_start:end], circuit, suite, mode,
+                   compression, accept)
+
+
+class ChunkReader:
+    """Reads exact amounts of bytes out of an iterator of chunks."""
+
+    def __init__(self, chunks):
+        """
+        Args:
+            chunks (Iterable[bytes]): The incoming chunks.
+        """
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    @classmethod
+    def from_stream(cls, stream, chunk_size=CHUNK_SIZE):
+        """Create a reader for a file like object, such as `request.stream`.
+
+        Args:
+            stream: An object with a `read(size)` method.
+            chunk_size (int, optional): Bytes per read. Defaults to CHUNK_SIZE.
+
+        Returns:
+            ChunkReader: The reader.
+        """
+        return cls(iter(lambda: stream.read(chunk_size), b''))
+
+    def read(self, size):
+        """Read exactly `size` bytes.
+
+        Args:
+            size (int): Number of bytes.
+
+        Returns:
+            bytes: The bytes.
+        """
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                raise ValueError(
+                    f'Stream ended after {len(self._buffer)} of {size} bytes')
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def encode_header(key,
+                  nonce,
+                  address,
+                  content_size=STREAM_SIZE,
+                  circuit=None,
+                  suite=SUITE_RSA,
+                  mode=MODE_EAX,
+                  compression=COMPRESSION_NONE,
+                  accept=0):
+    """Build the package header which is followed by the content.
+
+    Args:
+        key (bytes): The encrypted AES key.
+        nonce (bytes): The AES nonce.
+        address (bytes): The next address.
+        content_size (int, optional): Size of the content. Defaults to STREAM_SIZE.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite of the key. Defaults to SUITE_RSA.
+        mode (int, optional): The content mode. Defaults to MODE_EAX.
+        compression (int, optional): The compression of the content. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the accepted compressions. Defaults to 0.
+
+    Returns:
+        bytes: The header.
+    """
+    header = _pack_header(key, nonce, address, content_size, circuit, suite,
+                          mode, compression, accept)
+    return b''.join((header, key, nonce, address))
+
+
+def read_header(reader):
+    """Read the package header of a stream.
+
+    Args:
+        reader (ChunkReader): The stream.
+
+    Returns:
+        Header: The decoded header.
+    """
+    version = reader.read(1)
+    header = _header_struct(version[0])
+    (suite, mode, compression, accept, circuit, key_size, address_size,
+     content_size) = _unpack_header(
+        header, version + reader.read(header.size - 1))
+    enc_key = reader.read(key_size)
+    nonce = reader.read(NONCE_SIZE)
+    address = reader.read(address_size).decode()
+    return Header(enc_key, nonce, address, content_size, circuit, suite, mode,
+                  compression, accept)
+
+
+class AsyncChunkReader:
+    """Reads exact amounts of bytes out of an async iterator of chunks."""
+
+    def __init__(self, chunks):
+        """
+        Args:
+            chunks (AsyncIterable[bytes]): The incoming chunks.
+        """
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+
+    async def read(self, size):
+        """Read exactly `size` bytes.
+
+        Args:
+            size (int): Number of bytes.
+
+        Returns:
+            bytes: The bytes.
+        """
+        while len(self._buffer) < size:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                raise ValueError(
+                    f'Stream ended after {len(self._buffer)} of {size} bytes'
+                ) from None
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+async def aread_header(reader):
+    """Read the package header of a stream, see `read_header`.
+
+    Args:
+        reader (AsyncChunkReader): The stream.
+
+    Returns:
+        Header: The decoded header.
+    """
+    version = await reader.read(1)
+    header = _header_struct(version[0])
+    (suite, mode, compression, accept, circuit, key_size, address_size,
+     content_size) = _unpack_header(
+        header, version + await reader.read(header.size - 1))
+    enc_key = await reader.read(key_size)
+    nonce = await reader.read(NONCE_SIZE)
+    address = (await reader.read(address_size)).decode()
+    return Header(enc_key, nonce, address, content_size, circuit, suite, mode,
+                  compression, accept)
+
+
+def encode_frame(data):
+    """Prefix the data with its frame size.
+
+    Args:
+        data (bytes): The frame content.
+
+    Returns:
+        bytes: The frame.
+    """
+    return FRAME.pack(len(data)) + data
+
+
+def iter_frames(reader, content_size=STREAM_SIZE):
+    """Yield the frame contents of a package until the empty end frame.
+    A buffered package is yielded as a single frame.
+
+    Args:
+        reader (ChunkReader): The stream positioned after the header.
+        content_size (int, optional): The content size of the header. Defaults to STREAM_SIZE.
+
+    Yields:
+        bytes: The content of each frame.
+    """
+    if content_size != STREAM_SIZE:
+        yield reader.read(content_size)
+        return
+    while True:
+        size, = FRAME.unpack(reader.read(FRAME.size))
+        if size == 0:
+            return
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f'Frame of {size} bytes exceeds {MAX_FRAME_SIZE}')
+        yield reader.read(size)
+
+
+async def aiter_frames(reader, content_size=STREAM_SIZE):
+    """Yield the frame contents of a package, see `iter_frames`.
+
+    Args:
+        reader (AsyncChunkReader): The stream positioned after the header.
+        content_size (int, optional): The content size of the header. Defaults to STREAM_SIZE.
+
+    Yields:
+        bytes: The content of each frame.
+    """
+    if content_size != STREAM_SIZE:
+        yield await reader.read(content_size)
+        return
+    while True:
+        size, = FRAME.unpack(await reader.read(FRAME.size))
+        if size == 0:
+            return
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f'Frame of {size} bytes exceeds {MAX_FRAME_SIZE}')
+        yield await reader.read(size)
+
+
+def decrypt_frames(cipher, frames, content_size=STREAM_SIZE):
+    """Yield the decrypted frames of a package, see `iter_frames`.
+    A stream which was cut short raises a ValueError at its end.
+
+    Args:
+        cipher (LayerCipher): The cipher of the layer.
+        frames (Iterable[bytes]): The encrypted frames.
+        content_size (int, optional): The content size of the header. Defaults to STREAM_SIZE.
+
+    Yields:
+        bytes: The plain data of each frame.
+    """
+    if content_size != STREAM_SIZE:
+        for frame in frames:
+            yield cipher.decrypt(frame)
+        return
+    for frame in frames:
+        data = cipher.decrypt_frame(frame)
+        if data:
+            yield data
+    cipher.check_end()
+
+
+def wrap_stream(enc_key,
+                cipher,
+                address,
+                chunks,
+                circuit=None,
+                suite=SUITE_RSA,
+                compression=COMPRESSION_NONE,
+                accept=0):
+    """Yield a streamed package whose content is encrypted chunk by chunk.
+
+    Args:
+        enc_key (bytes): The encrypted AES key.
+        cipher (LayerCipher): The cipher, its nonce and mode are sent in the header.
+        address (bytes): The next address.
+        chunks (Iterable[bytes]): The plain content.
+        circuit (bytes, optional): The circuit id. Defaults to None.
+        suite (int, optional): The key suite of the key. Defaults to SUITE_RSA.
+        compression (int, optional): The content is compressed with it before it is
+            encrypted. Defaults to COMPRESSION_NONE.
+        accept (int, optional): The mask of the accepted compressions. Defaults to 0.
+
+    Yields:
+        bytes: Header, frames and the end frame.
+    """
+    yield encode_header(enc_key,
+                        cipher.nonce,
+                        address,
+                        circuit=circuit,
+                        suite=suite,
+                        mode=cipher.mode,
+                        compression=compression,
+                        accept=accept)
+    if compression != COMPRESSION_NONE:
+        chunks = compress_chunks(compression, chunks)
+    for chunk in chunks:
+        if chunk:
+            yield encode_frame(cipher.encrypt(chunk))
+    end = cipher.end()
+    if end:
+        yield encode_frame(end)
+    yield encode_frame(b'')
+
+
+def encode_mux_frame(stream_id, data=b'', flags=MUX_DATA):
+    """Build a frame of a multiplexed stream.
+
+    Args:
+        stream_id (int): The stream id, 0 ends the multiplexed content.
+        data (bytes, optional): The data. Defaults to b''.
+        flags (int, optional): MUX_DATA, MUX_END or MUX_ERROR. Defaults to MUX_DATA.
+
+    Returns:
+        bytes: The frame.
+    """
+    return MUX_FRAME.pack(stream_id, flags, len(data)) + data
+
+
+def iter_mux_frames(reader):
+    """Yield the frames of multiplexed content until the end frame of stream 0.
+
+    Args:
+        reader (ChunkReader): The content positioned after MUX_MAGIC.
+
+    Yields:
+        (int, int, bytes): Stream id, flags and data of each frame.
+    """
+    while True:
+        stream_id, flags, size = MUX_FRAME.unpack(reader.read(MUX_FRAME.size))
+        if stream_id == 0:
+            return
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f'Frame of {size} bytes exceeds {MAX_FRAME_SIZE}')
+        yield stream_id, flags, reader.read(size)
+
+
+def encode_mux_requests(requests):
+    """Build the multiplexed content of several requests, stream i + 1 carries request i.
+
+    Args:
+        requests (List[Tuple[str, str, bytes]]): Method, URL and body of each request.
+
+    Returns:
+        bytes: The content.
+    """
+    frames = [MUX_MAGIC]
+    for stream_id, (method, url, body) in enumerate(requests, 1):
+        frames.append(
+            encode_mux_frame(stream_id,
+                             f'{method} {url}\r\n\r\n'.encode() + body))
+        frames.append(encode_mux_frame(stream_id, flags=MUX_END))
+    frames.append(encode_mux_frame(0, flags=MUX_END))
+    return b''.join(frames)
+
+
+def decode_mux_requests(content):
+    """Decode the multiplexed content of several requests.
+
+    Args:
+        content (bytes): The content, starting with MUX_MAGIC.
+
+    Returns:
+        Dict[int, Tuple[str, str, bytes]]: Stream id -> method, URL and body.
+    """
+    reader = ChunkReader([content[len(MUX_MAGIC):]])
+    data = {}
+    for stream_id, flags, frame in iter_mux_frames(reader):
+        data.setdefault(stream_id, bytearray()).extend(frame)
+    requests = {}
+    for stream_id, request in data.items():
+        head, _, body = bytes(request).partition(b'\r\n\r\n')
+        method, _, url = head.decode().partition(' ')
+        if not method or not url:
+            raise ValueError(f'Stream {stream_id} has no request line')
+        requests[stream_id] = (method, url, body)
+    return requests
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
+import json
 import os
 import random
 from flask import Flask, jsonify
 
 app = Flask(__name__)
 
+MAX_PAYLOAD_SIZE = int(os.environ.get("MAX_PAYLOAD_SIZE", 64 * 1024 * 1024))
+
 quotes = [{
     "text":
     "The best thing about giving of ourselves is that what we get is always better than what we give. The reaction is greater than the action.",
@@ -197,5 +200,17 @@ def index():
     return jsonify(random.choice(quotes))
 
 
+@app.route("/payload/<int:size>")
+def payload(size):
+    """Return a JSON list of quotes of about `size` bytes, for benchmarks."""
+    size = min(size, MAX_PAYLOAD_SIZE)
+    items, total = [], 2
+    while total < size:
+        quote = quotes[len(items) % len(quotes)]
+        items.append(quote)
+        total += len(json.dumps(quote)) + 2
+    return jsonify(items)
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
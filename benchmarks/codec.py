@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Microbenchmark of the package codec in onion.py against the former
+slicing and concatenating implementation.
+
+Usage:
+    python3 benchmarks/codec.py [--sizes 1024 1048576 ...] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0,
+                os.path.join(os.path.dirname(__file__), '..', 'IntermediateNode'))
+import onion  # noqa: E402
+
+KEY = os.urandom(256)
+NONCE = os.urandom(16)
+ADDRESS = b'https://node-042-abcdefghij-ey.a.run.app'
+
+
+def legacy_build(key, nonce, address, content):
+    """The package building as it was done before onion.py."""
+    return (len(key).to_bytes(4, byteorder='big') +
+            len(address).to_bytes(4, byteorder='big') +
+            len(content).to_bytes(4, byteorder='big') + key + nonce + address +
+            content)
+
+
+def legacy_parse(data):
+    """The package parsing as it was done before onion.py."""
+    key_size = int.from_bytes(data[:4], byteorder='big')
+    address_size = int.from_bytes(data[4:8], byteorder='big')
+    content_size = int.from_bytes(data[8:12], byteorder='big')
+    enc_key = data[12:12 + key_size]
+    idx = 12 + key_size + 16
+    nonce = data[12 + key_size:idx]
+    next_host = data[idx:idx + address_size].decode()
+    idx += address_size
+    enc_content = data[idx:idx + content_size]
+    return enc_key, nonce, next_host, enc_content
+
+
+def measure(function, repeat):
+    """Return the best time of a single call in seconds."""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"size":>10} {"op":>6} {"legacy µs":>12} {"codec µs":>12} {"speedup":>8}')
+    for size in args.sizes:
+        content = os.urandom(size)
+        legacy_data = legacy_build(KEY, NONCE, ADDRESS, content)
+        data = bytes(onion.encode(KEY, NONCE, ADDRESS, content))
+        results = {
+            'build': (lambda: legacy_build(KEY, NONCE, ADDRESS, content),
+                      lambda: onion.encode(KEY, NONCE, ADDRESS, content)),
+            'parse': (lambda: legacy_parse(legacy_data),
+                      lambda: onion.decode(data)),
+        }
+        for op, (legacy, codec) in results.items():
+            legacy_time = measure(legacy, args.repeat)
+            codec_time = measure(codec, args.repeat)
+            print(f'{size:>10} {op:>6} {legacy_time * 1e6:>12.1f} '
+                  f'{codec_time * 1e6:>12.1f} {legacy_time / codec_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
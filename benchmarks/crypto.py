@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Microbenchmark suite of the wrap and unwrap primitives of the client and the node.
+
+Measures `encrypt`, `decrypt` and `parse_package` of `Originator/client.py`
+and `IntermediateNode/main.py` for every payload size, key suite (RSA of
+a key size such as `rsa2048`, or `x25519`) and content mode (`eax`, `gcm`
+or `chacha20`), and the wrapping (`build_onion`)
+and unwrapping (`parse_package` once per hop) of whole packages for every
+route length. Also measures the key generation of every suite. Runs without
+any network.
+
+Every case reports the best time of a call as ops/s and bytes/s, the peak
+memory allocated during a call (tracemalloc) and how the time splits between
+the key suite (wrapping the AES key), the content cipher and the rest, such
+as parsing, copying and importing keys.
+
+The results are written as JSON and can be compared to the JSON of an
+earlier run: the script exits with status 1 if a case got slower than
+`--threshold` allows.
+
+Usage:
+    python3 benchmarks/crypto.py [--sizes 1024 65536 1048576] [--suites rsa2048 rsa3072 x25519]
+        [--modes eax gcm chacha20] [--hops 1 3 5] [--repeat 5] [--output crypto.json]
+        [--baseline crypto.json] [--threshold 0.25]
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+KB = 1024
+MB = 1024 * KB
+
+
+def load(component, module):
+    """Import a module of a component. The components have modules of the same
+    name (such as onion.py), so those of an earlier component are forgotten first.
+
+    Args:
+        component (str): The directory of the component.
+        module (str): The module name.
+
+    Returns:
+        module: The module.
+    """
+    path = os.path.join(ROOT, component)
+    for name in os.listdir(path):
+        if name.endswith('.py'):
+            sys.modules.pop(name[:-3], None)
+    sys.path.insert(0, path)
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.remove(path)
+
+
+def load_components():
+    """Import the client and the node in a temporary directory.
+
+    The node would generate a key and register it at the directory node on
+    import, so it gets a stored key and no lease token, and its key pool
+    is filled before anything is measured.
+
+    Returns:
+        module, module: The client and the node.
+    """
+    os.chdir(tempfile.mkdtemp(prefix='onion-bench-crypto-'))
+    with open('private.pem', 'wb') as key_file:
+        key_file.write(RSA.generate(2048).export_key())
+    os.environ.pop('LEASE_TOKEN', None)
+    os.environ['KEY_GENERATIONS'] = '1'  # Only the current key is tried
+    os.environ['KEY_POOL_SIZE'] = '1'
+    client = load('Originator', 'client')
+    node = load('IntermediateNode', 'main')
+    while node.key_pool.stats()['ready'] < 1:
+        time.sleep(0.1)
+    node.key_writer.submit(lambda: None).result()
+    return client, node
+
+
+def parse_suite(client, name):
+    """Return the key suite and the RSA key size of a suite name such as rsa2048.
+
+    Returns:
+        int, int: The suite and the key size.
+    """
+    if name.startswith('rsa'):
+        return client.SUITE_RSA, int(name[3:] or 2048)
+    return client.SUITES[name], 2048
+
+
+def use_keys(client, node, suite, bits):
+    """Give the client and the node new keys of the given suite.
+
+    Returns:
+        Crypto.PublicKey.RSA.RsaKey|Crypto.PublicKey.ECC.EccKey: The public key of the node.
+    """
+    client_key, node_key = client.new_key(suite, bits), client.new_key(
+        suite, bits)
+    with open('private.pem', 'wb') as key_file:  # Read by the client
+        key_file.write(client.export_key(client_key, private=True))
+    node.keyring.install(node_key)
+    node.lease['PUBLIC_KEY'] = client.export_key(client_key).decode()
+    return client.import_key(client.export_key(node_key))
+
+
+def best_time(function, repeat):
+    """Return the best time of a single call in seconds."""
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+
+def peak_allocation(function):
+    """Return the peak memory allocated during a call in bytes."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def primitives(client, public_key, node, sizes, modes, repeat):
+    """Measure the key suite and content cipher operations the primitives are made of.
+
+    Returns:
+        dict: Seconds of 'key_wrap' and 'key_unwrap' of an AES key
+            and of ('aes', mode, size) for every content mode and size.
+    """
+    session_key = get_random_bytes(32)
+    suite, cipher_key = client.key_cipher(public_key)
+    enc_key = cipher_key.encrypt(session_key)
+    times = {
+        'key_wrap': best_time(lambda: cipher_key.encrypt(session_key),
+                              repeat),
+        'key_unwrap': best_time(lambda: node.keyring.decrypt(enc_key, suite),
+                                repeat)
+    }
+    for size in sizes:
+        content = os.urandom(size)
+        for mode in modes:
+            times[('aes', mode, size)] = best_time(
+                lambda: client.LayerCipher(session_key, mode).encrypt(content),
+                repeat)
+    return times
+
+
+def cases(client, node, public_key, size, mode, hops):
+    """Return the cases of a key, payload size and content mode.
+
+    Returns:
+        List[Tuple[str, Callable, int, int, int]]: Name, call, key wraps,
+            key unwraps and AES passes over the payload of every case.
+    """
+    content = os.urandom(size)
+    address = 'https://node-042-abcdefghij-ey.a.run.app'
+    request = client.build_onion(
+        content, client.onion_layers([public_key], [address], mode))
+    response = node.encrypt(content, mode)
+    wrapped = client.encrypt(public_key, content, mode)
+    found = [
+        ('client.encrypt', lambda: client.encrypt(public_key, content, mode),
+         1, 0, 1),
+        ('client.decrypt', lambda: client.decrypt(*response), 0, 1, 1),
+        ('client.parse_package', lambda: client.parse_package(request), 0, 0,
+         0),
+        ('node.encrypt', lambda: node.encrypt(content, mode), 1, 0, 1),
+        ('node.decrypt', lambda: node.decrypt(*wrapped), 0, 1, 1),
+        ('node.parse_package', lambda: node.parse_package(request), 0, 1, 1),
+    ]
+    for count in hops:
+        addresses = [address] * count
+        package = client.build_onion(
+            content, client.onion_layers([public_key] * count, addresses,
+                                         mode))
+
+        def unwrap(package=package, count=count):
+            for _ in range(count):
+                package = node.parse_package(package)[1]
+            return package
+
+        found += [
+            (f'route.wrap/hops{count}', lambda addresses=addresses: client.
+             build_onion(content,
+                         client.onion_layers([public_key] * len(addresses),
+                                             addresses, mode)), count, 0,
+             count),
+            (f'route.unwrap/hops{count}', unwrap, 0, count, count),
+        ]
+    return found
+
+
+def run(client, node, args):
+    """Run all cases.
+
+    Returns:
+        dict: Case name -> results.
+    """
+    results = {}
+    for suite_name in args.suites:
+        suite, bits = parse_suite(client, suite_name)
+        public_key = use_keys(client, node, suite, bits)
+        modes = [client.MODES[name] for name in args.modes]
+        times = primitives(client, public_key, node, args.sizes, modes,
+                           args.repeat)
+        found = [(f'keygen/{suite_name}', lambda: client.new_key(suite, bits),
+                  0, 0, 0, None, 0)]
+        for mode_name, mode in zip(args.modes, modes):
+            for size in args.sizes:
+                found += [
+                    case + (mode_name, size)
+                    for case in cases(client, node, public_key, size, mode,
+                                      args.hops)
+                ]
+        for name, function, wraps, unwraps, aes_passes, mode_name, size in found:
+            seconds = best_time(function, args.repeat)
+            # Estimated out of the primitives, capped in case the run was noisy
+            key = min(
+                seconds,
+                wraps * times['key_wrap'] + unwraps * times['key_unwrap'])
+            aes = min(seconds - key,
+                      aes_passes *
+                      times.get(('aes', client.MODES.get(mode_name), size), 0))
+            case = f'{name}/{suite_name}/{mode_name}/{size}' if size else name
+            results[case] = {
+                'ops_per_s': round(1 / seconds, 2),
+                'bytes_per_s': round(size / seconds, 1),
+                'us_per_op': round(seconds * 1e6, 2),
+                'alloc_peak_bytes': peak_allocation(function),
+                'split_us': {
+                    'key': round(key * 1e6, 2),
+                    'aes': round(aes * 1e6, 2),
+                    'other': round((seconds - key - aes) * 1e6, 2)
+                }
+            }
+            print(f'{case:>48} {seconds * 1e6:>12.1f} {size / seconds / MB:>9.1f} '
+                  f'{results[case]["alloc_peak_bytes"] / KB:>10.1f} '
+                  f'{key / seconds:>5.0%} {aes / seconds:>5.0%}')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare the results to a baseline.
+
+    Args:
+        results (dict): Case name -> results of this run.
+        baseline (dict): Case name -> results of the baseline.
+        threshold (float): Allowed slowdown, 0.25 allows 25% fewer ops/s.
+
+    Returns:
+        List[str]: The regressions.
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        before, after = baseline[case]['ops_per_s'], result['ops_per_s']
+        if after < before * (1 - threshold):
+            regressions.append(f'{case}: {before} -> {after} ops/s '
+                               f'({after / before - 1:+.0%})')
+    return regressions
+
+
+def system_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=ROOT,
+                                capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[KB, 64 * KB, MB])
+    parser.add_argument('--suites',
+                        nargs='+',
+                        default=['rsa2048', 'rsa3072', 'x25519'],
+                        help='Key suites, rsa<bits> or x25519')
+    parser.add_argument('--modes',
+                        nargs='+',
+                        choices=['eax', 'gcm', 'chacha20'],
+                        default=['eax', 'gcm', 'chacha20'],
+                        help='Content modes of the layers')
+    parser.add_argument('--hops', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='crypto.json')
+    parser.add_argument('--baseline',
+                        help='JSON of an earlier run to compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.25,
+                        help='Allowed slowdown against the baseline (default 0.25)')
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    client, node = load_components()
+    print(f'{"case":>48} {"µs/op":>12} {"MB/s":>9} {"peak KiB":>10} {"Key":>5} {"AES":>5}')
+    results = run(client, node, args)
+    report = {'config': vars(args), 'system': system_info(), 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'Written to {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'  regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression above {args.threshold:.0%} against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
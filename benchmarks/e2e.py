@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the full onion path on localhost.
+
+Starts the directory node with the local deployment backend, which starts
+and pools the nodes, and the service on free ports. Then drives
+`client.client` of the Originator with the given concurrency: every request
+asks the directory node for a route, gets the keys of the nodes, sends a
+request for `/payload/<size>` of the service over the route and finally
+releases the route with `/check`.
+
+Reports the throughput, the latency percentiles, the time per stage
+(route, key_fetch, wrap, transit, unwrap; release is not part of the latency)
+and the bytes the nodes received and sent per request (out of their
+`/metrics`), and writes them as JSON so runs can be compared between releases.
+The payload of the service is JSON, so `--compression none` shows what the
+compression of the responses saves.
+
+Usage:
+    python3 benchmarks/e2e.py [--requests 200] [--concurrency 4] [--payload 1024]
+        [--nodes 12] [--stream] [--circuit] [--keys directory|nodes]
+        [--node-server wsgi|asgi] [--content-mode gcm|chacha20|eax]
+        [--compression zstd zlib|none] [--output e2e.json]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'Originator'))
+import client  # noqa: E402
+
+HOST = '127.0.0.1'
+STAGES = ['route', 'key_fetch', 'wrap', 'transit', 'unwrap', 'release']
+PUBLIC_KEY = None  # Of the client, set in main
+# Node URL -> its byte counters when it was last scraped. A node is leased to
+# one route at a time, so only the request of that route scrapes it
+NODE_BYTES = {}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_app(app_dir, port, env, log, threads=8):
+    """Start the Flask app `main:app` of a component in its own process group,
+    with gunicorn like in the Dockerfiles if it is installed.
+
+    Args:
+        app_dir (str): The directory of the component.
+        port (int): The port to listen on.
+        env (dict): Additional environment variables.
+        log (file): Gets the output of the process.
+        threads (int, optional): The gunicorn threads, as in the Dockerfile
+            of the component. Defaults to 8.
+
+    Returns:
+        subprocess.Popen: The process.
+    """
+    if importlib.util.find_spec('gunicorn'):
+        command = [
+            sys.executable, '-m', 'gunicorn', '--bind', f'{HOST}:{port}',
+            '--workers', '1', '--threads', str(threads), '--timeout', '0',
+            '--pythonpath', app_dir, 'main:app'
+        ]
+    else:
+        command = [
+            sys.executable, '-m', 'flask', 'run', '--host', HOST, '--port',
+            str(port), '--with-threads', '--no-reload'
+        ]
+    env = dict(os.environ,
+               PORT=str(port),
+               FLASK_APP='main',
+               PYTHONPATH=app_dir,
+               PYTHONUNBUFFERED='1',
+               **env)
+    return subprocess.Popen(command,
+                            cwd=tempfile.mkdtemp(prefix='onion-bench-'),
+                            env=env,
+                            stdout=log,
+                            stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def stop_app(process):
+    """Stop a process and everything it started, such as the nodes of the directory node."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+            process.wait(timeout=10)
+            return
+        except ProcessLookupError:
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def wait_for(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except requests.RequestException:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{what} not ready within {timeout}s')
+        time.sleep(0.2)
+
+
+def percentiles(values):
+    """Return the mean and the nearest-rank percentiles of the values in ms."""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p * len(values)) - 1))]
+
+    return {
+        'p50': round(rank(0.50) * 1e3, 3),
+        'p95': round(rank(0.95) * 1e3, 3),
+        'p99': round(rank(0.99) * 1e3, 3),
+        'mean': round(sum(values) / len(values) * 1e3, 3),
+        'max': round(values[-1] * 1e3, 3)
+    }
+
+
+def one_request(directory, service, args):
+    """Run a single request over a new route.
+
+    Returns:
+        bool, float, dict, int|str, dict|None: Success, latency in seconds,
+            seconds per stage, the response size or the error and the bytes
+            the nodes of the route received and sent for it, see `relayed_bytes`.
+    """
+    timings = {}
+    start = time.perf_counter()
+    document = client.http.post(directory + '/route',
+                                json={
+                                    'public_key': PUBLIC_KEY
+                                },
+                                timeout=120).json()
+    if 'route' not in document:
+        return False, 0.0, timings, document.get('error', str(document)), None
+    now = client.record(timings, 'route', start)
+    if args.keys == 'directory':
+        route = client.directory_keys.load_route(directory, document)
+    else:  # Ask every node, as a client without the directory keys does
+        route = document['route']
+        client.node_keys.invalidate(route)
+    client.record(timings, 'key_fetch', now)
+    status, msg = client.client(service, route, args.stream, args.circuit,
+                                timings)
+    latency = time.perf_counter() - start
+    # Before the release, which might stop the nodes
+    relayed = relayed_bytes(document['route'])
+    now = time.perf_counter()
+    client.http.post(directory + '/check',
+                     json={'tracking_id': document['tracking_id']},
+                     timeout=120)
+    client.record(timings, 'release', now)
+    if not status:
+        return False, latency, timings, msg, relayed
+    return True, latency, timings, len(msg['result']), relayed
+
+
+def node_bytes(node):
+    """Return the bytes a node received and sent so far.
+
+    Args:
+        node (str): The node URL.
+
+    Returns:
+        dict: 'in' and 'out' -> bytes, out of its `onion_node_bytes_total`.
+    """
+    total = {'in': 0, 'out': 0}
+    for line in requests.get(node + '/metrics', timeout=10).text.splitlines():
+        for direction in total:
+            prefix = f'onion_node_bytes_total{{direction="{direction}"}} '
+            if line.startswith(prefix):
+                total[direction] += float(line[len(prefix):])
+    return total
+
+
+def relayed_bytes(route):
+    """Return the bytes the nodes of a route received and sent since they were
+    scraped for their previous route.
+
+    Args:
+        route (list[str]): The node URLs.
+
+    Returns:
+        dict|None: 'in' and 'out' -> bytes, None if a node did not answer.
+    """
+    try:
+        totals = {node: node_bytes(node) for node in route}
+    except requests.RequestException:
+        return None
+    relayed = {'in': 0, 'out': 0}
+    for node, total in totals.items():
+        last = NODE_BYTES.get(node, {'in': 0, 'out': 0})
+        NODE_BYTES[node] = total
+        for direction in relayed:
+            # A new node on the port of a stopped one counts from 0 again
+            relayed[direction] += total[direction] - (
+                last[direction] if total[direction] >= last[direction] else 0)
+    return relayed
+
+
+def run(directory, service, args):
+    """Run the warm-up and the measured requests.
+
+    Returns:
+        dict: The results.
+    """
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(
+            executor.map(lambda _: one_request(directory, service, args),
+                         range(args.warmup)))
+        start = time.perf_counter()
+        outcomes = list(
+            executor.map(lambda _: one_request(directory, service, args),
+                         range(args.requests)))
+        duration = time.perf_counter() - start
+
+    succeeded = [outcome for outcome in outcomes if outcome[0]]
+    errors = [outcome[3] for outcome in outcomes if not outcome[0]]
+    received = sum(outcome[3] for outcome in succeeded)
+    relayed = [outcome[4] for outcome in outcomes if outcome[4] is not None]
+    return {
+        'requests': len(outcomes),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(succeeded) / duration, 3),
+        'received_bytes_per_s': round(received / duration, 1),
+        # Requests whose nodes did not all answer are left out
+        'node_bytes_requests': len(relayed),
+        'node_bytes_per_request': {
+            direction: round(
+                sum(nodes[direction] for nodes in relayed) /
+                max(1, len(relayed)), 1)
+            for direction in ('in', 'out')
+        },
+        'latency_ms': percentiles([outcome[1] for outcome in succeeded]),
+        'stages_ms': {
+            stage: percentiles([
+                outcome[2][stage] for outcome in succeeded
+                if stage in outcome[2]
+            ])
+            for stage in STAGES
+        }
+    }
+
+
+def system_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=ROOT,
+                                capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+def main():
+    global PUBLIC_KEY
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--payload',
+                        type=int,
+                        default=1024,
+                        help='Size of the service response in bytes')
+    parser.add_argument('--nodes',
+                        type=int,
+                        help='Size of the node pool (default 3 per concurrent request)')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--circuit', action='store_true')
+    parser.add_argument('--keys',
+                        choices=['directory', 'nodes'],
+                        default='directory',
+                        help='Take the node keys out of the route document or ask the nodes')
+    parser.add_argument('--node-server',
+                        choices=['wsgi', 'asgi'],
+                        default='wsgi')
+    parser.add_argument('--content-mode',
+                        choices=list(client.MODES),
+                        default='gcm',
+                        help='Content mode of the layers, the nodes answer with the same one')
+    parser.add_argument('--compression',
+                        nargs='+',
+                        choices=list(client.COMPRESSIONS),
+                        default=['zstd', 'zlib'],
+                        help='Compressions the client accepts for the response')
+    parser.add_argument('--output', default='e2e.json')
+    args = parser.parse_args()
+    args.nodes = args.nodes or 3 * args.concurrency
+    args.output = os.path.abspath(args.output)
+    client.CONTENT_MODE = client.MODES[args.content_mode]
+    client.COMPRESSION = [client.COMPRESSIONS[name] for name in args.compression]
+
+    os.chdir(tempfile.mkdtemp(prefix='onion-bench-client-'))
+    client.generate_key()
+    PUBLIC_KEY = open('public.pem').read()
+
+    directory_port, service_port = free_port(), free_port()
+    directory = f'http://{HOST}:{directory_port}'
+    service = f'http://{HOST}:{service_port}/payload/{args.payload}'
+    log = open(os.path.join(os.getcwd(), 'servers.log'), 'w')
+    processes = [
+        start_app(os.path.join(ROOT, 'Service'), service_port, {}, log),
+        start_app(
+            os.path.join(ROOT, 'DirectoryNode'), directory_port, {
+                'DEPLOYMENT_BACKEND': 'local',
+                'NODE_POOL_SIZE': str(args.nodes),
+                'LOCAL_MAX_IDLE': str(args.nodes),
+                'NODE_SERVER': args.node_server
+            },
+            log,
+            threads=16)
+    ]
+    try:
+        print(f'Starting the service, the directory node and {args.nodes} nodes '
+              f'(logs in {log.name})')
+        wait_for(lambda: requests.get(service, timeout=5).ok, 60, 'Service')
+        wait_for(
+            lambda: requests.get(directory + '/pool', timeout=5).json()[
+                'ready'] >= args.nodes, 120, 'Node pool')
+        with contextlib.redirect_stdout(io.StringIO()):  # The client prints every response
+            results = run(directory, service, args)
+    finally:
+        for process in processes:
+            stop_app(process)
+        log.close()
+
+    report = {'config': vars(args), 'system': system_info(), **results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    print(f'{results["requests"]} requests, {results["errors"]} errors, '
+          f'{results["throughput_rps"]} requests/s, '
+          f'{results["received_bytes_per_s"] / 1024:.1f} KiB/s received')
+    for sample in results['error_samples']:
+        print(f'  error: {sample}')
+    print(f'{results["node_bytes_per_request"]["in"] / 1024:.1f} KiB received and '
+          f'{results["node_bytes_per_request"]["out"] / 1024:.1f} KiB sent by the nodes per request '
+          f'(over {results["node_bytes_requests"]} requests)')
+    print(f'{"":>10} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"mean ms":>10}')
+    for name, stats in [('latency', results['latency_ms'])] + list(
+            results['stages_ms'].items()):
+        if stats:
+            print(f'{name:>10} {stats["p50"]:>10.2f} {stats["p95"]:>10.2f} '
+                  f'{stats["p99"]:>10.2f} {stats["mean"]:>10.2f}')
+    print(f'Written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Benchmark of the onion construction of the client: the single buffer
+`build_onion` against the former re-concatenation of every layer.
+
+Usage:
+    python3 benchmarks/onion_build.py [--sizes 1024 ...] [--hops 3] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Originator'))
+from Crypto.PublicKey import RSA  # noqa: E402
+
+import client  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+
+
+def legacy_wrap(content, public_keys, addresses):
+    """The wrapping loop as it was done before `build_onion`."""
+    for public_key, address in zip(public_keys, addresses):
+        key, nonce, content, _, _ = client.encrypt(public_key, content)
+        content = (len(key).to_bytes(4, byteorder='big') +
+                   len(address).to_bytes(4, byteorder='big') +
+                   len(content).to_bytes(4, byteorder='big') + key + nonce +
+                   address.encode() + content)
+    return content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[KB, 64 * KB, MB, 10 * MB, 50 * MB])
+    parser.add_argument('--hops', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    public_keys = [
+        RSA.generate(2048).publickey().export_key().decode()
+        for _ in range(args.hops)
+    ]
+    addresses = [f'https://node-{i:03d}.example.com' for i in range(args.hops)]
+
+    print(f'{"size":>10} {"legacy ms":>10} {"builder ms":>11} {"MB/s":>8} {"speedup":>8}')
+    for size in args.sizes:
+        content = os.urandom(size)
+        legacy = min(
+            timeit.repeat(lambda: legacy_wrap(content, public_keys, addresses),
+                          number=1,
+                          repeat=args.repeat))
+        builder = min(
+            timeit.repeat(
+                lambda: client.build_onion(
+                    content, client.onion_layers(public_keys, addresses)),
+                number=1,
+                repeat=args.repeat))
+        print(f'{size:>10} {legacy * 1e3:>10.2f} {builder * 1e3:>11.2f} '
+              f'{size / builder / MB:>8.1f} {legacy / builder:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
+import os
 import subprocess
 import sys
+import tempfile
 
 PREFIX = '\n\x1b[4m➤ '
 SUFFIX = '\x1b[0m [y/N] '
@@ -188,14 +190,47 @@ def check_for_services(project_id):
     notify('All services enabled', prefix='tick')
 
 
+def signing_key_env_files():
+    """Generate the RSA key the directory node signs its documents with.
+    The directory node gets it as SIGNING_KEY, the client pins its public key
+    as DIRECTORY_KEY.
+
+    Returns:
+        Dict[str, str]: Service name -> file of its environment variables.
+    """
+    key_dir = tempfile.mkdtemp(prefix='onion-keys-')
+    private_file = os.path.join(key_dir, 'signing.pem')
+    subprocess.run(['openssl', 'genrsa', '-out', private_file, '2048'],
+                   capture_output=True,
+                   check=True)
+    public_key = subprocess.run(
+        ['openssl', 'rsa', '-in', private_file, '-pubout'],
+        capture_output=True,
+        text=True,
+        check=True).stdout
+    with open(private_file) as key_file:
+        private_key = key_file.read()
+    env_files = {}
+    for service, name, pem in [('directory', 'SIGNING_KEY', private_key),
+                               ('client', 'DIRECTORY_KEY', public_key)]:
+        env_files[service] = os.path.join(key_dir, f'{service}.yaml')
+        with open(env_files[service], 'w') as env_file:
+            env_file.write(f'{name}: |\n' + ''.join(
+                f'  {line}\n' for line in pem.strip().splitlines()))
+    return env_files
+
+
 def start_gcloud_services(project_id):
     service_urls = []
+    env_files = signing_key_env_files()
     for service in ['directory', 'service', 'client']:
         service_url = f'{LOCATION}-docker.pkg.dev/{project_id}/{REPOSITORY}/{service}'
+        env = ['--env-vars-file', env_files[service]
+               ] if service in env_files else []
         out, err = run_cmd([
             'gcloud', 'run', 'deploy', service, f'--region={LOCATION}',
             '--allow-unauthenticated', '--image', service_url
-        ])
+        ] + env)
         out.replace(10 * '.', '')  # Remove a lot of dots
         cmd_output(err if err else out, True if err else False)
         notify(f'Deployed {service}', prefix='tick')
@@ -85,10 +85,16 @@ docker push {location}-docker.pkg.dev/{project}/{repository}/service
 {sudo}docker tag michelkrispin/client {location}-docker.pkg.dev/{project}/{repository}/client
 docker push {location}-docker.pkg.dev/{project}/{repository}/client
 
+# The key the directory node signs its documents with, the client pins its public key
+KEY_DIR=$(mktemp -d)
+openssl genrsa -out $KEY_DIR/signing.pem 2048
+{{ echo 'SIGNING_KEY: |'; sed 's/^/  /' $KEY_DIR/signing.pem; }} > $KEY_DIR/directory.yaml
+{{ echo 'DIRECTORY_KEY: |'; openssl rsa -in $KEY_DIR/signing.pem -pubout | sed 's/^/  /'; }} > $KEY_DIR/client.yaml
+
 # Deploy all services to the cloud
 gcloud run deploy service --region {location} --allow-unauthenticated --image {location}-docker.pkg.dev/{project}/{repository}/service
-gcloud run deploy directory --region {location} --allow-unauthenticated --image {location}-docker.pkg.dev/{project}/{repository}/directory
-gcloud run deploy client --region {location} --allow-unauthenticated --image {location}-docker.pkg.dev/{project}/{repository}/client'''
+gcloud run deploy directory --region {location} --allow-unauthenticated --image {location}-docker.pkg.dev/{project}/{repository}/directory --env-vars-file $KEY_DIR/directory.yaml
+gcloud run deploy client --region {location} --allow-unauthenticated --image {location}-docker.pkg.dev/{project}/{repository}/client --env-vars-file $KEY_DIR/client.yaml'''
 
 if __name__ == '__main__':
     location = 'europe-west3'
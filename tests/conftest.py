@@ -0,0 +1,148 @@
+"""Fixtures shared by the tests of all components.
+
+The components are no packages and have modules of the same name (such as
+main.py and onion.py), so they are imported like in benchmarks/crypto.py.
+The node and the directory node start background threads on import, so
+each of them is imported once per test session in its own directory.
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Nothing listens here, so notifications and registrations fail fast
+UNREACHABLE = 'http://127.0.0.1:9'
+
+
+def load(component, module):
+    """Import a module of a component. The modules of the same name of an
+    earlier component are forgotten first.
+
+    Args:
+        component (str): The directory of the component.
+        module (str): The module name.
+
+    Returns:
+        module: The module.
+    """
+    path = os.path.join(ROOT, component)
+    for name in os.listdir(path):
+        if name.endswith('.py'):
+            sys.modules.pop(name[:-3], None)
+    sys.path.insert(0, path)
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.remove(path)
+
+
+@pytest.fixture(scope='session')
+def node_dir(tmp_path_factory):
+    """The working directory of the node, where it stores its key files."""
+    return tmp_path_factory.mktemp('node')
+
+
+def load_node(node_dir, module):
+    """Import a module of the node in its directory, without a lease token
+    and a directory node. The node has a key once it returns.
+
+    Args:
+        node_dir (str): The working directory of the node.
+        module (str): 'main' or 'asgi', which imports its own main.
+
+    Returns:
+        module: The module.
+    """
+    cwd = os.getcwd()
+    os.chdir(node_dir)
+    os.environ.pop('LEASE_TOKEN', None)
+    os.environ['DIRECTORY_NODE'] = UNREACHABLE
+    os.environ['KEY_POOL_SIZE'] = '1'
+    try:
+        loaded = load('IntermediateNode', module)
+        node = loaded if module == 'main' else loaded.node
+        node.key_writer.submit(lambda: None).result()
+    finally:
+        os.chdir(cwd)
+    return loaded
+
+
+@pytest.fixture(scope='session')
+def node(node_dir):
+    """The node (IntermediateNode/main.py)."""
+    return load_node(node_dir, 'main')
+
+
+@pytest.fixture(scope='session')
+def asgi(tmp_path_factory):
+    """The ASGI node (IntermediateNode/asgi.py), with a main.py of its own."""
+    return load_node(tmp_path_factory.mktemp('asgi'), 'asgi')
+
+
+@pytest.fixture
+def in_node_dir(node_dir, monkeypatch):
+    """Run the test in the directory of the node, which writes its keys there."""
+    monkeypatch.chdir(node_dir)
+
+
+@pytest.fixture(scope='session')
+def client():
+    """The client (Originator/client.py)."""
+    return load('Originator', 'client')
+
+
+@pytest.fixture(scope='session')
+def onion():
+    """The package format (IntermediateNode/onion.py, same as the client's)."""
+    return load('IntermediateNode', 'onion')
+
+
+@pytest.fixture(scope='session')
+def keys():
+    """The key stores of the node (IntermediateNode/keys.py)."""
+    return load('IntermediateNode', 'keys')
+
+
+@pytest.fixture(scope='session')
+def http_pool():
+    """The keep-alive sessions (IntermediateNode/http_pool.py, same as the client's)."""
+    return load('IntermediateNode', 'http_pool')
+
+
+@pytest.fixture(scope='session')
+def node_ids():
+    """The node id allocator (DirectoryNode/node_ids.py)."""
+    return load('DirectoryNode', 'node_ids')
+
+
+@pytest.fixture(scope='session')
+def directory(tmp_path_factory):
+    """The directory node (DirectoryNode/main.py) without any deployed nodes."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('directory'))
+    os.environ['DEPLOYMENT_BACKEND'] = 'local'
+    os.environ['NODE_POOL_SIZE'] = '0'
+    try:
+        return load('DirectoryNode', 'main')
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def key_directory():
+    """The signed key documents (DirectoryNode/key_directory.py)."""
+    return load('DirectoryNode', 'key_directory')
+
+
+@pytest.fixture(scope='session')
+def node_keys():
+    """The client's node key caches (Originator/node_keys.py)."""
+    return load('Originator', 'node_keys')
+
+
+@pytest.fixture(scope='session')
+def routes():
+    """The route store of the directory node (DirectoryNode/routes.py)."""
+    return load('DirectoryNode', 'routes')
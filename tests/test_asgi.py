@@ -0,0 +1,100 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+from starlette.testclient import TestClient
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', '10' if self.path == '/slow' else '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+        if self.path == '/slow':  # The rest of the body never comes
+            self.wfile.flush()
+            self.server.finished.wait(10)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def service():
+    """A service the exit node can reach."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ServiceHandler)
+    server.finished = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.finished.set()
+    server.shutdown()
+
+
+def exit_stream(client, asgi, service):
+    """Return the frames of a streamed GET package for the ASGI node as exit
+    node: the header, two content frames, the end frame and the empty frame."""
+    public_key = client.import_key(asgi.node.keyring.public_key())
+    [(key, cipher_aes, address, circuit,
+      suite)] = client.onion_layers([public_key], [service])
+    return list(
+        client.wrap_stream(key, cipher_aes, address,
+                           [b'GET / HTTP/1.1\r\n', b'Host: service\r\n\r\n'],
+                           circuit, suite))
+
+
+@pytest.fixture(autouse=True)
+def leased(client, asgi, monkeypatch):
+    """Lease the node to a client, which gets the response."""
+    public_key = client.export_key(client.new_key(client.KEY_SUITE))
+    monkeypatch.setitem(asgi.node.lease, 'PUBLIC_KEY', public_key.decode())
+
+
+def relay(asgi, parts):
+    with TestClient(asgi.app) as http:
+        return http.post('/',
+                         content=b''.join(parts),
+                         headers={'Content-Type': asgi.STREAM_TYPE})
+
+
+def test_exit_get_relays_the_response(client, asgi, service):
+    response = relay(asgi, exit_stream(client, asgi, service))
+    assert response.headers['Content-Type'].startswith(asgi.STREAM_TYPE)
+
+
+def test_exit_get_checks_the_trailing_frames(client, asgi, service,
+                                             monkeypatch):
+    monkeypatch.setattr(client, 'CONTENT_MODE', client.MODES['gcm'])  # Has tags
+    parts = exit_stream(client, asgi, service)
+    assert len(parts) == 5
+    frame = bytearray(parts[2])
+    frame[-1] ^= 1
+    parts[2] = bytes(frame)
+
+    response = relay(asgi, parts)
+
+    assert response.text.startswith('Error:')
+    assert not response.headers['Content-Type'].startswith(asgi.STREAM_TYPE)
+
+
+def test_exit_get_releases_the_upstream_on_errors(client, asgi, service,
+                                                  monkeypatch):
+    responses = []
+    get = aiohttp.ClientSession.get
+
+    async def spy(session, *args, **kwargs):
+        responses.append(await get(session, *args, **kwargs))
+        return responses[-1]
+
+    def fail(*args):
+        raise ValueError('No response key')
+
+    monkeypatch.setattr(aiohttp.ClientSession, 'get', spy)
+    monkeypatch.setattr(asgi.node, 'response_cipher', fail)
+
+    response = relay(asgi, exit_stream(client, asgi, service + 'slow'))
+
+    assert response.text == 'Error: No response key'
+    assert [upstream.connection for upstream in responses] == [None]
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+CONTENT = b'{"name": "onion", "hops": 3}\n' * 256
+# The next address of each layer, innermost first
+ADDRESSES = [
+    'http://127.0.0.1:9/service', 'http://127.0.0.1:9/exit',
+    'http://127.0.0.1:9/middle'
+]
+
+
+def public_key(onion, key):
+    """Return the public key of a node the way the client gets it."""
+    return onion.import_key(onion.export_key(key))
+
+
+@pytest.mark.parametrize('mode', ['eax', 'gcm', 'chacha20'])
+def test_build_onion_matches_wrapping_layer_by_layer(client, onion, mode):
+    mode = onion.MODES[mode]
+    secrets = [(os.urandom(32), os.urandom(16)) for _ in ADDRESSES]
+
+    def layers():
+        return [(b'key %d' % hop, onion.LayerCipher(key, mode, nonce),
+                 address.encode(), None, onion.SUITE_X25519)
+                for hop, ((key, nonce),
+                          address) in enumerate(zip(secrets, ADDRESSES))]
+
+    package = CONTENT
+    for enc_key, cipher, address, circuit, suite in layers():
+        package = onion.encode(enc_key, cipher.nonce, address,
+                               cipher.encrypt(package), circuit, suite, mode)
+    assert client.build_onion(CONTENT, layers()) == package
+
+
+def test_every_node_unwraps_its_layer(client, onion):
+    node_keys = [onion.new_key(onion.SUITE_X25519) for _ in ADDRESSES]
+    package = client.build_onion(
+        CONTENT,
+        client.onion_layers([public_key(onion, key) for key in node_keys],
+                            ADDRESSES, onion.MODE_GCM),
+        onion.COMPRESSION_ZLIB)
+
+    for key, address in zip(reversed(node_keys), reversed(ADDRESSES)):
+        parsed = onion.decode(package)
+        assert parsed.address == address
+        _, cipher = onion.key_cipher(key)
+        package = onion.LayerCipher(cipher.decrypt(parsed.key), parsed.mode,
+                                    parsed.nonce).decrypt(parsed.content)
+    assert parsed.compression == onion.COMPRESSION_ZLIB
+    assert onion.decompress(parsed.compression, package) == CONTENT
+
+
+def test_circuit_keys_match_the_nodes(client, onion):
+    route = ['http://127.0.0.1:9/a', 'http://127.0.0.1:9/b']
+    node_keys = [onion.new_key(onion.SUITE_X25519) for _ in route]
+    addresses = ['http://127.0.0.1:9/service', route[1]]
+    circuit = client.Circuit(route)
+    assert circuit.ids[0] != circuit.ids[1]
+    assert circuit.ids != client.Circuit(route).ids
+
+    package = client.build_onion(
+        b'first',
+        circuit.layers(addresses,
+                       [public_key(onion, key) for key in node_keys[::-1]]))
+    stored = []  # The circuit keys the nodes store
+    for hop, key in enumerate(node_keys):
+        parsed = onion.decode(package)
+        assert parsed.circuit == circuit.ids[hop]
+        _, cipher = onion.key_cipher(key)
+        stored.append(onion.derive_circuit_keys(cipher.decrypt(parsed.key)))
+        package = onion.LayerCipher(stored[hop][0], parsed.mode,
+                                    parsed.nonce).decrypt(parsed.content)
+    assert package == b'first'
+    assert stored == circuit.keys
+    assert stored[0][0] != stored[0][1]
+
+    circuit.established = True
+    package = client.build_onion(b'second', circuit.layers(addresses))
+    for hop in range(len(route)):
+        parsed = onion.decode(package)
+        assert parsed.key == b''
+        package = onion.LayerCipher(stored[hop][0], parsed.mode,
+                                    parsed.nonce).decrypt(parsed.content)
+    assert package == b'second'
+
+    response = onion.LayerCipher(stored[0][1], onion.MODE_GCM)
+    enc_content = response.encrypt(b'response')
+    assert circuit.response_cipher(0, b'', response.nonce,
+                                   mode=onion.MODE_GCM).decrypt(
+                                       enc_content) == b'response'
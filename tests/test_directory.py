@@ -0,0 +1,151 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+from Crypto.PublicKey import ECC
+from werkzeug.serving import BaseWSGIServer
+
+
+class PooledServer(BaseWSGIServer):
+    """Serves with a fixed number of threads, like gunicorn with --threads."""
+
+    def __init__(self, app, threads):
+        super().__init__('127.0.0.1', 0, app)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+@pytest.fixture
+def server(directory):
+    """Serve the directory node with 4 threads."""
+    server = PooledServer(directory.app, 4)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.port}'
+    server.shutdown()
+    server.pool.shutdown(wait=False)
+
+
+def test_checks_leave_threads_for_notifications(directory, server,
+                                                monkeypatch):
+    monkeypatch.setattr(directory, 'check_slots',
+                        threading.BoundedSemaphore(2))
+    node = 'http://127.0.0.1:9/node'
+    tracking_ids = [f'check-{i}' for i in range(6)]
+    for tracking_id in tracking_ids:
+        directory.routes.add(tracking_id, [node])
+
+    def check(tracking_id):
+        return requests.post(server + '/check',
+                             json={
+                                 'tracking_id': tracking_id,
+                                 'timeout': 10
+                             },
+                             timeout=30)
+
+    with ThreadPoolExecutor(len(tracking_ids)) as pool:
+        checks = [pool.submit(check, tracking_id) for tracking_id in tracking_ids]
+        time.sleep(0.5)  # Until the checks wait for their routes
+        start = time.monotonic()
+        response = requests.post(server + '/notify/batch',
+                                 json={
+                                     'notifications': [{
+                                         'status': 'success',
+                                         'node_address': node,
+                                         'tracking_id': tracking_id
+                                     } for tracking_id in tracking_ids] * 2
+                                 },
+                                 timeout=30)
+        assert response.ok
+        assert time.monotonic() - start < 2
+        responses = [check.result() for check in checks]
+
+    assert sorted(response.status_code for response in responses) == [
+        200, 200, 503, 503, 503, 503
+    ]
+    for response in responses:
+        if response.status_code == 200:
+            assert response.json() == {'status': 'success'}
+        else:
+            assert response.headers['Retry-After'] == '1'
+
+
+def test_dropped_routes_release_in_background(directory, monkeypatch):
+    released = threading.Event()
+
+    def release(urls, tracking_id):  # Blocks like the /release calls
+        time.sleep(1)
+        released.set()
+
+    monkeypatch.setattr(directory.node_pool, 'release', release)
+    directory.routes.add('dropped', ['http://127.0.0.1:9/node'])
+    monkeypatch.setattr(directory.routes, 'ttl', 0)
+    time.sleep(0.01)
+
+    start = time.monotonic()
+    directory.routes.add('new', ['http://127.0.0.1:9/node'])
+    assert time.monotonic() - start < 0.5
+    assert directory.routes.get('dropped') is None
+    assert released.wait(5)
+
+
+def test_checked_routes_release_their_nodes_once(directory, monkeypatch):
+    released = []
+    monkeypatch.setattr(directory.node_pool, 'release',
+                        lambda urls, tracking_id: released.append(tracking_id))
+    directory.routes.add('checked', ['http://127.0.0.1:9/node'])
+    client = directory.app.test_client()
+
+    response = client.post('/check',
+                           json={
+                               'tracking_id': 'checked',
+                               'timeout': 0.1
+                           })
+    assert response.get_json() == {'error': 'Timeout'}
+    response = client.post('/check',
+                           json={
+                               'tracking_id': 'checked',
+                               'timeout': 0.1
+                           })
+    assert response.status_code == 400
+    assert released == ['checked']
+    assert directory.routes.get('checked') is None
+
+
+def register(directory, token, node_address, public_key):
+    return directory.app.test_client().post(
+        '/register',
+        json={
+            'node_address': node_address,
+            'public_key': public_key
+        },
+        headers={'Authorization': f'Bearer {token}'})
+
+
+def test_nodes_only_register_their_own_key(directory):
+    node_a, node_b = 'http://127.0.0.1:9/a', 'http://127.0.0.1:9/b'
+    key_b = ECC.generate(curve='ed25519').public_key().export_key(
+        format='PEM')
+    key_a = ECC.generate(curve='ed25519').public_key().export_key(
+        format='PEM')
+    assert register(directory, directory.register_token(node_b), node_b,
+                    key_b).status_code == 200
+
+    response = register(directory, directory.register_token(node_a), node_b,
+                        key_a)
+    assert response.status_code == 403
+    response = register(directory, directory.LEASE_TOKEN, node_b, key_a)
+    assert response.status_code == 403
+    assert directory.key_directory.keys([node_b]) == {node_b: key_b}
@@ -0,0 +1,54 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servers():
+    """Two destinations."""
+    started = [ThreadingHTTPServer(('127.0.0.1', 0), Handler) for _ in range(2)]
+    for server in started:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield [f'http://127.0.0.1:{server.server_port}/' for server in started]
+    for server in started:
+        server.shutdown()
+
+
+@pytest.fixture
+def pool(http_pool):
+    """Every request sweeps the sessions, which are idle right away."""
+    return http_pool.SessionPool(idle_timeout=0)
+
+
+def test_streamed_response_keeps_its_session(pool, servers):
+    response = pool.get(servers[0], stream=True)
+    pool.get(servers[1])
+    assert pool.stats()['destinations'] == 2
+    assert next(response.iter_content(2)) == b'he'
+
+    response.close()
+    response.close()  # Released only once
+    pool.get(servers[1])
+    assert pool.stats()['destinations'] == 1
+    assert pool.evictions == 2
+
+
+def test_buffered_response_releases_its_session(pool, servers):
+    with pool.get(servers[0]) as response:
+        assert response.content == b'hello'
+    pool.get(servers[1])
+    assert pool.stats()['destinations'] == 1
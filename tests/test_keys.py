@@ -0,0 +1,77 @@
+import pytest
+
+SESSION_KEY = bytes(range(32))
+
+
+def wrapped(onion, key, session_key=SESSION_KEY):
+    """Wrap an AES key for the public key of a private key, like the client."""
+    _, cipher = onion.key_cipher(onion.import_key(onion.export_key(key)))
+    return cipher.encrypt(session_key)
+
+
+def test_keyring_falls_back_to_older_keys(keys, onion):
+    ring = keys.KeyRing(generations=2)
+    with pytest.raises(ValueError, match='No private key'):
+        ring.decrypt(b'', onion.SUITE_X25519)
+    first, second, third = (onion.new_key(onion.SUITE_X25519)
+                            for _ in range(3))
+    ring.install(first)
+    enc_key = wrapped(onion, first)
+
+    ring.install(second)
+    assert ring.public_key() == onion.export_key(second)
+    assert ring.decrypt(enc_key, onion.SUITE_X25519) == SESSION_KEY
+    assert ring.decrypt(wrapped(onion, second),
+                        onion.SUITE_X25519) == SESSION_KEY
+
+    ring.install(third)  # Rotates the first key out
+    assert len(ring.ciphers()) == 2
+    with pytest.raises(ValueError, match='not wrapped for any key'):
+        ring.decrypt(enc_key, onion.SUITE_X25519)
+
+
+def test_keyring_only_tries_keys_of_the_suite(keys, onion):
+    ring = keys.KeyRing()
+    rsa_key = onion.new_key(onion.SUITE_RSA, 1024)
+    ring.install(rsa_key)
+    ring.install(onion.new_key(onion.SUITE_X25519))
+
+    enc_key = wrapped(onion, rsa_key)
+    assert ring.decrypt(enc_key, onion.SUITE_RSA) == SESSION_KEY
+    with pytest.raises(ValueError, match='not wrapped for any key'):
+        ring.decrypt(enc_key, onion.SUITE_X25519)
+    with pytest.raises(ValueError, match='Only private keys'):
+        ring.install(rsa_key.publickey())
+
+
+def test_keyring_loads_key_files(keys, onion, tmp_path):
+    ring = keys.KeyRing()
+    key_file = tmp_path / 'private.pem'
+    assert not ring.load(str(key_file))
+
+    key = onion.new_key(onion.SUITE_X25519)
+    key_file.write_bytes(onion.export_key(key, private=True))
+    assert ring.load(str(key_file))
+    assert ring.public_key() == onion.export_key(key)
+    assert ring.decrypt(wrapped(onion, key), onion.SUITE_X25519) == SESSION_KEY
+
+
+def test_public_key_cache_evicts_the_least_recently_used(keys, onion):
+    cache = keys.PublicKeyCache(max_size=2)
+    private_keys = [onion.new_key(onion.SUITE_X25519) for _ in range(3)]
+    a, b, c = (onion.export_key(key) for key in private_keys)
+
+    cipher = cache.cipher(a)
+    assert cache.cipher(a.decode() + '\n') is cipher  # Same PEM, same fingerprint
+    suite, wrapping = cipher
+    _, unwrapping = onion.key_cipher(private_keys[0])
+    assert suite == onion.SUITE_X25519
+    assert unwrapping.decrypt(wrapping.encrypt(SESSION_KEY)) == SESSION_KEY
+
+    cache.cipher(b)
+    cache.cipher(a)  # b is the least recently used now
+    cache.cipher(c)
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 3}
+    cache.cipher(a)
+    cache.cipher(b)
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 4}
@@ -0,0 +1,92 @@
+import socket
+import time
+from types import SimpleNamespace
+
+import pytest
+
+SERVICE = 'http://127.0.0.1:9/service'
+
+
+def circuit_package(client, node, circuit, content):
+    """Build a package of a circuit over the single node of the route."""
+    public_keys = None
+    if not circuit.established:
+        public_keys = [client.import_key(node.keyring.public_key())]
+    return client.build_onion(content, circuit.layers([SERVICE], public_keys))
+
+
+def test_release_drops_circuits(client, node, in_node_dir):
+    circuit = client.Circuit(['http://127.0.0.1:9/node'])
+    address, content, *_ = node.parse_package(
+        circuit_package(client, node, circuit, b'first'))
+    assert (address, bytes(content)) == (SERVICE, b'first')
+    circuit.established = True
+    _, content, *_ = node.parse_package(
+        circuit_package(client, node, circuit, b'second'))
+    assert bytes(content) == b'second'
+
+    node.end_lease()
+
+    assert node.circuits.stats()['size'] == 0
+    with pytest.raises(ValueError, match='Unknown circuit'):
+        node.parse_package(circuit_package(client, node, circuit, b'third'))
+
+
+@pytest.fixture
+def hung_service():
+    """A service which accepts connections and never answers."""
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        yield f'http://127.0.0.1:{server.getsockname()[1]}/'
+
+
+def mux_frames(client, chunks):
+    """Decode the frames `serve_streams` yields after MUX_MAGIC."""
+    content = b''.join(chunks)
+    assert content.startswith(client.MUX_MAGIC)
+    reader = client.ChunkReader([content[len(client.MUX_MAGIC):]])
+    return list(client.iter_mux_frames(reader))
+
+
+def test_hung_stream_fails_with_mux_error(client, node, hung_service,
+                                          monkeypatch):
+    monkeypatch.setattr(node, 'MUX_TIMEOUT', 0.5)
+    content = client.encode_mux_requests([('GET', hung_service, b'')])
+    start = time.monotonic()
+    frames = mux_frames(client, node.serve_streams(content))
+    assert time.monotonic() - start < 5
+    assert [(stream_id, flags) for stream_id, flags, _ in frames
+            ] == [(1, client.MUX_ERROR)]
+
+
+def test_streams_without_frames_fail_with_mux_error(client, node,
+                                                    monkeypatch):
+    monkeypatch.setattr(node, 'MUX_TIMEOUT', 0.2)
+    # All threads are busy, none of the requests is sent
+    monkeypatch.setattr(node, 'mux_pool', SimpleNamespace(submit=lambda *args: None))
+    content = client.encode_mux_requests([('GET', SERVICE, b''),
+                                          ('GET', SERVICE, b'')])
+    frames = mux_frames(client, node.serve_streams(content))
+    assert [(stream_id, flags) for stream_id, flags, _ in frames
+            ] == [(1, client.MUX_ERROR), (2, client.MUX_ERROR)]
+    assert b'No response within' in frames[0][2]
+
+
+def test_exhausted_key_pool_is_counted(node):
+    pool = node.KeyPool(1, node.SUITES['x25519'],
+                        on_exhausted=node.KEY_POOL_EXHAUSTED.inc)
+    before = node.metrics.collect().get(
+        ('onion_node_key_pool_exhausted_total', ()), 0)
+    keys = [pool.take(), pool.take()]  # Not started, nothing is ready
+    assert keys[0] is not keys[1]
+    assert pool.stats() == {'depth': 1, 'ready': 0, 'exhausted': 2}
+    assert node.metrics.collect()[('onion_node_key_pool_exhausted_total',
+                                   ())] == before + 2
+
+    pool.start()
+    deadline = time.monotonic() + 5
+    while pool.stats()['ready'] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.take()
+    assert pool.stats()['exhausted'] == 2
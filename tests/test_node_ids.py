@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+
+def test_ids_are_unique_until_all_are_taken(node_ids):
+    allocator = node_ids.NodeIdAllocator(50)
+    ids = allocator.allocate(20) + allocator.allocate(30)
+    assert sorted(ids) == [f'{number:03d}' for number in range(1, 51)]
+    with pytest.raises(RuntimeError, match='Only 0 of 50'):
+        allocator.allocate(1)
+
+    allocator.release(['007', '042', '999'])  # 999 was never allocated
+    assert sorted(allocator.allocate(2)) == ['007', '042']
+    assert allocator.stats() == {'size': 50, 'allocated': 50, 'free': 0}
+
+
+def test_released_ids_are_not_stored(node_ids):
+    allocator = node_ids.NodeIdAllocator(10000)
+    in_use = []
+    for _ in range(2000):  # Routes come and go
+        in_use += allocator.allocate(3)
+        random.shuffle(in_use)
+        allocator.release(in_use[3:])
+        in_use = in_use[:3]
+        assert all(allocator.in_use(node_id) for node_id in in_use)
+    assert len(set(in_use)) == 3
+    assert len(allocator._numbers) == len(allocator._allocated) == 3
+    assert allocator.stats()['free'] == 10000 - 3
@@ -0,0 +1,208 @@
+import pytest
+
+CONTENT = b'{"name": "onion", "hops": 3}\n' * 4096
+
+
+@pytest.fixture(params=['zlib', 'zstd'])
+def compression(request, onion):
+    return onion.COMPRESSIONS[request.param]
+
+
+def test_zstd_is_preferred(onion):
+    accept = (1 << onion.COMPRESSION_ZLIB) | (1 << onion.COMPRESSION_ZSTD)
+    assert onion.choose_compression(accept, len(CONTENT)) == onion.COMPRESSION_ZSTD
+    assert onion.choose_compression(accept, 10) == onion.COMPRESSION_NONE
+
+
+def test_decompress_chunks_round_trip(onion, compression):
+    chunks = [CONTENT[i:i + 10000] for i in range(0, len(CONTENT), 10000)]
+    compressed = list(onion.compress_chunks(compression, chunks))
+    assert b''.join(onion.decompress_chunks(compression, compressed)) == CONTENT
+
+
+def test_truncated_content_is_rejected(onion, compression):
+    compressed = onion.compress(compression, CONTENT)
+    with pytest.raises(ValueError, match='truncated'):
+        onion.decompress(compression, compressed[:-4])
+    # The flushed chunks decompress, only the missing end is noticed
+    chunks = list(onion.compress_chunks(compression, [CONTENT]))[:-1]
+    with pytest.raises(ValueError, match='truncated'):
+        list(onion.decompress_chunks(compression, chunks))
+
+
+def test_corrupt_content_is_rejected(onion, compression):
+    compressed = bytearray(onion.compress(compression, CONTENT))
+    compressed[0] ^= 0xff  # The zlib header or the zstd magic number
+    with pytest.raises(ValueError, match='failed to decompress'):
+        onion.decompress(compression, bytes(compressed))
+
+
+def test_trailing_data_is_rejected(onion, compression):
+    compressed = onion.compress(compression, CONTENT)
+    with pytest.raises(ValueError, match='after its end'):
+        onion.decompress(compression, compressed + b'garbage')
+    chunks = list(onion.compress_chunks(compression, [CONTENT])) + [b'garbage']
+    with pytest.raises(ValueError, match='after its end'):
+        list(onion.decompress_chunks(compression, chunks))
+
+
+def test_bomb_is_stopped_at_the_limit(onion, compression):
+    # 128 MiB of zeros, the decompressor has to stop long before
+    compressor = onion.Compressor(compression)
+    block = b'\0' * (1 << 20)
+    compressed = b''.join(compressor.compress(block) for _ in range(128))
+    decompressor = onion.Decompressor(compression, max_size=1 << 20)
+    with pytest.raises(ValueError, match='exceeds'):
+        decompressor.decompress(compressed)
+    assert decompressor.size < 2 * (1 << 20)
+
+
+def test_unsupported_compression(onion):
+    with pytest.raises(ValueError, match='Unsupported'):
+        onion.Decompressor(onion.COMPRESSION_NONE)
+
+
+def test_x25519_fallback_interoperates(onion, monkeypatch):
+    key = onion.new_key(onion.SUITE_X25519)
+    public_key = onion.import_key(onion.export_key(key))
+    session_key = bytes(range(32))
+    wrapped = onion.key_cipher(public_key)[1].encrypt(session_key)
+    monkeypatch.setattr(onion, 'X25519PrivateKey', None)  # pycryptodome only
+    _, slow = onion.key_cipher(key)
+    assert slow.decrypt(wrapped) == session_key
+    rewrapped = onion.key_cipher(public_key)[1].encrypt(session_key)
+    monkeypatch.undo()
+    assert onion.key_cipher(key)[1].decrypt(rewrapped) == session_key
+
+
+
+@pytest.mark.parametrize('backend', ['cryptography', 'pycryptodome'])
+def test_x25519_rejects_keys_wrapped_for_another_key(onion, monkeypatch,
+                                                     backend):
+    if backend == 'pycryptodome':
+        monkeypatch.setattr(onion, 'X25519PrivateKey', None)
+    key, other = (onion.new_key(onion.SUITE_X25519) for _ in range(2))
+    _, cipher = onion.key_cipher(key)
+    _, other_cipher = onion.key_cipher(other)
+    wrapped = onion.key_cipher(key.public_key())[1].encrypt(bytes(32))
+    assert cipher.decrypt(wrapped) == bytes(32)
+
+    with pytest.raises(ValueError):
+        other_cipher.decrypt(wrapped)
+    tampered = bytearray(wrapped)
+    tampered[-1] ^= 1
+    with pytest.raises(ValueError):
+        cipher.decrypt(bytes(tampered))
+    with pytest.raises(ValueError, match='too short'):
+        cipher.decrypt(wrapped[:onion.X25519_KEY_SIZE + onion.TAG_SIZE])
+    with pytest.raises(TypeError, match='not a private key'):
+        onion.key_cipher(key.public_key())[1].decrypt(wrapped)
+
+NONCE = bytes(range(16))
+CIRCUIT = bytes(16)
+
+
+@pytest.mark.parametrize('fields', [
+    {},
+    {'circuit': CIRCUIT},
+    {'suite': 2},
+    {'suite': 2, 'mode': 1, 'circuit': CIRCUIT},
+    {'suite': 2, 'mode': 2, 'compression': 1, 'accept': 3},
+], ids=['v1', 'v2', 'v3', 'v6', 'v7'])
+def test_codec_round_trip(onion, fields):
+    fields = dict({'circuit': None}, **fields)
+    key, address, content = b'k' * 80, 'http://127.0.0.1:9/next', b'content'
+    data = onion.encode(key, NONCE, address.encode(), content, **fields)
+    assert len(data) == onion.encoded_size(len(key), len(address),
+                                           len(content), **fields)
+    buffer = bytearray(len(data))
+    offset = onion.encode_into(buffer, 0, key, NONCE, address.encode(),
+                               len(content), **fields)
+    buffer[offset:] = content
+    assert buffer == data
+
+    package = onion.decode(data)
+    assert package == onion.Package(key, NONCE, address, content, **fields)
+    assert isinstance(package.content, memoryview)  # Not copied
+    header = onion.read_header(onion.ChunkReader([data[:5], data[5:]]))
+    assert header == onion.Header(key, NONCE, address, len(content),
+                                  **fields)
+
+
+def test_codec_rejects_invalid_lengths(onion):
+    data = onion.encode(b'key', NONCE, b'next', b'content')
+    with pytest.raises(ValueError, match='empty'):
+        onion.decode(b'')
+    with pytest.raises(ValueError, match='too short'):
+        onion.decode(data[:5])
+    with pytest.raises(ValueError, match='shorter than its header says'):
+        onion.decode(data[:-1])
+    with pytest.raises(ValueError, match='Unsupported package version'):
+        onion.decode(b'\x09' + data[1:])
+    with pytest.raises(ValueError, match='Streamed package'):
+        onion.decode(onion.encode_header(b'key', NONCE, b'next'))
+    with pytest.raises(ValueError, match='Stream ended'):
+        onion.read_header(onion.ChunkReader([data[:20]]))
+    with pytest.raises(ValueError, match='Nonce'):
+        onion.encode(b'key', NONCE[:8], b'next', b'content')
+    with pytest.raises(ValueError, match='Circuit id'):
+        onion.encode(b'key', NONCE, b'next', b'content', circuit=b'short')
+
+
+def test_mux_requests_round_trip(onion):
+    requests = [('GET', 'http://127.0.0.1:9/a', b''),
+                ('POST', 'http://127.0.0.1:9/b', b'body\r\n\r\nwith a blank line')]
+    content = onion.encode_mux_requests(requests)
+    assert content.startswith(onion.MUX_MAGIC)
+    assert onion.decode_mux_requests(content) == dict(enumerate(requests, 1))
+
+    with pytest.raises(ValueError, match='no request line'):
+        onion.decode_mux_requests(onion.MUX_MAGIC +
+                                  onion.encode_mux_frame(1, b'GET') +
+                                  onion.encode_mux_frame(0, flags=onion.MUX_END))
+
+
+def test_mux_frames_keep_interleaved_streams_apart(onion):
+    frames = [(1, onion.MUX_DATA, b'one'), (2, onion.MUX_DATA, b'two'),
+              (1, onion.MUX_END, b''), (2, onion.MUX_ERROR, b'Timeout')]
+    content = b''.join(
+        onion.encode_mux_frame(stream_id, data, flags)
+        for stream_id, flags, data in frames)
+    end = onion.encode_mux_frame(0, flags=onion.MUX_END)
+    reader = onion.ChunkReader([content[:7], content[7:] + end])
+    assert list(onion.iter_mux_frames(reader)) == frames
+
+    with pytest.raises(ValueError, match='Stream ended'):
+        list(onion.iter_mux_frames(onion.ChunkReader([content])))
+    oversized = onion.MUX_FRAME.pack(1, onion.MUX_DATA,
+                                     onion.MAX_FRAME_SIZE + 1)
+    with pytest.raises(ValueError, match='exceeds'):
+        list(onion.iter_mux_frames(onion.ChunkReader([oversized])))
+
+
+@pytest.mark.parametrize('mode', ['gcm', 'chacha20'])
+def test_layer_cipher_rejects_reordered_and_truncated_frames(onion, mode):
+    mode = onion.MODES[mode]
+    key = bytes(range(32))
+    sender = onion.LayerCipher(key, mode)
+    chunks = [b'first', b'second', b'third']
+    frames = [sender.encrypt(chunk) for chunk in chunks] + [sender.end()]
+    with pytest.raises(ValueError, match='after the end'):
+        sender.encrypt(b'fourth')
+
+    def receive(frames):
+        return list(
+            onion.decrypt_frames(onion.LayerCipher(key, mode, sender.nonce),
+                                 frames))
+
+    assert receive(frames) == chunks
+    with pytest.raises(ValueError, match='tag check'):
+        receive([frames[1], frames[0]] + frames[2:])
+    with pytest.raises(ValueError, match='tag check'):
+        receive(frames[1:])
+    with pytest.raises(ValueError, match='end of the stream'):
+        receive(frames[:2] + frames[3:])  # The end frame is checked as well
+    with pytest.raises(ValueError, match='cut short'):
+        receive(frames[:-1])
+    with pytest.raises(ValueError, match='shorter than its tag'):
+        onion.LayerCipher(key, mode, sender.nonce).decrypt(b'short')
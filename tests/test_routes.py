@@ -0,0 +1,44 @@
+import time
+
+NODES = ['http://127.0.0.1:9/a', 'http://127.0.0.1:9/b']
+
+
+def test_least_recently_used_routes_are_evicted(routes):
+    dropped = []
+    store = routes.RouteStore(max_size=2,
+                              on_drop=lambda *route: dropped.append(route))
+    first = store.add('first', NODES)
+    store.add('second', NODES)
+    assert store.get('first') is first  # second is the least recently used now
+
+    store.add('third', NODES)
+    assert dropped == [('second', NODES)]
+    assert store.get('second') is None
+    assert store.get('first') is first
+    assert store.stats() == {
+        'size': 2,
+        'created': 3,
+        'expired': 0,
+        'evicted': 1,
+        'removed': 0
+    }
+
+
+def test_unused_routes_expire(routes):
+    dropped = []
+    store = routes.RouteStore(ttl=0.5,
+                              on_drop=lambda *route: dropped.append(route))
+    store.add('expiring', NODES)
+    store.add('used', NODES)
+    time.sleep(0.3)
+    assert store.get('used') is not None
+    time.sleep(0.3)
+
+    assert store.get('expiring') is None
+    assert dropped == [('expiring', NODES)]
+    assert store.get('used') is not None
+    assert store.remove('used') is not None  # The caller releases its nodes
+    assert store.remove('used') is None
+    assert dropped == [('expiring', NODES)]
+    assert store.stats()['expired'] == 1
+    assert store.stats()['removed'] == 1
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SHARED = [
+    ('onion.py', 'IntermediateNode', 'Originator'),
+    ('http_pool.py', 'IntermediateNode', 'Originator'),
+    ('metrics.py', 'IntermediateNode', 'DirectoryNode'),
+]
+
+
+@pytest.mark.parametrize('name, source, copy', SHARED)
+def test_shared_modules_are_identical(name, source, copy):
+    with open(os.path.join(ROOT, source, name), 'rb') as f:
+        expected = f.read()
+    with open(os.path.join(ROOT, copy, name), 'rb') as f:
+        assert f.read() == expected, f'Copy {source}/{name} to {copy}/'
+
+
+def test_client_verifies_directory_documents(key_directory, node_keys):
+    directory = key_directory.KeyDirectory()
+    keys = node_keys.DirectoryKeys(None, None,
+                                   pinned=directory.public_key())
+    document = directory.sign({
+        'route': ['http://127.0.0.1:9/b', 'http://127.0.0.1:9/a'],
+        'keys': {'http://127.0.0.1:9/ä': 'key'},
+        'published': 1
+    })
+    assert node_keys.DirectoryKeys.canonical(
+        document) == key_directory.canonical(document)
+    keys.verify('directory', document)
+
+    with pytest.raises(ValueError, match='not signed'):
+        keys.verify('directory', dict(document, published=2))